@@ -7,22 +7,38 @@ import math
 import os
 import random
 import time
-from concurrent.futures import CancelledError, TimeoutError
 from io import StringIO, BytesIO
+from itertools import islice
 from typing import List, Tuple, TextIO, Optional, Set, Dict, cast, Union, \
-    Sequence, Any, Iterator
+    Sequence, Any, Iterator, Iterable, NamedTuple, Callable
+
+from sparsebitfield import SparseBitfield
 
 from benji.blockuidhistory import BlockUidHistory
 from benji.config import Config
 from benji.database import DatabaseBackend, VersionUid, Version, Block, \
     BlockUid, DereferencedBlock, VersionStatus
+from benji.dedupindex import DedupIndex
 from benji.exception import InputDataError, InternalError, AlreadyLocked, UsageError, ScrubbingError
 from benji.factory import IOFactory, StorageFactory
 from benji.logging import logger
+from benji.pipeline import Pipeline
 from benji.repr import ReprMixIn
 from benji.retentionfilter import RetentionFilter
-from benji.storage.base import InvalidBlockException, BlockNotFoundError
-from benji.utils import notify, BlockHash, PrettyPrint
+from benji.storage.base import InvalidBlockException
+from benji.utils import notify, BlockHash, PrettyPrint, memory_budget
+
+
+class BackupJob(NamedTuple):
+    version_name: str
+    version_snapshot_name: str
+    source: str
+    hints: Optional[Iterable[Tuple[int, int, bool]]] = None
+    base_version_uid: Optional[VersionUid] = None
+    storage_name: Optional[str] = None
+    generate_hints: bool = False
+    # Identifies the job to the caller of batch_backup, it isn't used otherwise
+    job_index: Optional[int] = None
 
 
 class Benji(ReprMixIn):
@@ -30,6 +46,8 @@ class Benji(ReprMixIn):
     # This is in number of blocks (i.e. database rows in the blocks table)
     _BLOCKS_CREATE_WORK_PACKAGE = 10000
     _BLOCKS_READ_WORK_PACKAGE = 10000
+    # Maximum number of blocks which are submitted for reading but whose results haven't been consumed yet
+    _BLOCKS_IN_FLIGHT = 1024
 
     def __init__(self,
                  config: Config,
@@ -47,14 +65,12 @@ class Benji(ReprMixIn):
             self._block_size = block_size
 
         self._block_hash = BlockHash(config.get('hashFunction', types=str))
+        self._simultaneous_hashes = config.get('simultaneousHashes', types=int)
+        memory_budget.set_limit(config.get('memoryBudget', types=int))
         self._process_name = config.get('processName', types=str)
 
         IOFactory.initialize(config)
 
-        StorageFactory.initialize(self.config)
-        default_storage = self.config.get('defaultStorage', types=str)
-        self._default_storage_id = StorageFactory.name_to_storage_id(default_storage)
-
         database_backend = DatabaseBackend(config, in_memory=in_memory_database)
         if init_database or in_memory_database:
             database_backend.init(_destroy=_destroy_database)
@@ -65,8 +81,39 @@ class Benji(ReprMixIn):
         self._database_backend = database_backend.open()
         self._locking = self._database_backend.locking()
 
+        # The storages need the database backend to keep track of the blocks stored inside of packs
+        StorageFactory.initialize(self.config, database_backend=self._database_backend)
+        default_storage = self.config.get('defaultStorage', types=str)
+        self._default_storage_id = StorageFactory.name_to_storage_id(default_storage)
+
+        # Deduplication indexes by storage id, these are shared between all backups done by this instance
+        self._dedup_indexes: Dict[int, DedupIndex] = {}
+
         notify(self._process_name)
 
+    def _dedup_index(self, storage_id: int) -> DedupIndex:
+        if storage_id not in self._dedup_indexes:
+            # The index is loaded on demand
+            self._dedup_indexes[storage_id] = DedupIndex(database_backend=self._database_backend,
+                                                         storage_id=storage_id)
+        return self._dedup_indexes[storage_id]
+
+    def _hash_function(self, zero_block: bytes = None) -> Callable[[Tuple], Tuple]:
+        """ Returns a function for a pipeline map stage which calculates the checksum of the data of a completed read
+        job. Each entry is a tuple with the data as its second element, it is returned with the checksum appended.
+        If zero_block is given, data which is equal to it isn't hashed and None is appended instead of the checksum.
+        """
+        block_hash = self._block_hash
+
+        def hash_entry(entry: Tuple) -> Tuple:
+            data = entry[1]
+            # The comparison stops at the first differing byte, so this is much cheaper than hashing
+            if zero_block is not None and len(data) == len(zero_block) and data == zero_block:
+                return entry + (None,)
+            return entry + (block_hash.data_hexdigest(data),)
+
+        return hash_entry
+
     def _prepare_version(self,
                          version_name: str,
                          version_snapshot_name: str,
@@ -79,7 +126,6 @@ class Benji(ReprMixIn):
         a pure sparse version is created.
         """
         storage_id = StorageFactory.name_to_storage_id(storage_name) if storage_name else None
-        old_blocks_iter: Optional[Iterator[Block]] = None
         if base_version_uid:
             if not base_version_locking and not self._locking.is_version_locked(base_version_uid):
                 raise InternalError('Base version is not locked.')
@@ -92,9 +138,6 @@ class Benji(ReprMixIn):
                 raise UsageError('Base version and new version have to be in the same storage.')
             new_storage_id = old_version.storage_id
 
-            old_blocks_iter = self._database_backend.get_blocks_by_version(base_version_uid,
-                                                                           yield_per=self._BLOCKS_READ_WORK_PACKAGE)
-
             if size is not None:
                 new_size = size
             else:
@@ -120,60 +163,39 @@ class Benji(ReprMixIn):
                                                             status=VersionStatus.incomplete)
             self._locking.lock_version(version.uid, reason='Preparing version')
 
-            uid: Optional[BlockUid]
-            checksum: Optional[str]
-            block_size: int
-            valid: bool
-            blocks: List[Dict[str, Any]] = []
-            old_version_exhausted = old_blocks_iter is None
-            for id in range(num_blocks):
-                if not old_version_exhausted:
-                    assert old_blocks_iter is not None
-                    old_block = next(old_blocks_iter, None)
-                    if old_block is not None:
-                        assert old_block.id == id
-                        uid = old_block.uid
-                        checksum = old_block.checksum
-                        block_size = old_block.size
-                        valid = old_block.valid
-                    else:
-                        old_version_exhausted = True
-                        uid = None
-                        checksum = None
-                        block_size = self._block_size
-                        valid = True
-                else:
-                    uid = None
-                    checksum = None
-                    block_size = self._block_size
-                    valid = True
+            notify(self._process_name, 'Preparing version {}'.format(version.uid.v_string))
+            if base_version_uid:
+                # The blocks of the base version are copied inside the database
+                cloned_blocks = self._database_backend.clone_blocks(base_version_uid=base_version_uid,
+                                                                    version_uid=version.uid,
+                                                                    size=new_size,
+                                                                    block_size=self._block_size)
+            else:
+                cloned_blocks = 0
 
+            # Sparse blocks for the rest of the version
+            blocks: List[Dict[str, Any]] = []
+            for id in range(cloned_blocks, num_blocks):
                 # the last block can differ in size, so let's check
                 _offset = id * self._block_size
                 new_block_size = min(self._block_size, new_size - _offset)
-                if new_block_size != block_size:
-                    # last block changed, so set back all info
-                    block_size = new_block_size
-                    uid = None
-                    checksum = None
-                    valid = False
 
                 blocks.append({
                     'id': id,
                     'version_uid': version.uid,
-                    'uid_left': uid.left if uid is not None else None,
-                    'uid_right': uid.right if uid is not None else None,
-                    'checksum': checksum,
-                    'size': block_size,
-                    'valid': valid
+                    'uid_left': None,
+                    'uid_right': None,
+                    'checksum': None,
+                    'size': new_block_size,
+                    # A short last block is marked invalid so that it is always read
+                    'valid': new_block_size == self._block_size
                 })
 
-                notify(self._process_name, 'Preparing version {} ({:.1f}%)'.format(version.uid.v_string,
-                                                                                   (id + 1) / num_blocks * 100))
-
                 if len(blocks) == self._BLOCKS_CREATE_WORK_PACKAGE:
                     self._database_backend.create_blocks(blocks=blocks)
                     blocks = []
+                    notify(self._process_name, 'Preparing version {} ({:.1f}%)'.format(
+                        version.uid.v_string, (id + 1) / num_blocks * 100))
             self._database_backend.create_blocks(blocks=blocks)
             self._database_backend.commit()
         except:
@@ -205,9 +227,9 @@ class Benji(ReprMixIn):
                        version: Version,
                        history: BlockUidHistory = None,
                        block_percentage: int,
-                       deep_scrub: bool) -> int:
-        storage = StorageFactory.get_by_storage_id(version.storage_id)
-        read_jobs = 0
+                       deep_scrub: bool) -> SparseBitfield:
+        """ Returns the ids of the blocks to scrub. """
+        block_ids = SparseBitfield()
         blocks_count = self._database_backend.get_blocks_count_by_version(version.uid)
         blocks_iter = self._database_backend.get_blocks_by_version(version.uid,
                                                                    yield_per=self._BLOCKS_READ_WORK_PACKAGE)
@@ -229,9 +251,8 @@ class Benji(ReprMixIn):
                 logger.debug('{} of block {} (UID {}) skipped (percentile is {}).'.format(
                     'Deep-scrub' if deep_scrub else 'Scrub', block.id, block.uid, block_percentage))
             else:
-                storage.read_block_async(block, metadata_only=(not deep_scrub))
-                read_jobs += 1
-        return read_jobs
+                block_ids.add(block.id)
+        return block_ids
 
     def _scrub_report_progress(self, *, version_uid: VersionUid, block: DereferencedBlock, read_jobs: int,
                                done_read_jobs: int, deep_scrub: bool) -> None:
@@ -261,13 +282,22 @@ class Benji(ReprMixIn):
         affected_version_uids = []
         try:
             storage = StorageFactory.get_by_storage_id(version.storage_id)
-            read_jobs = self._scrub_prepare(version=version,
+            block_ids = self._scrub_prepare(version=version,
                                             history=history,
                                             block_percentage=block_percentage,
                                             deep_scrub=False)
+            read_jobs = len(block_ids)
+
+            pipeline = Pipeline('scrub', window=self._BLOCKS_IN_FLIGHT)
+            pipeline.read_stage('storage-read',
+                                submit=lambda block: storage.read_block_async(block, metadata_only=True),
+                                get_completed=storage.read_get_completed)
 
             done_read_jobs = 0
-            for entry in storage.read_get_completed():
+            for entry in pipeline.run(
+                    self._database_backend.get_blocks_by_ids(version.uid,
+                                                             block_ids,
+                                                             yield_per=self._BLOCKS_READ_WORK_PACKAGE)):
                 done_read_jobs += 1
                 if isinstance(entry, Exception):
                     # If it really is a data inconsistency mark blocks invalid
@@ -306,11 +336,6 @@ class Benji(ReprMixIn):
             self._locking.unlock_version(version_uid)
             notify(self._process_name)
 
-        if read_jobs != done_read_jobs:
-            raise InternalError(
-                'Number of submitted and completed read jobs inconsistent (submitted: {}, completed {}).'.format(
-                    read_jobs, done_read_jobs))
-
         # A scrub (in contrast to a deep-scrub) can only ever mark a version as invalid. To mark it as valid
         # there is not enough information.
         if valid:
@@ -347,20 +372,33 @@ class Benji(ReprMixIn):
         valid = True
         source_mismatch = False
         affected_version_uids = []
+        lease = memory_budget.lease()
         try:
             storage = StorageFactory.get_by_storage_id(version.storage_id)
             old_use_read_cache = storage.use_read_cache(False)
-            read_jobs = self._scrub_prepare(version=version,
+            block_ids = self._scrub_prepare(version=version,
                                             history=history,
                                             block_percentage=block_percentage,
                                             deep_scrub=True)
+            read_jobs = len(block_ids)
+
+            pipeline = Pipeline('deep-scrub', window=self._BLOCKS_IN_FLIGHT, lease=lease)
+            pipeline.read_stage('storage-read',
+                                submit=storage.read_block_async,
+                                get_completed=storage.read_get_completed,
+                                item_size=lambda block: block.size)
+            pipeline.map_stage('hash', function=self._hash_function(), workers=self._simultaneous_hashes)
 
             done_read_jobs = 0
-            for entry in storage.read_get_completed():
+            for entry in pipeline.run(
+                    self._database_backend.get_blocks_by_ids(version.uid,
+                                                             block_ids,
+                                                             yield_per=self._BLOCKS_READ_WORK_PACKAGE)):
                 done_read_jobs += 1
                 if isinstance(entry, Exception):
                     # If it really is a data inconsistency mark blocks invalid
                     if isinstance(entry, InvalidBlockException):
+                        lease.release(entry.block.size)
                         logger.error('Block {} (UID {}) is invalid: {}'.format(entry.block.id, entry.block.uid, entry))
                         affected_version_uids.extend(self._database_backend.set_block_invalid(entry.block.uid))
                         valid = False
@@ -368,7 +406,9 @@ class Benji(ReprMixIn):
                     else:
                         raise entry
                 else:
-                    block, data, metadata = cast(Tuple[DereferencedBlock, bytes, Dict], entry)
+                    block, data, metadata, data_checksum = cast(Tuple[DereferencedBlock, bytes, Dict, str], entry)
+                    # The data isn't passed on to any other stage
+                    lease.release(block.size)
 
                 try:
                     storage.check_block_metadata(block=block, data_length=len(data), metadata=metadata)
@@ -381,7 +421,6 @@ class Benji(ReprMixIn):
                 except:
                     raise
 
-                data_checksum = self._block_hash.data_hexdigest(data)
                 if data_checksum != block.checksum:
                     logger.error(
                         'Checksum mismatch during deep-scrub of block {} (UID {}) (is: {}... should-be: {}...).'.format(
@@ -418,15 +457,11 @@ class Benji(ReprMixIn):
         finally:
             if source:
                 io.close()
+            lease.close()
             # Restore old read cache setting
             storage.use_read_cache(old_use_read_cache)
             notify(self._process_name)
 
-        if read_jobs != done_read_jobs:
-            raise InternalError(
-                'Number of submitted and completed read jobs inconsistent (submitted: {}, completed {}).'.format(
-                    read_jobs, done_read_jobs))
-
         if valid:
             if block_percentage == 100:
                 try:
@@ -519,6 +554,8 @@ class Benji(ReprMixIn):
             self._locking.unlock_version(version_uid)
             raise
 
+        # Memory held by blocks read from the storage until they are written to the target
+        lease = memory_budget.lease()
         try:
             storage = StorageFactory.get_by_storage_id(version.storage_id)
 
@@ -526,92 +563,76 @@ class Benji(ReprMixIn):
             read_blocks_count = self._database_backend.get_blocks_count_by_version(version_uid) - sparse_blocks_count
 
             t1 = time.time()
-            read_jobs = 0
-            write_jobs = 0
             done_write_jobs = 0
             written = 0
-            log_every_jobs = (sparse_blocks_count if not sparse else read_blocks_count) // 200 + 1  # about every half percent
-            sparse_data_block = b'\0' * version.block_size
-            blocks_iter = self._database_backend.get_blocks_by_version(version_uid,
-                                                                       yield_per=self._BLOCKS_READ_WORK_PACKAGE)
-            for block in blocks_iter:
-                if block.uid:
-                    storage.read_block_async(block)
-                    read_jobs += 1
-                    logger.debug('Queued read for block {} successfully ({} bytes).'.format(block.id, block.size))
-                elif not sparse:
-                    io.write(block, sparse_data_block)
-                    write_jobs += 1
-                    logger.debug('Queued write for sparse block {} successfully ({} bytes).'.format(
-                        block.id, block.size))
-                else:
-                    logger.debug('Ignored sparse block {}.'.format(block.id))
-
-                if sparse:
-                    # Version might be completely sparse
-                    if read_blocks_count > 0:
-                        notify(
-                            self._process_name, 'Restoring version {} to {}: Queueing blocks to read ({:.1f}%)'.format(
-                                version_uid.v_string, target, read_jobs / read_blocks_count * 100))
+            write_blocks_count = read_blocks_count + (sparse_blocks_count if not sparse else 0)
+            log_every_jobs = write_blocks_count // 200 + 1  # about every half percent
+
+            def block_written(written_block: DereferencedBlock) -> None:
+                nonlocal done_write_jobs, written
+                done_write_jobs += 1
+                written += written_block.size
+                # Sparse blocks don't hold any memory
+                if written_block.uid:
+                    lease.release(written_block.size)
+
+                notify(
+                    self._process_name,
+                    'Restoring version {} to {} ({:.1f}%)'.format(version_uid.v_string, target,
+                                                                  done_write_jobs / write_blocks_count * 100))
+                if done_write_jobs % log_every_jobs == 0 or done_write_jobs == write_blocks_count:
+                    logger.info('Restored {}/{} blocks ({:.1f}%)'.format(done_write_jobs, write_blocks_count,
+                                                                         done_write_jobs / write_blocks_count * 100))
+
+            pipeline = Pipeline('restore', window=self._BLOCKS_IN_FLIGHT, lease=lease)
+            pipeline.read_stage('storage-read',
+                                submit=storage.read_block_async,
+                                get_completed=storage.read_get_completed,
+                                item_size=lambda block: block.size)
+            pipeline.map_stage('hash', function=self._hash_function(), workers=self._simultaneous_hashes)
+
+            def write_block(block: DereferencedBlock, data: Optional[bytes]) -> None:
+                # Sparse blocks are zeroed out by the I/O module without transferring any data if possible
+                if data is None:
+                    io.write_zeroes(block)
                 else:
-                    try:
-                        for written_block in io.write_get_completed(timeout=0):
-                            if isinstance(written_block, Exception):
-                                raise written_block
-                            done_write_jobs += 1
-                            written += written_block.size
-
-                            notify(
-                                self._process_name, 'Restoring version {} to {}: Sparse writing ({:.1f}%)'.format(
-                                    version_uid.v_string, target, done_write_jobs / sparse_blocks_count * 100))
-                            if done_write_jobs % log_every_jobs == 0 or done_write_jobs == sparse_blocks_count:
-                                logger.info('Wrote sparse {}/{} blocks ({:.1f}%)'.format(
-                                    done_write_jobs, sparse_blocks_count, done_write_jobs / sparse_blocks_count * 100))
-                    except (TimeoutError, CancelledError):
-                        pass
+                    io.write(block, data)
 
-            try:
-                for written_block in io.write_get_completed():
-                    if isinstance(written_block, Exception):
-                        raise written_block
-                    done_write_jobs += 1
-                    written += written_block.size
-
-                    assert sparse_blocks_count > 0
-                    notify(
-                        self._process_name, 'Restoring version {} to {}: Sparse writing ({:.1f}%)'.format(
-                            version_uid.v_string, target, done_write_jobs / sparse_blocks_count * 100))
-                    if done_write_jobs % log_every_jobs == 0 or done_write_jobs == sparse_blocks_count:
-                        logger.info('Wrote sparse {}/{} blocks ({:.1f}%)'.format(
-                            done_write_jobs, sparse_blocks_count, done_write_jobs / sparse_blocks_count * 100))
-            except CancelledError:
-                pass
-
-            if write_jobs != done_write_jobs:
-                raise InternalError(
-                    'Number of submitted and completed write jobs inconsistent (submitted: {}, completed {}).'.format(
-                        write_jobs, done_write_jobs))
+            pipeline.write_stage('io-write',
+                                 submit=write_block,
+                                 get_completed=io.write_get_completed,
+                                 completed=block_written)
 
-            done_read_jobs = 0
-            write_jobs = 0
-            done_write_jobs = 0
-            log_every_jobs = read_jobs // 200 + 1  # about every half percent
-            for entry in storage.read_get_completed():
-                done_read_jobs += 1
+            def blocks_to_read() -> Iterator[Block]:
+                # Sparse blocks are written directly, all other blocks are passed on to be read from the storage
+                blocks_iter = self._database_backend.get_blocks_by_version(version_uid,
+                                                                           yield_per=self._BLOCKS_READ_WORK_PACKAGE)
+                for block in blocks_iter:
+                    if block.uid:
+                        yield block
+                        logger.debug('Queued read for block {} successfully ({} bytes).'.format(block.id, block.size))
+                    elif not sparse:
+                        pipeline.write(block.deref(), None)
+                        logger.debug('Queued write for sparse block {} successfully ({} bytes).'.format(
+                            block.id, block.size))
+                    else:
+                        logger.debug('Ignored sparse block {}.'.format(block.id))
+
+            for entry in pipeline.run(blocks_to_read()):
                 if isinstance(entry, Exception):
                     logger.error('Storage backend read failed: {}'.format(entry))
                     # If it really is a data inconsistency mark blocks invalid
-                    if isinstance(entry, (KeyError, ValueError)):
-                        self._database_backend.set_block_invalid(block.uid)
+                    if isinstance(entry, InvalidBlockException):
+                        lease.release(entry.block.size)
+                        self._database_backend.set_block_invalid(entry.block.uid)
                         continue
                     else:
                         raise entry
                 else:
-                    block, data, metadata = cast(Tuple[DereferencedBlock, bytes, Dict], entry)
+                    block, data, metadata, data_checksum = cast(Tuple[DereferencedBlock, bytes, Dict, str], entry)
 
                 # Write what we have
-                io.write(block, data)
-                write_jobs += 1
+                pipeline.write(block, data)
 
                 try:
                     storage.check_block_metadata(block=block, data_length=len(data), metadata=metadata)
@@ -622,7 +643,6 @@ class Benji(ReprMixIn):
                 except:
                     raise
 
-                data_checksum = self._block_hash.data_hexdigest(data)
                 if data_checksum != block.checksum:
                     logger.error('Checksum mismatch during restore for block {} (UID {}) (is: {}... should-be: {}..., '
                                  'block.valid: {}). Block restored is invalid.'.format(
@@ -632,58 +652,17 @@ class Benji(ReprMixIn):
                 else:
                     logger.debug('Restored block {} successfully ({} bytes).'.format(block.id, block.size))
 
-                try:
-                    for written_block in io.write_get_completed(timeout=0):
-                        if isinstance(written_block, Exception):
-                            raise written_block
-                        done_write_jobs += 1
-                        written += written_block.size
-
-                        notify(
-                            self._process_name,
-                            'Restoring version {} to {} ({:.1f}%)'.format(version_uid.v_string, target,
-                                                                          done_write_jobs / read_jobs * 100))
-                        if done_write_jobs % log_every_jobs == 0 or done_write_jobs == read_jobs:
-                            logger.info('Restored {}/{} blocks ({:.1f}%)'.format(done_write_jobs, read_jobs,
-                                                                                 done_write_jobs / read_jobs * 100))
-                except (TimeoutError, CancelledError):
-                    pass
-
-            try:
-                for written_block in io.write_get_completed():
-                    if isinstance(written_block, Exception):
-                        raise written_block
-                    done_write_jobs += 1
-                    written += written_block.size
-
-                    notify(
-                        self._process_name,
-                        'Restoring version {} to {} ({:.1f}%)'.format(version_uid.v_string, target,
-                                                                      done_write_jobs / read_jobs * 100))
-                    if done_write_jobs % log_every_jobs == 0 or done_write_jobs == read_jobs:
-                        logger.info('Restored {}/{} blocks ({:.1f}%)'.format(done_write_jobs, read_jobs,
-                                                                             done_write_jobs / read_jobs * 100))
-            except CancelledError:
-                pass
+            lease.log_stats()
 
         except:
             raise
         finally:
             io.close()
+            lease.close()
             t2 = time.time()
             self._locking.unlock_version(version_uid)
             notify(self._process_name)
 
-        if read_jobs != done_read_jobs:
-            raise InternalError(
-                'Number of submitted and completed read jobs inconsistent (submitted: {}, completed {}).'.format(
-                    read_jobs, done_read_jobs))
-
-        if write_jobs != done_write_jobs:
-            raise InternalError(
-                'Number of submitted and completed write jobs inconsistent (submitted: {}, completed {}).'.format(
-                    write_jobs, done_write_jobs))
-
         logger.info('Successfully restored version {} in {} with {}/s.'.format(
             version.uid.v_string, PrettyPrint.duration(max(int(t2 - t1), 1)), PrettyPrint.bytes(written / (t2 - t1))))
 
@@ -730,39 +709,92 @@ class Benji(ReprMixIn):
             logger.info('Removed backup version {} with {} blocks.'.format(version_uid.v_string, num_blocks))
 
     @staticmethod
-    def _blocks_from_hints(hints: Sequence[Tuple[int, int, bool]], block_size: int) -> Tuple[Set[int], Set[int]]:
-        sparse_blocks = set()
-        read_blocks = set()
+    def _runs_from_intervals(intervals: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """ Merges half-open intervals of block ids into sorted and non-overlapping runs of first id and length. """
+        runs: List[Tuple[int, int]] = []
+        for start, end in sorted(intervals):
+            if end <= start:
+                continue
+            if runs and start <= runs[-1][0] + runs[-1][1]:
+                run_start, run_length = runs[-1]
+                runs[-1] = (run_start, max(run_length, end - run_start))
+            else:
+                runs.append((start, end - start))
+        return runs
+
+    @classmethod
+    def _blocks_from_hints(cls,
+                           hints: Iterable[Tuple[int, int, bool]],
+                           block_size: int,
+                           size: int = None) -> Tuple[SparseBitfield, SparseBitfield, List[Tuple[int, int]]]:
+        """ Returns the blocks which are sparse and which need to be read. The third element are the runs of
+        consecutive ids covering both. The hints are only iterated over once, so they can be supplied by a generator.
+        If size is given, hints beyond it are rejected.
+        """
+        sparse_intervals: List[Tuple[int, int]] = []
+        read_intervals: List[Tuple[int, int]] = []
         for offset, length, exists in hints:
+            if size is not None and offset + length > size:
+                raise InputDataError('Hints have higher offsets than source file.')
             start_block = offset // block_size
             end_block = (offset + length - 1) // block_size
             if exists:
-                for i in range(start_block, end_block + 1):
-                    read_blocks.add(i)
+                read_intervals.append((start_block, end_block + 1))
             else:
                 if offset % block_size > 0:
                     # Start block is only partially sparse, make sure it is read
-                    read_blocks.add(start_block)
+                    read_intervals.append((start_block, start_block + 1))
 
                 if (offset + length) % block_size > 0:
                     # End block is only partially sparse, make sure it is read
-                    read_blocks.add(end_block)
+                    read_intervals.append((end_block, end_block + 1))
 
-                for i in range(start_block, end_block + 1):
-                    sparse_blocks.add(i)
+                sparse_intervals.append((start_block, end_block + 1))
 
-        return sparse_blocks, read_blocks
+        # Intervals are half-open, empty intervals are not allowed
+        sparse_blocks = SparseBitfield.from_intervals([(start, end) for start, end in sparse_intervals if end > start])
+        read_blocks = SparseBitfield.from_intervals([(start, end) for start, end in read_intervals if end > start])
+        return sparse_blocks, read_blocks, cls._runs_from_intervals(sparse_intervals + read_intervals)
+
+    @staticmethod
+    def _sanity_check_blocks(ignored_blocks: SparseBitfield, blocks_count: int) -> Set[int]:
+        """ Selects the blocks to check from the blocks not covered by the hints: 0.1% but at least ten. If there
+        are less than ten blocks check them all. Half of them are taken from the start and the other half from random
+        locations.
+        """
+        ignored_blocks_count = len(ignored_blocks)
+        check_blocks_count = max(min(ignored_blocks_count, 10), ignored_blocks_count // 1000)
+        # 50% from the start
+        check_blocks = set(islice(ignored_blocks, check_blocks_count // 2))
+        # and 50% from random locations
+        random_blocks_count = check_blocks_count // 2
+        if ignored_blocks_count * 100 < blocks_count:
+            # The ignored blocks are only a small fraction, so just sample from a list of them
+            check_blocks.update(random.sample(list(ignored_blocks), random_blocks_count))
+        else:
+            # Pick random block ids until we've got enough ignored ones, this needs at most a hundred tries per block
+            # on average
+            random_blocks: Set[int] = set()
+            while len(random_blocks) < random_blocks_count:
+                block_id = random.randrange(blocks_count)
+                if block_id in ignored_blocks:
+                    random_blocks.add(block_id)
+            check_blocks.update(random_blocks)
+        return check_blocks
 
     def backup(self,
                version_name: str,
                version_snapshot_name: str,
                source: str,
-               hints: List[Tuple[int, int, bool]] = None,
+               hints: Iterable[Tuple[int, int, bool]] = None,
                base_version_uid: VersionUid = None,
-               storage_name: str = None) -> Version:
+               storage_name: str = None,
+               generate_hints: bool = False) -> Version:
         """ Create a backup from source.
         If hints are given, they must be tuples of (offset, length, exists) where offset and length are integers and
-        exists is a boolean. In this case only data within hints will be backed up.
+        exists is a boolean. In this case only data within hints will be backed up. The hints are only iterated over
+        once. If no hints are given, the I/O module is asked to provide them. If generate_hints is true, the I/O module
+        generates them even if its configuration doesn't enable this.
         Otherwise, the backup reads source and looks if checksums match with the target.
         """
         block: Union[DereferencedBlock, Block]
@@ -772,6 +804,7 @@ class Benji(ReprMixIn):
             'bytes_written': 0,
             'bytes_dedup': 0,
             'bytes_sparse': 0,
+            'blocks_zero_detected': 0,
             'start_time': time.time(),
         }
         io = IOFactory.get(source, self._block_size)
@@ -780,22 +813,25 @@ class Benji(ReprMixIn):
 
         blocks_count = int(math.ceil(source_size / self._block_size))
 
-        if hints is not None:
-            if len(hints) > 0:
-                # Sanity check: check hints for validity, i.e. too high offsets, ...
-                max_offset = max([h[0] + h[1] for h in hints])
-                if max_offset > source_size:
-                    raise InputDataError('Hints have higher offsets than source file.')
+        if hints is None:
+            base_snapshot_name = self._database_backend.get_version(
+                base_version_uid).snapshot_name if base_version_uid else None
+            hints = io.hints(base_snapshot_name=base_snapshot_name, generate=generate_hints)
+            if hints is not None:
+                logger.info('Using hints provided by the I/O module.')
 
-                sparse_blocks, read_blocks = self._blocks_from_hints(hints, self._block_size)
-            else:
+        if hints is not None:
+            # The hints are checked for too high offsets while they are processed
+            sparse_blocks, read_blocks, hinted_runs = self._blocks_from_hints(hints,
+                                                                              self._block_size,
+                                                                              size=source_size)
+            if len(sparse_blocks) == 0 and len(read_blocks) == 0:
                 # Two snapshots can be completely identical between one backup and next
                 logger.warning('Hints are empty, assuming nothing has changed.')
-                sparse_blocks = set()
-                read_blocks = set()
         else:
-            sparse_blocks = set()
-            read_blocks = set(range(blocks_count))
+            sparse_blocks = SparseBitfield()
+            read_blocks = SparseBitfield.from_intervals([(0, blocks_count)]) if blocks_count > 0 else SparseBitfield()
+            hinted_runs = []
 
         version = self._prepare_version(version_name=version_name,
                                         version_snapshot_name=version_snapshot_name,
@@ -814,27 +850,28 @@ class Benji(ReprMixIn):
             logger.info('Starting sanity check with 0.1% of the ignored blocks.')
             notify(self._process_name, 'Sanity checking hints of version {}'.format(version.uid.v_string))
 
-            ignored_blocks = sorted(set(range(blocks_count)) - read_blocks - sparse_blocks)
-            # 0.1% but at least ten. If there are less than ten blocks check them all.
-            check_blocks_count = max(min(len(ignored_blocks), 10), len(ignored_blocks) // 1000)
-            # 50% from the start
-            check_blocks = set(ignored_blocks[:check_blocks_count // 2])
-            # and 50% from random locations
-            check_blocks = check_blocks.union(random.sample(ignored_blocks, check_blocks_count // 2))
-            read_jobs = 0
-            for block in [self._database_backend.get_block_by_id(version.uid, id) for id in check_blocks]:
-                if block.uid and block.valid:  # no uid = sparse block in backup. Can't check.
-                    io.read(block)
-                    read_jobs += 1
+            ignored_blocks = SparseBitfield.from_intervals([(0, blocks_count)]) if blocks_count > 0 else \
+                SparseBitfield()
+            ignored_blocks.difference_update(read_blocks)
+            ignored_blocks.difference_update(sparse_blocks)
+            check_blocks = self._sanity_check_blocks(ignored_blocks, blocks_count)
 
-            for entry in io.read_get_completed():
+            pipeline = Pipeline('sanity-check', window=self._BLOCKS_IN_FLIGHT)
+            pipeline.read_stage('source-read', submit=io.read, get_completed=io.read_get_completed)
+            pipeline.map_stage('hash', function=self._hash_function(), workers=self._simultaneous_hashes)
+
+            # no uid = sparse block in backup. Can't check.
+            check_blocks_iter = (block for block in self._database_backend.get_blocks_by_ids(
+                version.uid, sorted(check_blocks)) if block.uid and block.valid)
+            read_jobs = 0
+            for entry in pipeline.run(check_blocks_iter):
+                read_jobs += 1
                 if isinstance(entry, Exception):
                     raise entry
                 else:
-                    source_block, source_data = cast(Tuple[DereferencedBlock, bytes], entry)
+                    source_block, source_data, source_data_checksum = cast(Tuple[DereferencedBlock, bytes, str], entry)
 
                 # check metadata checksum with the newly read one
-                source_data_checksum = self._block_hash.data_hexdigest(source_data)
                 if source_block.checksum != source_data_checksum:
                     logger.error("Source and backup don't match in regions outside of the ones indicated by the hints.")
                     logger.error("Looks like the hints don't match or the source is different.")
@@ -846,61 +883,97 @@ class Benji(ReprMixIn):
                     raise InputDataError('Source changed in regions outside of ones indicated by the hints.')
             logger.info('Finished sanity check. Checked {} blocks.'.format(read_jobs))
 
+        # Memory held by blocks read from the source until they are written to the storage or found to be redundant
+        lease = memory_budget.lease()
         try:
             storage = StorageFactory.get_by_storage_id(version.storage_id)
-            read_jobs = 0
-            blocks_iter = self._database_backend.get_blocks_by_version(version.uid,
-                                                                       yield_per=self._BLOCKS_READ_WORK_PACKAGE)
-            for block in blocks_iter:
-                if block.id in read_blocks or not block.valid:
-                    io.read(block)
-                    read_jobs += 1
-                elif block.id in sparse_blocks:
-                    # This "elif" is very important. Because if the block is in read_blocks AND sparse_blocks,
-                    # it *must* be read.
-
-                    # Only update the database when the block wasn't sparse to begin with
-                    if block.uid is not None:
-                        self._database_backend.set_block(id=block.id,
-                                                         version_uid=version.uid,
-                                                         block_uid=None,
-                                                         checksum=None,
-                                                         size=block.size,
-                                                         valid=True)
-                        logger.debug('Skipping block (had data, turned sparse) {}'.format(block.id))
-                    else:
-                        assert block.checksum is None
-                        logger.debug('Skipping block (sparse) {}'.format(block.id))
-                    stats['bytes_sparse'] += block.size
-
-                else:
-                    # Block is already in database, no need to update it
-                    logger.debug('Keeping block {}'.format(block.id))
-                notify(
-                    self._process_name, 'Backing up version {} from {}: Queueing blocks to read ({:.1f}%)'.format(
-                        version.uid.v_string, source, (block.id + 1) / blocks_count * 100))
+            dedup_index = self._dedup_index(version.storage_id)
+            if hints is not None:
+                # Only look at the blocks covered by the hints. Invalid blocks are always re-read.
+                invalid_blocks = self._database_backend.get_invalid_block_ids_by_version(version.uid)
+                read_blocks.update(SparseBitfield(invalid_blocks))
+                # The blocks are queried run by run, so that the cost doesn't depend on the size of the runs
+                if invalid_blocks:
+                    hinted_runs = self._runs_from_intervals([(start, start + length) for start, length in hinted_runs] +
+                                                            [(block_id, block_id + 1) for block_id in invalid_blocks])
+                blocks_iter = self._database_backend.get_blocks_by_id_runs(version.uid,
+                                                                           hinted_runs,
+                                                                           yield_per=self._BLOCKS_READ_WORK_PACKAGE)
+            else:
+                blocks_iter = self._database_backend.get_blocks_by_version(version.uid,
+                                                                           yield_per=self._BLOCKS_READ_WORK_PACKAGE)
+            # Without hints all blocks are read, with hints the invalid blocks have been added to read_blocks above
+            read_blocks_count = len(read_blocks)
+
+            def blocks_to_read() -> Iterator[Block]:
+                for block in blocks_iter:
+                    if block.id in read_blocks or not block.valid:
+                        yield block
+                    elif block.id in sparse_blocks:
+                        # This "elif" is very important. Because if the block is in read_blocks AND sparse_blocks,
+                        # it *must* be read.
+
+                        # Only update the database when the block wasn't sparse to begin with
+                        if block.uid is not None:
+                            self._database_backend.set_block(id=block.id,
+                                                             version_uid=version.uid,
+                                                             block_uid=None,
+                                                             checksum=None,
+                                                             size=block.size,
+                                                             valid=True)
+                            logger.debug('Skipping block (had data, turned sparse) {}'.format(block.id))
+                        else:
+                            assert block.checksum is None
+                            logger.debug('Skipping block (sparse) {}'.format(block.id))
+                        stats['bytes_sparse'] += block.size
 
-            # precompute checksum of a sparse block
-            sparse_block_checksum = self._block_hash.data_hexdigest(b'\0' * self._block_size)
+                    else:
+                        # Block is already in database, no need to update it
+                        logger.debug('Keeping block {}'.format(block.id))
+
+            def block_written(written_block: DereferencedBlock) -> None:
+                self._database_backend.set_block(id=written_block.id,
+                                                 version_uid=written_block.version_uid,
+                                                 block_uid=written_block.uid,
+                                                 checksum=written_block.checksum,
+                                                 size=written_block.size,
+                                                 valid=True)
+                dedup_index.add(cast(str, written_block.checksum))
+                lease.release(written_block.size)
+                stats['bytes_written'] += written_block.size
+
+            # Shared buffer for detecting blocks which only contain zeros
+            zero_block = bytes(self._block_size)
+
+            # Zero detection and hashing happen in the same stage as the zero check is very cheap. Deduplication
+            # happens in the consumer as it needs the database session. Transformations are applied by the storage
+            # before writing.
+            pipeline = Pipeline('backup', window=self._BLOCKS_IN_FLIGHT, lease=lease)
+            pipeline.read_stage('source-read',
+                                submit=io.read,
+                                get_completed=io.read_get_completed,
+                                item_size=lambda block: block.size)
+            pipeline.map_stage('hash', function=self._hash_function(zero_block), workers=self._simultaneous_hashes)
+            pipeline.write_stage('storage-write',
+                                 submit=storage.write_block_async,
+                                 get_completed=storage.write_get_completed,
+                                 completed=block_written)
 
             done_read_jobs = 0
-            write_jobs = 0
-            done_write_jobs = 0
-            log_every_jobs = read_jobs // 200 + 1  # about every half percent
-            for entry in io.read_get_completed():
+            log_every_jobs = read_blocks_count // 200 + 1  # about every half percent
+            for entry in pipeline.run(blocks_to_read()):
                 if isinstance(entry, Exception):
                     raise entry
                 else:
-                    block, data = cast(Tuple[DereferencedBlock, bytes], entry)
+                    block, data, data_checksum = cast(Tuple[DereferencedBlock, bytes, Optional[str]], entry)
 
                 stats['bytes_read'] += len(data)
 
                 # dedup
-                data_checksum = self._block_hash.data_hexdigest(data)
-                existing_block = self._database_backend.get_block_by_checksum(data_checksum, version.storage_id)
-                if data_checksum == sparse_block_checksum and block.size == self._block_size:
+                if data_checksum is None:
                     # if the block is only \0, set it as a sparse block.
                     stats['bytes_sparse'] += block.size
+                    stats['blocks_zero_detected'] += 1
                     logger.debug('Skipping block (detected sparse) {}'.format(block.id))
                     self._database_backend.set_block(id=block.id,
                                                      version_uid=version.uid,
@@ -908,67 +981,43 @@ class Benji(ReprMixIn):
                                                      checksum=None,
                                                      size=block.size,
                                                      valid=True)
-                elif existing_block:
-                    self._database_backend.set_block(id=block.id,
-                                                     version_uid=version.uid,
-                                                     block_uid=existing_block.uid,
-                                                     checksum=existing_block.checksum,
-                                                     size=existing_block.size,
-                                                     valid=True)
+                    lease.release(block.size)
+                elif block.uid and block.valid and block.checksum == data_checksum:
+                    # Fast path: The block is unchanged in relation to the base version and the database
+                    # already contains the right information.
                     stats['bytes_dedup'] += len(data)
-                    logger.debug('Found existing block for id {} with UID {}'.format(block.id, existing_block.uid))
+                    logger.debug('Keeping block {} (unchanged) with UID {}'.format(block.id, block.uid))
+                    lease.release(block.size)
                 else:
-                    block.uid = BlockUid(version.uid.integer, block.id + 1)
-                    block.checksum = data_checksum
-                    storage.write_block_async(block, data)
-                    write_jobs += 1
-                    logger.debug('Queued block {} for write (checksum {}...)'.format(block.id, data_checksum[:16]))
+                    existing_block = dedup_index.get(data_checksum)
+                    if existing_block is not None:
+                        self._database_backend.set_block(id=block.id,
+                                                         version_uid=version.uid,
+                                                         block_uid=existing_block.uid,
+                                                         checksum=existing_block.checksum,
+                                                         size=existing_block.size,
+                                                         valid=True)
+                        stats['bytes_dedup'] += len(data)
+                        logger.debug('Found existing block for id {} with UID {}'.format(block.id, existing_block.uid))
+                        lease.release(block.size)
+                    else:
+                        block.uid = BlockUid(version.uid.integer, block.id + 1)
+                        block.checksum = data_checksum
+                        pipeline.write(block, data)
+                        logger.debug('Queued block {} for write (checksum {}...)'.format(block.id, data_checksum[:16]))
 
                 done_read_jobs += 1
 
-                try:
-                    for written_block in storage.write_get_completed(timeout=0):
-                        if isinstance(written_block, Exception):
-                            raise written_block
-
-                        written_block = cast(DereferencedBlock, written_block)
-
-                        self._database_backend.set_block(id=written_block.id,
-                                                         version_uid=written_block.version_uid,
-                                                         block_uid=written_block.uid,
-                                                         checksum=written_block.checksum,
-                                                         size=written_block.size,
-                                                         valid=True)
-                        done_write_jobs += 1
-                        stats['bytes_written'] += written_block.size
-                except (TimeoutError, CancelledError):
-                    pass
-
                 notify(
                     self._process_name,
                     'Backing up version {} from {} ({:.1f}%)'.format(version.uid.v_string, source,
-                                                                     done_read_jobs / read_jobs * 100))
-                if done_read_jobs % log_every_jobs == 0 or done_read_jobs == read_jobs:
-                    logger.info('Backed up {}/{} blocks ({:.1f}%)'.format(done_read_jobs, read_jobs,
-                                                                          done_read_jobs / read_jobs * 100))
-
-            try:
-                for written_block in storage.write_get_completed():
-                    if isinstance(written_block, Exception):
-                        raise written_block
-
-                    written_block = cast(DereferencedBlock, written_block)
+                                                                     done_read_jobs / read_blocks_count * 100))
+                if done_read_jobs % log_every_jobs == 0 or done_read_jobs == read_blocks_count:
+                    logger.info('Backed up {}/{} blocks ({:.1f}%)'.format(done_read_jobs, read_blocks_count,
+                                                                          done_read_jobs / read_blocks_count * 100))
 
-                    self._database_backend.set_block(id=written_block.id,
-                                                     version_uid=written_block.version_uid,
-                                                     block_uid=written_block.uid,
-                                                     checksum=written_block.checksum,
-                                                     size=written_block.size,
-                                                     valid=True)
-                    done_write_jobs += 1
-                    stats['bytes_written'] += written_block.size
-            except CancelledError:
-                pass
+            dedup_index.log_stats()
+            lease.log_stats()
 
         except:
             self._locking.unlock_version(version.uid)
@@ -976,18 +1025,9 @@ class Benji(ReprMixIn):
         finally:
             # This will also cancel any outstanding read jobs
             io.close()
+            lease.close()
             self._database_backend.commit()
 
-        if read_jobs != done_read_jobs:
-            raise InternalError(
-                'Number of submitted and completed read jobs inconsistent (submitted: {}, completed {}).'.format(
-                    read_jobs, done_read_jobs))
-
-        if write_jobs != done_write_jobs:
-            raise InternalError(
-                'Number of submitted and completed write jobs inconsistent (submitted: {}, completed {}).'.format(
-                    write_jobs, done_write_jobs))
-
         notify(self._process_name, 'Marking version {} as valid'.format(version.uid.v_string))
         self._database_backend.set_version(version.uid, status=VersionStatus.valid)
 
@@ -1009,31 +1049,55 @@ class Benji(ReprMixIn):
         logger.info('New version {} created, backup successful.'.format(version.uid.v_string))
         return version
 
+    def batch_backup(self, jobs: Iterable[BackupJob]) -> Iterator[Tuple[BackupJob, Union[Version, Exception]]]:
+        """ Backs up multiple sources one after another. The storage instances, their worker threads and connection
+        pools as well as the deduplication indexes are shared between all backups. A failing backup doesn't stop the
+        remaining ones. For each job the new version or the exception is yielded. The backups are performed
+        sequentially, only the storage and I/O modules work on the blocks of each backup concurrently. They can't run
+        in parallel as the database session, the deduplication and pack indexes and the storage job executors may only
+        be used by one thread.
+        """
+        for job in jobs:
+            logger.info('Backing up {} to version name {}.'.format(job.source, job.version_name))
+            try:
+                version = self.backup(version_name=job.version_name,
+                                      version_snapshot_name=job.version_snapshot_name,
+                                      source=job.source,
+                                      hints=job.hints,
+                                      base_version_uid=job.base_version_uid,
+                                      storage_name=job.storage_name,
+                                      generate_hints=job.generate_hints)
+            except Exception as exception:
+                logger.error('Backup of {} to version name {} failed: {}'.format(job.source, job.version_name,
+                                                                                 exception))
+                # Throw away any uncommitted changes of the failed backup so that the next one starts afresh
+                self._database_backend.rollback()
+                yield job, exception
+            else:
+                yield job, version
+
     def cleanup(self, dt: int = 3600, override_lock: bool = False) -> None:
         with self._locking.with_lock(lock_name='cleanup',
                                      reason='Cleanup',
                                      locked_msg='Another cleanup is already running.',
                                      override_lock=override_lock):
             notify(self._process_name, 'Cleanup')
+            storage_ids = set()
             for hit_list in self._database_backend.get_delete_candidates(dt):
                 for storage_id, uids in hit_list.items():
+                    storage_ids.add(storage_id)
                     storage = StorageFactory.get_by_storage_id(storage_id)
                     logger.debug('Deleting UIDs from storage {}: {}'.format(storage.name,
                                                                             ', '.join([str(uid) for uid in uids])))
 
-                    for uid in uids:
-                        storage.rm_block_async(uid)
-
-                    no_del_uids = []
-                    for entry in storage.rm_get_completed():
-                        if isinstance(entry, BlockNotFoundError):
-                            no_del_uids.append(entry.uid)
-                        elif isinstance(uid, Exception):
-                            raise entry
-
+                    no_del_uids = storage.rm_many_blocks(uids)
                     if no_del_uids:
                         logger.info('Unable to delete these UIDs from storage {}: {}'.format(
                             storage.name, ', '.join([str(uid) for uid in no_del_uids])))
+
+            # Reclaim the space taken up by removed blocks which were stored inside of packs
+            for storage_id in storage_ids:
+                StorageFactory.get_by_storage_id(storage_id).compact_packs()
             notify(self._process_name)
 
     def add_label(self, version_uid: VersionUid, key: str, value: str) -> None:
@@ -1088,9 +1152,16 @@ class Benji(ReprMixIn):
     def metadata_import(self, f: TextIO) -> None:
         # TODO: Find a good way to lock here
         version_uids = self._database_backend.import_(f)
+        self._rebuild_pack_indexes(version_uids)
         logger.info('Imported metadata of version(s): {}.'.format(', '.join(
             [version_uid.v_string for version_uid in version_uids])))
 
+    def _rebuild_pack_indexes(self, version_uids: Iterable[VersionUid]) -> None:
+        # The location of blocks stored inside of packs isn't part of the version metadata
+        storage_ids = {self._database_backend.get_version(version_uid).storage_id for version_uid in version_uids}
+        for storage_id in storage_ids:
+            StorageFactory.get_by_storage_id(storage_id).rebuild_pack_index()
+
     def metadata_restore(self, version_uids: Sequence[VersionUid], storage_name: str = None) -> None:
         if storage_name is not None:
             storage = StorageFactory.get_by_name(storage_name)
@@ -1107,6 +1178,7 @@ class Benji(ReprMixIn):
                 with StringIO(metadata_import_data) as metadata_import:
                     self._database_backend.import_(metadata_import)
                 logger.info('Restored metadata of version {}.'.format(version_uid.v_string))
+            self._rebuild_pack_indexes(version_uids)
         finally:
             for version_uid in locked_version_uids:
                 self._locking.unlock_version(version_uid)
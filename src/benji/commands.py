@@ -2,18 +2,19 @@ import json
 import logging
 import os
 import sys
-from typing import List, NamedTuple, Type, Optional
+from contextlib import ExitStack
+from typing import List, NamedTuple, Type, Optional, Dict, Any, Iterator, Tuple, cast
 
 from prettytable import PrettyTable
 
 import benji.exception
 from benji import __version__
-from benji.benji import Benji, BenjiStore
+from benji.benji import Benji, BenjiStore, BackupJob
 from benji.database import Version, VersionUid
 from benji.factory import StorageFactory
 from benji.logging import logger
 from benji.nbdserver import NbdServer
-from benji.utils import hints_from_rbd_diff, PrettyPrint, InputValidation
+from benji.utils import hints_from_rbd_diff_file, PrettyPrint, InputValidation
 from benji.versions import VERSIONS
 
 
@@ -30,7 +31,7 @@ class Commands:
         self.config = config
 
     def backup(self, version_name: str, snapshot_name: str, source: str, rbd_hints: str, base_version_uid: str,
-               block_size: int, labels: List[str], storage: str) -> None:
+               block_size: int, labels: List[str], storage: str, generate_hints: bool) -> None:
         # Validate version_name and snapshot_name
         if not InputValidation.is_backup_name(version_name):
             raise benji.exception.UsageError('Version name {} is invalid.'.format(version_name))
@@ -42,25 +43,22 @@ class Commands:
         benji_obj = None
         try:
             benji_obj = Benji(self.config, block_size=block_size)
-            hints = None
-            if rbd_hints:
-                logger.debug(f'Loading RBD hints from file {rbd_hints}.')
-                with open(rbd_hints, 'r') as f:
-                    hints = hints_from_rbd_diff(f.read())
-            backup_version = benji_obj.backup(version_name, snapshot_name, source, hints, base_version_uid_obj, storage)
+            with ExitStack() as stack:
+                hints = None
+                if rbd_hints:
+                    logger.debug(f'Loading RBD hints from file {rbd_hints}.')
+                    # The hints are parsed while the backup consumes them
+                    hints = hints_from_rbd_diff_file(stack.enter_context(open(rbd_hints, 'r')))
+                backup_version = benji_obj.backup(version_name,
+                                                  snapshot_name,
+                                                  source,
+                                                  hints,
+                                                  base_version_uid_obj,
+                                                  storage,
+                                                  generate_hints=generate_hints)
 
             if labels:
-                for key, value in label_add:
-                    benji_obj.add_label(backup_version.uid, key, value)
-                for key in label_remove:
-                    benji_obj.rm_label(backup_version.uid, key)
-                if label_add:
-                    logger.info('Added label(s) to version {}: {}.'.format(
-                        backup_version.uid.v_string,
-                        ', '.join(['{}={}'.format(name, value) for name, value in label_add])))
-                if label_remove:
-                    logger.info('Removed label(s) from version {}: {}.'.format(backup_version.uid.v_string,
-                                                                               ', '.join(label_remove)))
+                self._add_labels(benji_obj, backup_version, label_add, label_remove)
 
             if self.machine_output:
                 benji_obj.export_any({'versions': [backup_version]},
@@ -70,6 +68,103 @@ class Commands:
             if benji_obj:
                 benji_obj.close()
 
+    @staticmethod
+    def _add_labels(benji_obj: Benji, version: Version, label_add: List[Tuple[str, str]],
+                    label_remove: List[str]) -> None:
+        for key, value in label_add:
+            benji_obj.add_label(version.uid, key, value)
+        for key in label_remove:
+            benji_obj.rm_label(version.uid, key)
+        if label_add:
+            logger.info('Added label(s) to version {}: {}.'.format(
+                version.uid.v_string, ', '.join(['{}={}'.format(name, value) for name, value in label_add])))
+        if label_remove:
+            logger.info('Removed label(s) from version {}: {}.'.format(version.uid.v_string, ', '.join(label_remove)))
+
+    def batch_backup(self, jobs_file: str, block_size: int) -> None:
+        logger.debug(f'Loading backup jobs from file {jobs_file}.')
+        with open(jobs_file, 'r', encoding='utf-8') as f:
+            try:
+                jobs = json.load(f)
+            except ValueError as exception:
+                raise benji.exception.InputDataError('Jobs file {} is invalid.'.format(jobs_file)) from exception
+        if not isinstance(jobs, list):
+            raise benji.exception.InputDataError('Jobs file {} must contain a list of jobs.'.format(jobs_file))
+
+        # Validate all jobs before starting the first backup
+        labels: Dict[int, Tuple[List[Tuple[str, str]], List[str]]] = {}
+        for i, job in enumerate(jobs):
+            if not isinstance(job, dict) or 'source' not in job or 'version_name' not in job:
+                raise benji.exception.InputDataError('Job {} in {} needs at least a source and a version_name.'.format(
+                    i, jobs_file))
+            if not InputValidation.is_backup_name(job['version_name']):
+                raise benji.exception.UsageError('Version name {} is invalid.'.format(job['version_name']))
+            if not InputValidation.is_snapshot_name(job.get('snapshot_name', '')):
+                raise benji.exception.UsageError('Snapshot name {} is invalid.'.format(job.get('snapshot_name')))
+            labels[i] = InputValidation.parse_and_validate_labels(job.get('labels', []))
+
+        failed_jobs: List[Dict[str, Any]] = []
+
+        def backup_jobs() -> Iterator[BackupJob]:
+            # Hints are parsed while each job's backup consumes them. The hints file stays open until the job is
+            # finished and the next one is requested.
+            for i, job in enumerate(jobs):
+                with ExitStack() as stack:
+                    hints = None
+                    if job.get('rbd_hints'):
+                        logger.debug(f'Loading RBD hints from file {job["rbd_hints"]}.')
+                        try:
+                            hints = hints_from_rbd_diff_file(stack.enter_context(open(job['rbd_hints'], 'r')))
+                        except OSError as exception:
+                            logger.error('Loading RBD hints from file {} failed: {}'.format(
+                                job['rbd_hints'], exception))
+                            failed_jobs.append({'job': i, 'exception': exception})
+                            continue
+                    base_version_uid = job.get('base_version_uid')
+                    backup_job = BackupJob(version_name=job['version_name'],
+                                           version_snapshot_name=job.get('snapshot_name', ''),
+                                           source=job['source'],
+                                           hints=hints,
+                                           base_version_uid=VersionUid(base_version_uid) if base_version_uid else None,
+                                           storage_name=job.get('storage') or None,
+                                           generate_hints=bool(job.get('generate_hints', False)),
+                                           job_index=i)
+                    yield backup_job
+
+        benji_obj = None
+        try:
+            benji_obj = Benji(self.config, block_size=block_size)
+            versions = []
+            for job, result in benji_obj.batch_backup(backup_jobs()):
+                i = cast(int, job.job_index)
+                if isinstance(result, Exception):
+                    failed_jobs.append({'job': i, 'exception': result})
+                    continue
+                label_add, label_remove = labels[i]
+                self._add_labels(benji_obj, result, label_add, label_remove)
+                versions.append(result)
+
+            failed_jobs.sort(key=lambda failed_job: failed_job['job'])
+            if self.machine_output:
+                errors = [{
+                    'version_name': jobs[failed_job['job']]['version_name'],
+                    'snapshot_name': jobs[failed_job['job']].get('snapshot_name', ''),
+                    'source': jobs[failed_job['job']]['source'],
+                    'error': '{}: {}'.format(failed_job['exception'].__class__.__name__, failed_job['exception']),
+                } for failed_job in failed_jobs]
+                benji_obj.export_any({
+                    'versions': versions,
+                    'errors': errors,
+                },
+                                     sys.stdout,
+                                     ignore_relationships=[((Version,), ('blocks',))])
+            if failed_jobs:
+                logger.error('{} of {} backups failed.'.format(len(failed_jobs), len(jobs)))
+                raise failed_jobs[0]['exception']
+        finally:
+            if benji_obj:
+                benji_obj.close()
+
     def restore(self, version_uid: str, destination: str, sparse: bool, force: bool, database_less: bool,
                 storage: str) -> None:
         if not database_less and storage is not None:
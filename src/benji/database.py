@@ -15,7 +15,8 @@ from abc import abstractmethod
 from binascii import hexlify, unhexlify
 from contextlib import contextmanager
 from functools import total_ordering
-from typing import Union, List, Tuple, TextIO, Dict, cast, Iterator, Set, Any, Optional, Sequence, Callable
+from typing import Union, List, Tuple, TextIO, Dict, cast, Iterator, Set, Any, Optional, Sequence, Callable, \
+    Iterable, NamedTuple
 
 import pyparsing
 import semantic_version
@@ -305,6 +306,58 @@ class BlockUid(sqlalchemy.ext.mutable.MutableComposite, StorageKeyMixIn['BlockUi
     # End: Implements StorageKeyMixIn
 
 
+class PackUid(StorageKeyMixIn['PackUid']):
+    """ Identifies a pack object. Pack UIDs are random so that they can be generated by the storage threads without
+    consulting the database.
+    """
+
+    _LENGTH = 32
+
+    def __init__(self, value: str) -> None:
+        if len(value) != self._LENGTH:
+            raise ValueError('Pack UID {} has an invalid length, expected exactly {} characters.'.format(
+                value, self._LENGTH))
+        self.value = value
+
+    @classmethod
+    def new(cls) -> 'PackUid':
+        return cls(uuid.uuid4().hex)
+
+    def __str__(self) -> str:
+        return self.value
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, PackUid):
+            return self.value == other.value
+        else:
+            return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self.value)
+
+    # Start: Implements StorageKeyMixIn
+    _STORAGE_PREFIX = 'packs/'
+
+    @classmethod
+    def storage_prefix(cls) -> str:
+        return cls._STORAGE_PREFIX
+
+    def _storage_object_to_key(self) -> str:
+        return self.value
+
+    @classmethod
+    def _storage_key_to_object(cls, key: str) -> 'PackUid':
+        return PackUid(key)
+
+    # End: Implements StorageKeyMixIn
+
+
+class PackLocation(NamedTuple):
+    pack_uid: PackUid
+    offset: int
+    length: int
+
+
 # Explicit naming helps Alembic to auto-generate versions
 metadata = sqlalchemy.MetaData(
     naming_convention={
@@ -489,6 +542,41 @@ class DeletedBlock(Base):
     __table_args__ = (sqlalchemy.Index(None, 'uid_left', 'uid_right'), {'sqlite_autoincrement': True})
 
 
+class Pack(Base):
+    __tablename__ = 'packs'
+
+    REPR_SQL_ATTR_SORT_FIRST = ['storage_id', 'uid']
+
+    storage_id = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    uid = sqlalchemy.Column(sqlalchemy.String(32), nullable=False)
+    # Size of the pack object including the space taken up by removed blocks
+    size = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    date = sqlalchemy.Column(BenjiDateTime, nullable=False)
+
+    __table_args__ = (sqlalchemy.PrimaryKeyConstraint('storage_id', 'uid'),)
+
+
+class PackedBlock(Base):
+    __tablename__ = 'packed_blocks'
+
+    REPR_SQL_ATTR_SORT_FIRST = ['storage_id', 'uid_left', 'uid_right']
+
+    storage_id = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    uid_left = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    uid_right = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    pack_uid = sqlalchemy.Column(sqlalchemy.String(32), nullable=False)
+    offset = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    length = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+    uid = sqlalchemy.orm.composite(BlockUid, uid_left, uid_right, comparator_factory=BlockUidComparator)
+    __table_args__ = (
+        sqlalchemy.PrimaryKeyConstraint('storage_id', 'uid_left', 'uid_right'),
+        sqlalchemy.ForeignKeyConstraint(['storage_id', 'pack_uid'], ['packs.storage_id', 'packs.uid'],
+                                        ondelete='CASCADE'),
+        sqlalchemy.Index(None, 'storage_id', 'pack_uid'),
+    )
+
+
 class Lock(Base):
     __tablename__ = 'locks'
 
@@ -505,6 +593,11 @@ class DatabaseBackend(ReprMixIn):
     _METADATA_VERSION_KEY = 'metadata_version'
     _METADATA_VERSION_REGEX = r'\d+\.\d+\.\d+'
     _BLOCKS_COMMIT_INTERVAL = 20  # in seconds
+    _BLOCK_UPDATES_FLUSH_SIZE = 5000  # in number of blocks
+    # Each range takes two bound parameters, this keeps us well below SQLite's default limit of 999 parameters
+    _BLOCK_ID_RANGES_PER_QUERY = 400
+    # Each block UID takes two bound parameters, too
+    _BLOCK_UIDS_PER_QUERY = 400
 
     _locking = None
 
@@ -512,6 +605,7 @@ class DatabaseBackend(ReprMixIn):
         if not in_memory:
             url = config.get('databaseEngine', types=str)
             connect_args = {}
+            engine_args = {}
             if url.startswith('sqlite:'):
                 # This tries to work around a SQLite design limitation. It's best to use PostgreSQL if you're affected
                 # by this as it doesn't have this limitation.
@@ -519,7 +613,11 @@ class DatabaseBackend(ReprMixIn):
                 # Increase the timeout (5 seconds is the default). This will make "database is locked" errors
                 # due to concurrent database access less likely.
                 connect_args['timeout'] = 3 * self._BLOCKS_COMMIT_INTERVAL
-            self._engine = sqlalchemy.create_engine(url, connect_args=connect_args)
+            elif sqlalchemy.engine.url.make_url(url).get_driver_name() == 'psycopg2':
+                # Send the statements of an executemany() call in pages instead of one by one. This greatly reduces
+                # the number of round trips when flushing buffered block updates.
+                engine_args['executemany_mode'] = 'batch'
+            self._engine = sqlalchemy.create_engine(url, connect_args=connect_args, **engine_args)
         else:
             logger.info('Running with ephemeral in-memory database.')
             self._engine = sqlalchemy.create_engine('sqlite://')
@@ -587,6 +685,13 @@ class DatabaseBackend(ReprMixIn):
         self._session = Session()
         self._locking = DatabaseBackendLocking(self._session)
         self._last_blocks_commit = time.monotonic()
+
+        # Block updates are buffered and written in bulk. Make sure that they are part of any commit and that they
+        # are discarded together with the rest of the transaction on a rollback.
+        self._block_updates: Dict[Tuple[VersionUid, int], Dict[str, Any]] = {}
+        self._block_updates_checksums: Set[str] = set()
+        sqlalchemy.event.listen(self._session, 'before_commit', lambda session: self._flush_block_updates())
+        sqlalchemy.event.listen(self._session, 'after_rollback', lambda session: self._discard_block_updates())
         return self
 
     def init(self, _destroy: bool = False) -> None:
@@ -614,6 +719,9 @@ class DatabaseBackend(ReprMixIn):
     def commit(self) -> None:
         self._session.commit()
 
+    def rollback(self) -> None:
+        self._session.rollback()
+
     def create_version(self,
                        version_name: str,
                        snapshot_name: str,
@@ -728,27 +836,64 @@ class DatabaseBackend(ReprMixIn):
             raise
 
     def _conditional_blocks_commit(self):
-        caller = inspect.stack()[1].function
         current_clock = time.monotonic()
         if current_clock - self._last_blocks_commit > self._BLOCKS_COMMIT_INTERVAL:
+            caller = inspect.stack()[1].function
             t1 = time.time()
             self._session.commit()
             t2 = time.time()
             logger.debug('Commited database transaction in {} in {:.2f}s'.format(caller, t2 - t1))
             self._last_blocks_commit = current_clock
 
+    def _flush_block_updates(self) -> None:
+        if not self._block_updates:
+            return
+
+        t1 = time.time()
+        block_updates = list(self._block_updates.values())
+        table = Block.__table__
+        statement = table.update().where(
+            sqlalchemy.and_(table.c.version_uid == sqlalchemy.bindparam('_version_uid'),
+                            table.c.id == sqlalchemy.bindparam('_id')))
+        result = self._session.execute(statement, block_updates)
+        if result.supports_sane_multi_rowcount() and result.rowcount != len(block_updates):
+            raise InternalError('Some blocks did not exist when they should (updated {} of {} blocks).'.format(
+                result.rowcount, len(block_updates)))
+
+        # Expire any affected blocks currently loaded into the session so that they don't show stale data
+        identity_map = self._session.identity_map
+        for key in self._block_updates.keys():
+            block = identity_map.get(sqlalchemy.orm.util.identity_key(Block, key))
+            if block is not None:
+                self._session.expire(block)
+
+        self._discard_block_updates()
+        t2 = time.time()
+        logger.debug('Flushed {} block updates in {:.2f}s.'.format(len(block_updates), t2 - t1))
+
+    def _discard_block_updates(self) -> None:
+        self._block_updates = {}
+        self._block_updates_checksums = set()
+
     def set_block(self, *, id: int, version_uid: VersionUid, block_uid: Optional[BlockUid], checksum: Optional[str],
                   size: int, valid: bool) -> None:
-        try:
-            block = self._session.query(Block).filter_by(id=id, version_uid=version_uid).first()
-            if not block:
-                raise InternalError('Block {} of version {} does not exist when it should.'.format(
-                    id, version_uid.v_string))
+        # The update is only buffered here, it will be written to the database together with other updates
+        # when the buffer is full, before any query which needs to see it and at the latest on commit.
+        self._block_updates[(version_uid, id)] = {
+            '_version_uid': version_uid,
+            '_id': id,
+            'uid_left': block_uid.left if block_uid is not None else None,
+            'uid_right': block_uid.right if block_uid is not None else None,
+            'checksum': checksum,
+            'size': size,
+            'valid': valid,
+        }
+        if checksum is not None:
+            self._block_updates_checksums.add(checksum)
 
-            block.uid = block_uid
-            block.checksum = checksum
-            block.size = size
-            block.valid = valid
+        try:
+            if len(self._block_updates) >= self._BLOCK_UPDATES_FLUSH_SIZE:
+                self._flush_block_updates()
 
             self._conditional_blocks_commit()
         except:
@@ -764,8 +909,56 @@ class DatabaseBackend(ReprMixIn):
             self._session.rollback()
             raise
 
+    def clone_blocks(self, *, base_version_uid: VersionUid, version_uid: VersionUid, size: int,
+                     block_size: int) -> int:
+        """ Copies the blocks of the base version to a new version of the given size with a single INSERT ... SELECT
+        statement. Blocks beyond the end of the new version are skipped. Blocks whose size doesn't match the size
+        they should have in the new version (i.e. the last block of the old or the new version if the size
+        changed) are reset: Their size is adjusted, they lose their data and are marked invalid so that they are
+        read again. Returns the number of copied blocks.
+        """
+        num_blocks = (size + block_size - 1) // block_size
+        if num_blocks == 0:
+            return 0
+        last_block_id = num_blocks - 1
+        last_block_size = size - last_block_id * block_size
+
+        self._flush_block_updates()
+        table = Block.__table__
+        expected_size = sqlalchemy.case([(table.c.id == last_block_id, last_block_size)], else_=block_size)
+        size_changed = table.c.size != expected_size
+
+        def unless_size_changed(column, replacement):
+            return sqlalchemy.case([(size_changed, replacement)], else_=column)
+
+        select = sqlalchemy.select([
+            table.c.id,
+            sqlalchemy.literal(version_uid, type_=table.c.version_uid.type),
+            unless_size_changed(table.c.uid_left, sqlalchemy.null()),
+            unless_size_changed(table.c.uid_right, sqlalchemy.null()),
+            unless_size_changed(table.c.checksum, sqlalchemy.null()),
+            expected_size,
+            unless_size_changed(table.c.valid, sqlalchemy.false()),
+        ]).where(sqlalchemy.and_(table.c.version_uid == base_version_uid, table.c.id < num_blocks))
+        insert = table.insert().from_select(['id', 'version_uid', 'uid_left', 'uid_right', 'checksum', 'size', 'valid'],
+                                            select)
+
+        try:
+            t1 = time.time()
+            result = self._session.execute(insert)
+            t2 = time.time()
+        except:
+            self._session.rollback()
+            raise
+
+        logger.debug('Cloned {} blocks from version {} to {} in {:.2f}s.'.format(result.rowcount,
+                                                                                 base_version_uid.v_string,
+                                                                                 version_uid.v_string, t2 - t1))
+        return result.rowcount
+
     def set_block_invalid(self, block_uid: BlockUid) -> List[VersionUid]:
         try:
+            self._flush_block_updates()
             affected_version_uids = self._session.query(sqlalchemy.distinct(
                 Block.version_uid)).filter_by(uid=block_uid).all()
             affected_version_uids = [version_uid[0] for version_uid in affected_version_uids]
@@ -785,20 +978,36 @@ class DatabaseBackend(ReprMixIn):
         return affected_version_uids
 
     def get_block(self, block_uid: BlockUid) -> Block:
+        self._flush_block_updates()
         return self._session.query(Block).filter_by(uid=block_uid).first()
 
     def get_block_by_id(self, version_uid: VersionUid, block_id: int) -> Block:
+        self._flush_block_updates()
         return self._session.query(Block).filter_by(version_uid=version_uid, id=block_id).first()
 
     def get_block_by_checksum(self, checksum, storage_id):
+        if checksum in self._block_updates_checksums:
+            self._flush_block_updates()
         return self._session.query(Block).filter_by(checksum=checksum,
                                                     valid=True).join(Version).filter_by(storage_id=storage_id).first()
 
+    def get_checksums_by_storage(self, storage_id: int, yield_per: int = 10000) -> Iterator[str]:
+        # Ordering by checksum allows the index on the checksum column to be used and returns the checksums sorted
+        # byte-wise which is what the deduplication index expects.
+        self._flush_block_updates()
+        query = self._session.query(sqlalchemy.distinct(Block.checksum))\
+            .join(Version, Block.version_uid == Version.uid)\
+            .filter(Version.storage_id == storage_id, Block.valid == True, Block.checksum != None)\
+            .order_by(Block.checksum)
+        for checksum, in query.yield_per(yield_per):
+            yield checksum
+
     # Our own version of yield_per without using a cursor
     # See: https://github.com/sqlalchemy/sqlalchemy/wiki/WindowedRangeQuery
     def _yield_blocks(self, version_uid: VersionUid, yield_per: int):
         last_id = None
         while True:
+            self._flush_block_updates()
             query = self._session.query(Block).filter_by(version_uid=version_uid)
             if last_id is not None:
                 query = query.filter(Block.id > last_id)
@@ -812,7 +1021,69 @@ class DatabaseBackend(ReprMixIn):
     def get_blocks_by_version(self, version_uid: VersionUid, yield_per: int = 10000) -> Iterator[Block]:
         yield from self._yield_blocks(version_uid, yield_per)
 
+    def get_blocks_by_id_runs(self,
+                              version_uid: VersionUid,
+                              id_runs: Iterable[Tuple[int, int]],
+                              yield_per: int = 10000) -> Iterator[Block]:
+        """ Yields the blocks of a version covered by the given runs of consecutive ids ordered by id. Each run is
+        a tuple of its first id and its length. The runs must be sorted in ascending order and must not overlap. Each
+        query only needs to match a few ranges of the primary key and returns at most yield_per blocks.
+        """
+
+        def query_blocks(id_ranges: List[Tuple[int, int]]) -> Iterator[Block]:
+            self._flush_block_updates()
+            query = self._session.query(Block).filter(
+                Block.version_uid == version_uid,
+                sqlalchemy.or_(*[Block.id.between(first_id, last_id) for first_id, last_id in id_ranges]))
+            yield from query.order_by(Block.id)
+
+        # Ranges are inclusive
+        id_ranges: List[Tuple[int, int]] = []
+        blocks_count = 0
+        for run_start, run_length in id_runs:
+            # Long runs are split up so that each query stays below yield_per blocks
+            while run_length > 0:
+                length = min(run_length, yield_per - blocks_count)
+                id_ranges.append((run_start, run_start + length - 1))
+                blocks_count += length
+                run_start += length
+                run_length -= length
+
+                if blocks_count == yield_per or len(id_ranges) == self._BLOCK_ID_RANGES_PER_QUERY:
+                    yield from query_blocks(id_ranges)
+                    id_ranges = []
+                    blocks_count = 0
+
+        if id_ranges:
+            yield from query_blocks(id_ranges)
+
+    def get_blocks_by_ids(self, version_uid: VersionUid, block_ids: Iterable[int],
+                          yield_per: int = 10000) -> Iterator[Block]:
+        """ Yields the blocks of a version with the given ids ordered by id. The ids must be sorted in ascending order.
+        Consecutive ids are combined into runs, see get_blocks_by_id_runs.
+        """
+
+        def id_runs() -> Iterator[Tuple[int, int]]:
+            run_start, run_length = 0, 0
+            for block_id in block_ids:
+                if run_length > 0 and block_id == run_start + run_length:
+                    run_length += 1
+                else:
+                    if run_length > 0:
+                        yield run_start, run_length
+                    run_start, run_length = block_id, 1
+            if run_length > 0:
+                yield run_start, run_length
+
+        return self.get_blocks_by_id_runs(version_uid, id_runs(), yield_per=yield_per)
+
+    def get_invalid_block_ids_by_version(self, version_uid: VersionUid) -> List[int]:
+        self._flush_block_updates()
+        query = self._session.query(Block.id).filter_by(version_uid=version_uid, valid=False).order_by(Block.id)
+        return [row[0] for row in query]
+
     def get_blocks_count_by_version(self, version_uid: VersionUid, sparse_only: bool = False) -> int:
+        self._flush_block_updates()
         query = self._session.query(Block).filter_by(version_uid=version_uid)
         if sparse_only:
             query = query.filter_by(uid_left=None, uid_right=None)
@@ -820,6 +1091,7 @@ class DatabaseBackend(ReprMixIn):
 
     def rm_version(self, version_uid: VersionUid) -> int:
         try:
+            self._flush_block_updates()
             version = self._session.query(Version).filter_by(uid=version_uid).first()
             affected_blocks = self._session.query(Block).filter_by(version_uid=version.uid)
             num_blocks = affected_blocks.count()
@@ -841,16 +1113,106 @@ class DatabaseBackend(ReprMixIn):
 
         return num_blocks
 
+    def has_packs(self, storage_id: int) -> bool:
+        return self._session.query(Pack.uid).filter_by(storage_id=storage_id).first() is not None
+
+    def is_pack_known(self, storage_id: int, pack_uid: PackUid) -> bool:
+        return self._session.query(Pack.uid).filter_by(storage_id=storage_id, uid=pack_uid.value).first() is not None
+
+    def add_pack(self, *, storage_id: int, pack_uid: PackUid, size: int,
+                 entries: Sequence[Tuple[BlockUid, int, int]]) -> None:
+        """ Records a pack and the location of the blocks it contains. Each entry is a tuple of block UID, offset and
+        length. Blocks which are already recorded as being part of another pack are moved to this one.
+        """
+        self._session.bulk_insert_mappings(Pack, [{
+            'storage_id': storage_id,
+            'uid': pack_uid.value,
+            'size': size,
+            'date': datetime.datetime.utcnow(),
+        }])
+        entries_list = list(entries)
+        for i in range(0, len(entries_list), self._BLOCK_UIDS_PER_QUERY):
+            uids = [uid for uid, _, _ in entries_list[i:i + self._BLOCK_UIDS_PER_QUERY]]
+            self._session.query(PackedBlock)\
+                .filter(PackedBlock.storage_id == storage_id)\
+                .filter(PackedBlock.uid.in_(uids))\
+                .delete(synchronize_session=False)
+        self._session.bulk_insert_mappings(PackedBlock, [{
+            'storage_id': storage_id,
+            'uid_left': uid.left,
+            'uid_right': uid.right,
+            'pack_uid': pack_uid.value,
+            'offset': offset,
+            'length': length,
+        } for uid, offset, length in entries_list])
+
+    def get_pack_location(self, storage_id: int, block_uid: BlockUid) -> Optional[PackLocation]:
+        row = self._session.query(PackedBlock.pack_uid, PackedBlock.offset, PackedBlock.length)\
+            .filter_by(storage_id=storage_id, uid_left=block_uid.left, uid_right=block_uid.right)\
+            .first()
+        return PackLocation(PackUid(row[0]), row[1], row[2]) if row is not None else None
+
+    def get_packed_blocks(self, storage_id: int, pack_uid: PackUid) -> List[Tuple[BlockUid, int, int]]:
+        rows = self._session.query(PackedBlock.uid_left, PackedBlock.uid_right, PackedBlock.offset, PackedBlock.length)\
+            .filter_by(storage_id=storage_id, pack_uid=pack_uid.value)\
+            .order_by(PackedBlock.offset)\
+            .all()
+        return [(BlockUid(row[0], row[1]), row[2], row[3]) for row in rows]
+
+    def rm_packed_blocks(self, storage_id: int, block_uids: Iterable[BlockUid]) -> Set[BlockUid]:
+        """ Removes blocks from their packs and returns the UIDs of the blocks which were found in a pack. The space
+        they took up is reclaimed when their pack is compacted.
+        """
+        block_uids_list = list(block_uids)
+        removed_uids: Set[BlockUid] = set()
+        for i in range(0, len(block_uids_list), self._BLOCK_UIDS_PER_QUERY):
+            query = self._session.query(PackedBlock.uid_left, PackedBlock.uid_right)\
+                .filter(PackedBlock.storage_id == storage_id)\
+                .filter(PackedBlock.uid.in_(block_uids_list[i:i + self._BLOCK_UIDS_PER_QUERY]))
+            rows = query.all()
+            if rows:
+                removed_uids.update([BlockUid(row[0], row[1]) for row in rows])
+                query.delete(synchronize_session=False)
+        return removed_uids
+
+    def get_pack_compaction_candidates(self, storage_id: int, threshold: int) -> List[Tuple[PackUid, int, int]]:
+        """ Returns the UID, size and live size of the packs of which less than threshold percent are still in
+        use.
+        """
+        live_size = sqlalchemy.func.coalesce(sqlalchemy.func.sum(PackedBlock.length), 0)
+        rows = self._session.query(Pack.uid, Pack.size, live_size)\
+            .outerjoin(PackedBlock, (PackedBlock.storage_id == Pack.storage_id) & (PackedBlock.pack_uid == Pack.uid))\
+            .filter(Pack.storage_id == storage_id)\
+            .group_by(Pack.uid, Pack.size)\
+            .having(live_size * 100 < Pack.size * threshold)\
+            .order_by(Pack.date)\
+            .all()
+        return [(PackUid(row[0]), row[1], row[2]) for row in rows]
+
+    def rm_pack(self, storage_id: int, pack_uid: PackUid) -> None:
+        self._session.query(PackedBlock)\
+            .filter_by(storage_id=storage_id, pack_uid=pack_uid.value)\
+            .delete(synchronize_session=False)
+        self._session.query(Pack).filter_by(storage_id=storage_id, uid=pack_uid.value).delete(synchronize_session=False)
+
+    def _rm_delete_candidates(self, uids: Set[BlockUid]) -> None:
+        uids_list = list(uids)
+        for i in range(0, len(uids_list), self._BLOCK_UIDS_PER_QUERY):
+            self._session.query(DeletedBlock)\
+                .filter(DeletedBlock.uid.in_(uids_list[i:i + self._BLOCK_UIDS_PER_QUERY]))\
+                .delete(synchronize_session=False)
+
     def get_delete_candidates(self, dt: int = 3600) -> Iterator[Dict[int, Set[BlockUid]]]:
         rounds = 0
         false_positives_count = 0
         hit_list_count = 0
         cut_off_date = datetime.datetime.utcnow() - datetime.timedelta(seconds=dt)
+        self._flush_block_updates()
         while True:
             # http://stackoverflow.com/questions/7389759/memory-efficient-built-in-sqlalchemy-iterator-generator
             delete_candidates = self._session.query(DeletedBlock)\
                 .filter(DeletedBlock.date < cut_off_date)\
-                .limit(250)\
+                .limit(500)\
                 .all()
             if not delete_candidates:
                 break
@@ -880,13 +1242,11 @@ class DatabaseBackend(ReprMixIn):
 
             if false_positives:
                 logger.debug("Cleanup: Removing {} false positive from delete candidates.".format(len(false_positives)))
-                self._session.query(DeletedBlock)\
-                    .filter(DeletedBlock.uid.in_(false_positives))\
-                    .delete(synchronize_session=False)
+                self._rm_delete_candidates(false_positives)
 
             if hit_list:
                 for uids in hit_list.values():
-                    self._session.query(DeletedBlock).filter(DeletedBlock.uid.in_(uids)).delete(synchronize_session=False)
+                    self._rm_delete_candidates(uids)
                 yield hit_list
                 # We expect that the caller has handled all the blocks returned so far, so we can call commit after
                 # the yield to keep the transaction small.
@@ -974,6 +1334,7 @@ class DatabaseBackend(ReprMixIn):
         )
 
     def export(self, version_uids: Sequence[VersionUid], f: TextIO):
+        self._flush_block_updates()
         self.export_any({'versions': [self.get_version(version_uid) for version_uid in version_uids]}, f)
 
     def import_(self, f: TextIO) -> List[VersionUid]:
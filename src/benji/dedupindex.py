@@ -0,0 +1,112 @@
+from array import array
+from bisect import bisect_left
+from typing import Optional, Set
+
+from benji.database import DatabaseBackend, Block
+from benji.logging import logger
+from benji.repr import ReprMixIn
+
+
+class DedupIndex(ReprMixIn):
+    """ In-memory index of the block checksums present in one storage.
+
+    The index only holds a 64 bit prefix of each checksum. It is used to filter out lookups which can't possibly
+    succeed before querying the database. A match in the index is always confirmed by a database query, so the index
+    can never lead to a wrong deduplication decision, even when it is stale.
+
+    Loading the index reads the checksums of all blocks in the storage. This only pays off when there are many lookups,
+    so the first lookups go directly to the database and the index is only loaded when their number exceeds
+    _DIRECT_LOOKUPS. This keeps small differential backups cheap.
+    """
+
+    # Number of hex digits of the checksum used as key (16 hex digits = 64 bits)
+    _PREFIX_DIGITS = 16
+    # Number of lookups answered by the database before the index is loaded
+    _DIRECT_LOOKUPS = 4096
+
+    def __init__(self, *, database_backend: DatabaseBackend, storage_id: int) -> None:
+        self._database_backend = database_backend
+        self._storage_id = storage_id
+        # Sorted array of unsigned 64 bit integers, this takes about eight bytes per distinct checksum
+        self._prefixes = array('Q')
+        # Checksums added after the bulk load
+        self._added_prefixes: Set[int] = set()
+        self._loaded = False
+        self._lookups = 0
+        self._hits = 0
+        self._false_positives = 0
+
+    @property
+    def storage_id(self) -> int:
+        return self._storage_id
+
+    def __len__(self) -> int:
+        return len(self._prefixes) + len(self._added_prefixes)
+
+    @classmethod
+    def _prefix(cls, checksum: str) -> int:
+        return int(checksum[:cls._PREFIX_DIGITS], 16)
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load(self) -> None:
+        prefixes = array('Q')
+        last_prefix = -1
+        is_sorted = True
+        for checksum in self._database_backend.get_checksums_by_storage(self._storage_id):
+            prefix = self._prefix(checksum)
+            # Distinct checksums can still share a prefix
+            if prefix == last_prefix:
+                continue
+            if prefix < last_prefix:
+                is_sorted = False
+            prefixes.append(prefix)
+            last_prefix = prefix
+
+        # The database should return the checksums in order, but don't depend on it
+        if not is_sorted:
+            prefixes = array('Q', sorted(set(prefixes)))
+
+        self._prefixes = prefixes
+        # Checksums added before the load are already part of the database and so of the loaded prefixes
+        self._added_prefixes = set()
+        self._loaded = True
+        logger.debug('Loaded deduplication index for storage {} with {} entries ({} bytes).'.format(
+            self._storage_id, len(prefixes),
+            len(prefixes) * prefixes.itemsize))
+
+    def add(self, checksum: str) -> None:
+        self._added_prefixes.add(self._prefix(checksum))
+
+    def probably_contains(self, checksum: str) -> bool:
+        prefix = self._prefix(checksum)
+        if prefix in self._added_prefixes:
+            return True
+        position = bisect_left(self._prefixes, prefix)
+        return position < len(self._prefixes) and self._prefixes[position] == prefix
+
+    def get(self, checksum: str) -> Optional[Block]:
+        self._lookups += 1
+        if not self._loaded:
+            if self._lookups <= self._DIRECT_LOOKUPS:
+                block = self._database_backend.get_block_by_checksum(checksum, self._storage_id)
+                if block is not None:
+                    self._hits += 1
+                return block
+            self.load()
+
+        if not self.probably_contains(checksum):
+            return None
+
+        block = self._database_backend.get_block_by_checksum(checksum, self._storage_id)
+        if block is not None:
+            self._hits += 1
+        else:
+            self._false_positives += 1
+        return block
+
+    def log_stats(self) -> None:
+        logger.debug('Deduplication index for storage {}: {} lookups, {} hits, {} false positives.'.format(
+            self._storage_id, self._lookups, self._hits, self._false_positives))
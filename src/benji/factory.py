@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 import importlib
-from typing import Dict, NamedTuple, Any, List
+from typing import Dict, NamedTuple, Any, List, Optional
 from urllib import parse
 
 from benji.config import Config, ConfigList
 from benji.exception import ConfigurationError, InternalError, UsageError
-from benji.io.base import IOBase
+from benji.io.base import IOBase, IOThrottling
+from benji.packindex import PackIndex
 from benji.repr import ReprMixIn
 
 
@@ -23,6 +24,7 @@ class StorageFactory(ReprMixIn):
     _name_to_storage_id: Dict[str, int] = {}
     _storage_id_to_name: Dict[int, str] = {}
     _instances: Dict[int, Any] = {}
+    _database_backend: Optional[Any] = None
 
     def __init__(self) -> None:
         raise InternalError('StorageFactory constructor called.')
@@ -74,10 +76,12 @@ class StorageFactory(ReprMixIn):
             cls._storage_id_to_name[storage_id] = name
 
     @classmethod
-    def initialize(cls, config: Config) -> None:
+    def initialize(cls, config: Config, database_backend: Any = None) -> None:
         TransformFactory.initialize(config)
         storages: ConfigList = config.get('storages', types=list)
         cls._import_modules(config, storages)
+        # Without a database backend the storages can't locate blocks inside of packs and never write any
+        cls._database_backend = database_backend
 
     @classmethod
     def close(cls) -> None:
@@ -88,6 +92,7 @@ class StorageFactory(ReprMixIn):
         cls._name_to_storage_id = {}
         cls._storage_id_to_name = {}
         cls._instances = {}
+        cls._database_backend = None
 
         TransformFactory.close()
 
@@ -99,7 +104,10 @@ class StorageFactory(ReprMixIn):
 
             module = cls._modules[storage_id].module
             module_arguments = cls._modules[storage_id].arguments
-            cls._instances[storage_id] = module.Storage(**module_arguments)
+            storage = module.Storage(**module_arguments)
+            if cls._database_backend is not None:
+                storage.set_pack_index(PackIndex(database_backend=cls._database_backend, storage_id=storage_id))
+            cls._instances[storage_id] = storage
 
         return cls._instances[storage_id]
 
@@ -251,6 +259,32 @@ class IOFactory(ReprMixIn):
     def close(cls) -> None:
         cls._modules = {}
 
+    @classmethod
+    def update_throttling(cls, config: Config) -> None:
+        """ Applies the bandwidth and IOPS limits found in config to all I/O instances of this process, including
+        those which are currently in use.
+        """
+        ios: ConfigList = config.get('ios', None, types=list)
+        for index, module_dict in enumerate(ios):
+            module = Config.get_from_dict(module_dict,
+                                          'module',
+                                          types=str,
+                                          full_name_override=ios.full_name,
+                                          index=index)
+            name = Config.get_from_dict(module_dict, 'name', types=str, full_name_override=ios.full_name, index=index)
+            configuration = Config.get_from_dict(module_dict,
+                                                 'configuration',
+                                                 None,
+                                                 types=dict,
+                                                 full_name_override=ios.full_name,
+                                                 index=index)
+            try:
+                configuration = config.validate(module='{}.{}.{}'.format(__package__, cls._MODULE, module),
+                                                config=configuration)
+            except ConfigurationError as exception:
+                raise ConfigurationError('Configuration for IO {} is invalid.'.format(name)) from exception
+            IOThrottling.get(name, configuration)
+
     @classmethod
     def get(cls, url: str, block_size: int) -> IOBase:
         parsed_url = parse.urlparse(url)
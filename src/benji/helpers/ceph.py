@@ -1,7 +1,9 @@
+import json
 import logging
+import os
 from datetime import datetime
-from tempfile import NamedTemporaryFile
-from typing import Dict, Any
+from tempfile import TemporaryDirectory
+from typing import Dict, Any, List, Optional, Sequence, Tuple
 
 from blinker import signal
 
@@ -48,28 +50,62 @@ def snapshot_create(*, version_name: str, pool: str, image: str, snapshot: str,
                                                  context=context)
 
 
-def backup_initial(*, version_name: str, pool: str, image: str, version_labels: Dict[str, str],
-                   context: Any = None) -> Dict[str, str]:
-    logger.info(f'Performing initial backup of {version_name}:{pool}/{image}')
+def _newest_snapshot(*, pool: str, image: str) -> Optional[str]:
+    rbd_snap_ls = subprocess_run(['rbd', 'snap', 'ls', '--format=json', f'{pool}/{image}'], decode_json=True)
+    assert isinstance(rbd_snap_ls, list)
+    # Snapshot are sorted by their ID, so newer snapshots come last
+    benjis_snapshots = [
+        snapshot['name'] for snapshot in rbd_snap_ls if snapshot['name'].startswith(RBD_SNAP_NAME_PREFIX)
+    ]
+    if len(benjis_snapshots) == 0:
+        return None
+
+    # Delete all snapshots except the newest
+    for snapshot in benjis_snapshots[:-1]:
+        logger.info(f'Deleting older RBD snapshot {pool}/{image}@{snapshot}.')
+        subprocess_run(['rbd', 'snap', 'rm', f'{pool}/{image}@{snapshot}'])
 
+    last_snapshot = benjis_snapshots[-1]
+    logger.info(f'Newest RBD snapshot is {pool}/{image}@{last_snapshot}.')
+    return last_snapshot
+
+
+def _snapshot(*, version_name: str, pool: str, image: str, context: Any = None) -> str:
     now = datetime.utcnow()
     snapshot = now.strftime(RBD_SNAP_NAME_PREFIX + '%Y-%m-%dT%H:%M:%SZ')
-
     snapshot_create(version_name=version_name, pool=pool, image=image, snapshot=snapshot, context=context)
-    stdout = subprocess_run(['rbd', 'diff', '--whole-object', '--format=json', f'{pool}/{image}@{snapshot}'])
-
-    with NamedTemporaryFile(mode='w+', encoding='utf-8') as rbd_hints:
-        rbd_hints.write(stdout)
-        rbd_hints.flush()
-        benji_args = [
-            'benji', '--machine-output', '--log-level', benji_log_level, 'backup', '--snapshot-name', snapshot,
-            '--rbd-hints', rbd_hints.name
-        ]
-        for label_name, label_value in version_labels.items():
-            benji_args.extend(['--label', f'{label_name}={label_value}'])
-        benji_args.extend([f'{pool}:{pool}/{image}@{snapshot}', version_name])
-        result = subprocess_run(benji_args, decode_json=True)
-        assert isinstance(result, dict)
+    return snapshot
+
+
+def _benji_backup_args(*, version_name: str, pool: str, image: str, snapshot: str, version_labels: Dict[str, str],
+                       base_version_uid: Optional[int]) -> List[str]:
+    # The hints are generated by Benji's RBD I/O module directly. The snapshot names of the versions match the RBD
+    # snapshot names, so this is enabled here regardless of the generateHints option.
+    benji_args = [
+        'benji', '--machine-output', '--log-level', benji_log_level, 'backup', '--snapshot-name', snapshot,
+        '--generate-hints'
+    ]
+    if base_version_uid is not None:
+        benji_args.extend(['--base-version', str(base_version_uid)])
+    for label_name, label_value in version_labels.items():
+        benji_args.extend(['--label', f'{label_name}={label_value}'])
+    benji_args.extend([f'{pool}:{pool}/{image}@{snapshot}', version_name])
+    return benji_args
+
+
+def backup_initial(*, version_name: str, pool: str, image: str, version_labels: Dict[str, str],
+                   context: Any = None) -> Dict[str, str]:
+    logger.info(f'Performing initial backup of {version_name}:{pool}/{image}')
+
+    snapshot = _snapshot(version_name=version_name, pool=pool, image=image, context=context)
+    result = subprocess_run(_benji_backup_args(version_name=version_name,
+                                               pool=pool,
+                                               image=image,
+                                               snapshot=snapshot,
+                                               version_labels=version_labels,
+                                               base_version_uid=None),
+                            decode_json=True)
+    assert isinstance(result, dict)
 
     return result
 
@@ -82,30 +118,22 @@ def backup_differential(*,
                         last_version_uid: int,
                         version_labels: Dict[str, str],
                         context: Any = None) -> Dict[str, str]:
-    logger.info(f'Performing differential backup of {version_name}:{pool}/{image} from RBD snapshot" \
-        "{last_snapshot} and Benji version V{last_version_uid:09d}.')
-
-    now = datetime.utcnow()
-    snapshot = now.strftime(RBD_SNAP_NAME_PREFIX + '%Y-%m-%dT%H:%M:%SZ')
+    logger.info(f'Performing differential backup of {version_name}:{pool}/{image} from RBD snapshot ' +
+                f'{last_snapshot} and Benji version V{last_version_uid:09d}.')
 
-    snapshot_create(version_name=version_name, pool=pool, image=image, snapshot=snapshot, context=context)
-    stdout = subprocess_run(
-        ['rbd', 'diff', '--whole-object', '--format=json', '--from-snap', last_snapshot, f'{pool}/{image}@{snapshot}'])
-    subprocess_run(['rbd', 'snap', 'rm', f'{pool}/{image}@{last_snapshot}'])
-
-    with NamedTemporaryFile(mode='w+', encoding='utf-8') as rbd_hints:
-        rbd_hints.write(stdout)
-        rbd_hints.flush()
-        benji_args = [
-            'benji', '--machine-output', '--log-level', benji_log_level, 'backup', '--snapshot-name', snapshot,
-            '--rbd-hints', rbd_hints.name, '--base-version',
-            str(last_version_uid)
-        ]
-        for label_name, label_value in version_labels.items():
-            benji_args.extend(['--label', f'{label_name}={label_value}'])
-        benji_args.extend([f'{pool}:{pool}/{image}@{snapshot}', version_name])
-        result = subprocess_run(benji_args, decode_json=True)
+    snapshot = _snapshot(version_name=version_name, pool=pool, image=image, context=context)
+    try:
+        # The last snapshot is needed to generate the hints, so it is only removed after the backup
+        result = subprocess_run(_benji_backup_args(version_name=version_name,
+                                                   pool=pool,
+                                                   image=image,
+                                                   snapshot=snapshot,
+                                                   version_labels=version_labels,
+                                                   base_version_uid=last_version_uid),
+                                decode_json=True)
         assert isinstance(result, dict)
+    finally:
+        subprocess_run(['rbd', 'snap', 'rm', f'{pool}/{image}@{last_snapshot}'])
 
     return result
 
@@ -119,13 +147,8 @@ def backup(*, version_name: str, pool: str, image: str, version_labels: Dict[str
                            context=context)
     version = None
     try:
-        rbd_snap_ls = subprocess_run(['rbd', 'snap', 'ls', '--format=json', f'{pool}/{image}'], decode_json=True)
-        assert isinstance(rbd_snap_ls, list)
-        # Snapshot are sorted by their ID, so newer snapshots come last
-        benjis_snapshots = [
-            snapshot['name'] for snapshot in rbd_snap_ls if snapshot['name'].startswith(RBD_SNAP_NAME_PREFIX)
-        ]
-        if len(benjis_snapshots) == 0:
+        last_snapshot = _newest_snapshot(pool=pool, image=image)
+        if last_snapshot is None:
             logger.info('No previous RBD snapshot found, performing initial backup.')
             result = backup_initial(version_name=version_name,
                                     pool=pool,
@@ -133,14 +156,6 @@ def backup(*, version_name: str, pool: str, image: str, version_labels: Dict[str
                                     version_labels=version_labels,
                                     context=context)
         else:
-            # Delete all snapshots except the newest
-            for snapshot in benjis_snapshots[:-1]:
-                logger.info(f'Deleting older RBD snapshot {pool}/{image}@{snapshot}.')
-                subprocess_run(['rbd', 'snap', 'rm', f'{pool}/{image}@{snapshot}'])
-
-            last_snapshot = benjis_snapshots[-1]
-            logger.info(f'Newest RBD snapshot is {pool}/{image}@{last_snapshot}.')
-
             benji_ls = subprocess_run([
                 'benji', '--machine-output', '--log-level', benji_log_level, 'ls',
                 f'name == "{version_name}" and snapshot_name == "{last_snapshot}" and status == "valid"'
@@ -185,3 +200,151 @@ def backup(*, version_name: str, pool: str, image: str, version_labels: Dict[str
                                         version_labels=version_labels,
                                         context=context,
                                         version=version)
+
+
+def _backup_batch_post(job: Dict[str, Any], version: Optional[Dict], exception: Optional[Exception]) -> None:
+    if exception is not None:
+        signal_backup_post_error.send(SIGNAL_SENDER,
+                                      version_name=job['version_name'],
+                                      pool=job['pool'],
+                                      image=job['image'],
+                                      version_labels=job['version_labels'],
+                                      context=job['context'],
+                                      version=version,
+                                      exception=exception)
+    else:
+        signal_backup_post_success.send(SIGNAL_SENDER,
+                                        version_name=job['version_name'],
+                                        pool=job['pool'],
+                                        image=job['image'],
+                                        version_labels=job['version_labels'],
+                                        context=job['context'],
+                                        version=version)
+
+
+def backup_batch(jobs: Sequence[Dict[str, Any]]) -> None:
+    """Backs up multiple RBD images with a single Benji process. Each job is a dictionary with the same keys as the
+    keyword arguments of backup(). The signals are sent for each job individually. If a signal handler raises an
+    exception the remaining jobs are still processed and the first exception is re-raised at the end.
+    """
+    handler_exceptions: List[Exception] = []
+
+    def post(job: Dict[str, Any], version: Optional[Dict] = None, exception: Exception = None) -> None:
+        try:
+            _backup_batch_post(job, version, exception)
+        except Exception as handler_exception:
+            handler_exceptions.append(handler_exception)
+
+    jobs = [{'version_labels': {}, 'context': None, **job} for job in jobs]
+
+    last_snapshots: Dict[int, Optional[str]] = {}
+    for i, job in enumerate(jobs):
+        signal_backup_pre.send(SIGNAL_SENDER,
+                               version_name=job['version_name'],
+                               pool=job['pool'],
+                               image=job['image'],
+                               version_labels=job['version_labels'],
+                               context=job['context'])
+        try:
+            last_snapshots[i] = _newest_snapshot(pool=job['pool'], image=job['image'])
+        except Exception as exception:
+            post(job, exception=exception)
+
+    # Look up the base versions of all differential backups at once
+    base_versions: Dict[Tuple[str, str], int] = {}
+    candidates = [(jobs[i]['version_name'], snapshot) for i, snapshot in last_snapshots.items() if snapshot is not None]
+    if candidates:
+        filter_expression = ' or '.join(
+            [f'(name == "{version_name}" and snapshot_name == "{snapshot}")' for version_name, snapshot in candidates])
+        try:
+            benji_ls = subprocess_run([
+                'benji', '--machine-output', '--log-level', benji_log_level, 'ls',
+                f'status == "valid" and ({filter_expression})'
+            ],
+                                      decode_json=True)
+            assert isinstance(benji_ls, dict)
+            assert 'versions' in benji_ls
+            assert isinstance(benji_ls['versions'], list)
+        except Exception as exception:
+            logger.error(f'Looking up base versions failed, reverting to initial backups: {str(exception)}')
+        else:
+            for version in benji_ls['versions']:
+                base_versions[(version['name'], version['snapshot_name'])] = version['uid']
+
+    benji_jobs: Dict[int, Dict[str, Any]] = {}
+    # Snapshots the differential backups are based on, they are removed once the backups are done
+    base_snapshots: List[str] = []
+    for i, last_snapshot in last_snapshots.items():
+        job = jobs[i]
+        version_name, pool, image = job['version_name'], job['pool'], job['image']
+        try:
+            base_version_uid = None
+            if last_snapshot is None:
+                logger.info(f'No previous RBD snapshot found for {pool}/{image}, performing initial backup.')
+            elif (version_name, last_snapshot) in base_versions:
+                base_version_uid = base_versions[(version_name, last_snapshot)]
+                logger.info(f'Performing differential backup of {version_name}:{pool}/{image} from RBD snapshot ' +
+                            f'{last_snapshot} and Benji version V{base_version_uid:09d}.')
+            else:
+                logger.info(f'Existing RBD snapshot {pool}/{image}@{last_snapshot} not found in Benji, ' +
+                            'deleting it and reverting to initial backup.')
+                subprocess_run(['rbd', 'snap', 'rm', f'{pool}/{image}@{last_snapshot}'])
+                last_snapshot = None
+
+            snapshot = _snapshot(version_name=version_name, pool=pool, image=image, context=job['context'])
+        except Exception as exception:
+            post(job, exception=exception)
+            continue
+
+        if last_snapshot is not None:
+            base_snapshots.append(f'{pool}/{image}@{last_snapshot}')
+        # The hints are generated by Benji's RBD I/O module directly, see _benji_backup_args
+        benji_job = {
+            'source': f'{pool}:{pool}/{image}@{snapshot}',
+            'version_name': version_name,
+            'snapshot_name': snapshot,
+            'generate_hints': True,
+            'labels': [f'{label_name}={label_value}' for label_name, label_value in job['version_labels'].items()],
+        }
+        if base_version_uid is not None:
+            benji_job['base_version_uid'] = base_version_uid
+        benji_jobs[i] = benji_job
+
+    with TemporaryDirectory() as temporary_directory:
+        if benji_jobs:
+            jobs_file = os.path.join(temporary_directory, 'jobs.json')
+            with open(jobs_file, 'w', encoding='utf-8') as f:
+                json.dump(list(benji_jobs.values()), f)
+
+            try:
+                # Failed backups are reported in the output, so don't treat a non-zero return code as fatal
+                result = subprocess_run(
+                    ['benji', '--machine-output', '--log-level', benji_log_level, 'batch-backup', jobs_file],
+                    decode_json=True,
+                    ignore_returncode=True)
+                assert isinstance(result, dict)
+                assert 'versions' in result and isinstance(result['versions'], list)
+                assert 'errors' in result and isinstance(result['errors'], list)
+            except Exception as exception:
+                for i in benji_jobs.keys():
+                    post(jobs[i], exception=exception)
+            else:
+                versions = {(version['name'], version['snapshot_name']): version for version in result['versions']}
+                errors = {(error['version_name'], error['snapshot_name']): error for error in result['errors']}
+                for i, benji_job in benji_jobs.items():
+                    key = (benji_job['version_name'], benji_job['snapshot_name'])
+                    if key in versions:
+                        post(jobs[i], version=versions[key])
+                    elif key in errors:
+                        post(jobs[i], exception=RuntimeError(f'Backup failed: {errors[key]["error"]}'))
+                    else:
+                        post(jobs[i], exception=RuntimeError('Backup result is missing from Benji\'s output.'))
+
+    for base_snapshot in base_snapshots:
+        try:
+            subprocess_run(['rbd', 'snap', 'rm', base_snapshot])
+        except Exception as exception:
+            logger.error(f'Removing RBD snapshot {base_snapshot} failed: {str(exception)}')
+
+    if handler_exceptions:
+        raise handler_exceptions[0]
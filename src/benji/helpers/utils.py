@@ -23,8 +23,11 @@ def _one_line_stderr(stderr: str):
     return stderr
 
 
-def subprocess_run(args: List[str], input: str = None, timeout: int = None,
-                   decode_json: bool = False) -> Union[Dict, List, str]:
+def subprocess_run(args: List[str],
+                   input: str = None,
+                   timeout: int = None,
+                   decode_json: bool = False,
+                   ignore_returncode: bool = False) -> Union[Dict, List, str]:
     logger.debug('Running process: {}'.format(' '.join(args)))
     try:
 
@@ -45,16 +48,21 @@ def subprocess_run(args: List[str], input: str = None, timeout: int = None,
         for line in result.stderr.splitlines():
             logger.info(line)
 
-    if result.returncode == 0:
-        logger.debug('Process finished successfully.')
+    if result.returncode == 0 or ignore_returncode:
+        if result.returncode == 0:
+            outcome = 'was successful'
+            logger.debug('Process finished successfully.')
+        else:
+            outcome = f'failed with return code {result.returncode}'
+            logger.debug(f'Process finished with return code {result.returncode}.')
         if decode_json:
             try:
                 stdout_json = json.loads(result.stdout)
             except JSONDecodeError:
-                raise RuntimeError(f'{args[0]} invocation was successful but did not return valid JSON. Output on stderr was: {_one_line_stderr(result.stderr)}.')
+                raise RuntimeError(f'{args[0]} invocation {outcome} but did not return valid JSON. Output on stderr was: {_one_line_stderr(result.stderr)}.')
 
             if stdout_json is None or not isinstance(stdout_json, (dict, list)):
-                raise RuntimeError(f'{args[0]} invocation was successful but did return null or empty JSON dictonary. Output on stderr was: {_one_line_stderr(result.stderr)}.')
+                raise RuntimeError(f'{args[0]} invocation {outcome} but did return null or empty JSON dictonary. Output on stderr was: {_one_line_stderr(result.stderr)}.')
 
             return stdout_json
         else:
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
+import threading
+import time
 from abc import ABCMeta, abstractmethod
-from typing import Tuple, Union, Optional, List, Iterator
+from typing import Tuple, Union, Optional, List, Iterator, Iterable, Dict
 from urllib import parse
 
 from benji.config import ConfigDict, Config
@@ -9,6 +11,60 @@ from benji.database import Block, DereferencedBlock
 from benji.jobexecutor import JobExecutor
 from benji.logging import logger
 from benji.repr import ReprMixIn
+from benji.utils import TokenBucket
+
+
+class IOThrottling(ReprMixIn):
+    """
+    Bandwidth and IOPS limits of an I/O configuration. All instances of an I/O module created from the same
+    configuration share these, so the limits apply to all their operations together. A limit of zero disables it.
+    The limits can be changed at runtime with set_limits.
+    """
+
+    _LIMITS = ('bandwidthRead', 'bandwidthWrite', 'iopsRead', 'iopsWrite')
+
+    _throttlings: Dict[str, 'IOThrottling'] = {}
+    _throttlings_lock = threading.Lock()
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._configured_limits: Dict[str, int] = {}
+        self._buckets = {limit: TokenBucket() for limit in self._LIMITS}
+
+    @classmethod
+    def get(cls, name: str, module_configuration: ConfigDict) -> 'IOThrottling':
+        """ Returns the throttling of the named I/O configuration. Limits changed at runtime are kept until the
+        configured limits change.
+        """
+        configured_limits = {
+            limit: Config.get_from_dict(module_configuration, limit, 0, types=int) for limit in cls._LIMITS
+        }
+        with cls._throttlings_lock:
+            throttling = cls._throttlings.get(name)
+            if throttling is None:
+                throttling = cls(name)
+                cls._throttlings[name] = throttling
+            if throttling._configured_limits != configured_limits:
+                throttling._configured_limits = configured_limits
+                throttling.set_limits(**configured_limits)
+        return throttling
+
+    def set_limits(self, **limits: int) -> None:
+        for limit, rate in limits.items():
+            if limit not in self._buckets:
+                raise ValueError('Unknown limit {}.'.format(limit))
+            self._buckets[limit].set_rate(rate)
+        logger.debug('Limits of I/O {}: {}.'.format(self.name, ', '.join(
+            ['{} {}'.format(limit, bucket.rate) for limit, bucket in self._buckets.items()])))
+
+    def limits(self) -> Dict[str, int]:
+        return {limit: bucket.rate for limit, bucket in self._buckets.items()}
+
+    def throttle_read(self, length: int) -> None:
+        time.sleep(max(self._buckets['bandwidthRead'].consume(length), self._buckets['iopsRead'].consume(1)))
+
+    def throttle_write(self, length: int) -> None:
+        time.sleep(max(self._buckets['bandwidthWrite'].consume(length), self._buckets['iopsWrite'].consume(1)))
 
 
 class IOBase(ReprMixIn, metaclass=ABCMeta):
@@ -19,6 +75,9 @@ class IOBase(ReprMixIn, metaclass=ABCMeta):
         self._url = url
         self._parsed_url = parse.urlparse(url)
         self._block_size = block_size
+        self._zero_block: Optional[bytes] = None
+        # Each read or write operation issued to the source or target counts as one I/O
+        self._throttling = IOThrottling.get(name, module_configuration)
 
     @property
     def name(self) -> str:
@@ -52,6 +111,17 @@ class IOBase(ReprMixIn, metaclass=ABCMeta):
     def size(self) -> int:
         raise NotImplementedError
 
+    def hints(self,
+              base_snapshot_name: str = None,
+              generate: bool = False) -> Optional[Iterable[Tuple[int, int, bool]]]:
+        """ Returns hints in the same format as hints_from_rbd_diff describing which regions of the source
+        contain data. If the I/O module supports snapshots and base_snapshot_name is given, the hints may
+        be restricted to the regions which changed since that snapshot. If generate is true, hints are generated even
+        if the I/O module's configuration doesn't enable this. Must only be called after open_r. The default
+        implementation returns None which means that no hints are available.
+        """
+        return None
+
     @abstractmethod
     def read(self, block: Union[DereferencedBlock, Block]) -> None:
         raise NotImplementedError
@@ -69,6 +139,18 @@ class IOBase(ReprMixIn, metaclass=ABCMeta):
     def write(self, block: DereferencedBlock, data: bytes) -> None:
         raise NotImplementedError
 
+    def write_zeroes(self, block: DereferencedBlock) -> None:
+        """ Fills the region of the target covered by block with zeros. Completion is reported by write_get_completed
+        like for write. The default implementation writes a buffer of zeros. Modules should override this when the
+        target can zero out or deallocate a region without transferring any data.
+        """
+        if block.size == self.block_size:
+            if self._zero_block is None:
+                self._zero_block = bytes(self.block_size)
+            self.write(block, self._zero_block)
+        else:
+            self.write(block, bytes(block.size))
+
     @abstractmethod
     def write_sync(self, block: DereferencedBlock, data: bytes) -> None:
         raise NotImplementedError
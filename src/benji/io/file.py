@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import mmap
 import os
+import stat
+import struct
 import threading
 import time
-from typing import Tuple, Optional, Union, Iterator
+from collections import deque
+from typing import Tuple, Optional, Union, Iterator, List, Deque
 
 from benji.config import ConfigDict, Config
 from benji.database import DereferencedBlock, Block
@@ -13,8 +21,27 @@ from benji.jobexecutor import JobExecutor
 from benji.logging import logger
 
 
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+# From linux/fs.h
+_BLKZEROOUT = 0x127f
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _fallocate = None
+
+
 class IO(IOBase):
 
+    # Alignment of offsets, lengths and buffers when using direct I/O
+    _DIRECT_IO_ALIGNMENT = 4096
+    # Alignment required by BLKZEROOUT
+    _SECTOR_SIZE = 512
+
     def __init__(self, *, config: Config, name: str, module_configuration: ConfigDict, url: str,
                  block_size: int) -> None:
         super().__init__(
@@ -26,9 +53,43 @@ class IO(IOBase):
 
         self._simultaneous_reads = config.get_from_dict(module_configuration, 'simultaneousReads', types=int)
         self._simultaneous_writes = config.get_from_dict(module_configuration, 'simultaneousWrites', types=int)
+        self._detect_holes = config.get_from_dict(module_configuration, 'detectHoles', types=bool)
+        self._max_read_size = config.get_from_dict(module_configuration, 'maxReadSize', types=int)
+        self._max_write_size = config.get_from_dict(module_configuration, 'maxWriteSize', types=int)
+        self._direct_io = config.get_from_dict(module_configuration, 'directIo', types=bool)
+        if self._direct_io and block_size % self._DIRECT_IO_ALIGNMENT != 0:
+            raise UsageError('Direct I/O requires a block size which is a multiple of {} bytes.'.format(
+                self._DIRECT_IO_ALIGNMENT))
+        if self._direct_io and not hasattr(os, 'preadv'):
+            # os.pread doesn't read into an aligned buffer
+            raise UsageError('Direct I/O requires Python 3.7 or newer.')
+
         self._read_executor: Optional[JobExecutor] = None
         self._write_executor: Optional[JobExecutor] = None
 
+        # Blocks with adjacent ids which have been queued by read but not yet submitted to the read executor
+        self._pending_reads: List[DereferencedBlock] = []
+        self._pending_reads_size = 0
+        self._completed_reads: Deque[Union[Tuple[DereferencedBlock, bytes], BaseException]] = deque()
+
+        # Each reading thread has its own file descriptor and read buffer which are kept open until close is called
+        self._read_local = threading.local()
+        self._read_fds: List[int] = []
+        self._read_fds_lock = threading.Lock()
+
+        # Blocks with adjacent ids which have been queued by write but not yet submitted to the write executor
+        self._pending_writes: List[Tuple[DereferencedBlock, bytes]] = []
+        self._pending_writes_size = 0
+        self._completed_writes: Deque[Union[DereferencedBlock, BaseException]] = deque()
+
+        # All writes go through one file descriptor which is synced once when closing
+        self._write_fd: Optional[int] = None
+        self._write_fd_is_block_device = False
+        self._write_target_created = False
+        # Set to False when the target doesn't support punching holes or zeroing out ranges
+        self._zero_out_supported = True
+        self._zero_block = bytes(block_size)
+
     def open_r(self) -> None:
         self._read_executor = JobExecutor(name='IO-Read', workers=self._simultaneous_reads, blocking_submit=False)
 
@@ -47,12 +108,36 @@ class IO(IOBase):
             with open(self.parsed_url.path, 'wb') as f:
                 f.seek(size - 1)
                 f.write(b'\0')
+            self._write_target_created = True
+
+        self._write_fd = os.open(self.parsed_url.path, os.O_WRONLY)
+        self._write_fd_is_block_device = stat.S_ISBLK(os.fstat(self._write_fd).st_mode)
 
     def close(self) -> None:
+        self._pending_reads = []
+        self._pending_reads_size = 0
+        self._completed_reads.clear()
+        self._pending_writes = []
+        self._pending_writes_size = 0
+        self._completed_writes.clear()
         if self._read_executor:
             self._read_executor.shutdown()
         if self._write_executor:
             self._write_executor.shutdown()
+        if self._write_fd is not None:
+            try:
+                # One sync for the whole restore, afterwards the written data isn't needed in the page cache anymore
+                os.fsync(self._write_fd)
+                os.posix_fadvise(self._write_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(self._write_fd)
+                self._write_fd = None
+        with self._read_fds_lock:
+            for fd in self._read_fds:
+                os.close(fd)
+            self._read_fds = []
+        # Threads calling read_sync still have a reference to the closed file descriptor
+        self._read_local = threading.local()
 
     def size(self) -> int:
         with open(self.parsed_url.path, 'rb') as f:
@@ -60,73 +145,300 @@ class IO(IOBase):
             size = f.tell()
         return size
 
-    def _read(self, block: DereferencedBlock) -> Tuple[DereferencedBlock, bytes]:
-        offset = block.id * self.block_size
-        t1 = time.time()
+    def hints(self, base_snapshot_name: str = None, generate: bool = False) -> Optional[List[Tuple[int, int, bool]]]:
+        # Files don't have snapshots, so base_snapshot_name is ignored and all regions containing data are returned
+        if not (generate or self._detect_holes) or not hasattr(os, 'SEEK_DATA'):
+            return None
+
+        hints: List[Tuple[int, int, bool]] = []
         with open(self.parsed_url.path, 'rb') as f:
-            f.seek(offset)
-            data = f.read(block.size)
-            os.posix_fadvise(f.fileno(), offset, block.size, os.POSIX_FADV_DONTNEED)
+            fd = f.fileno()
+            size = os.lseek(fd, 0, os.SEEK_END)
+            if size == 0:
+                return None
+
+            offset = 0
+            try:
+                while offset < size:
+                    try:
+                        data_offset = min(os.lseek(fd, offset, os.SEEK_DATA), size)
+                    except OSError as exception:
+                        # ENXIO means that there is no more data after offset
+                        if exception.errno != errno.ENXIO:
+                            raise
+                        data_offset = size
+                    if data_offset > offset:
+                        hints.append((offset, data_offset - offset, False))
+                    if data_offset == size:
+                        break
+
+                    hole_offset = min(os.lseek(fd, data_offset, os.SEEK_HOLE), size)
+                    hints.append((data_offset, hole_offset - data_offset, True))
+                    offset = hole_offset
+            except OSError as exception:
+                if exception.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                    logger.debug('Detecting holes is not supported for {}: {}'.format(self.url, exception))
+                    return None
+                raise
+
+        logger.debug('Detected {} bytes of data and {} bytes of holes in {}.'.format(
+            sum([hint[1] for hint in hints if hint[2]]), sum([hint[1] for hint in hints if not hint[2]]), self.url))
+        return hints
+
+    def _read_fd_and_buffer(self) -> Tuple[int, memoryview]:
+        read_local = self._read_local
+        if not hasattr(read_local, 'fd'):
+            flags = os.O_RDONLY
+            if self._direct_io:
+                flags |= os.O_DIRECT
+            fd = os.open(self.parsed_url.path, flags)
+            with self._read_fds_lock:
+                self._read_fds.append(fd)
+            if not self._direct_io:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            read_local.fd = fd
+
+            alignment = self._DIRECT_IO_ALIGNMENT
+            buffer_size = (max(self._max_read_size, self.block_size) + alignment - 1) // alignment * alignment
+            # Anonymous memory maps are page aligned which is required for direct I/O
+            read_local.buffer = memoryview(mmap.mmap(-1, buffer_size))
+        return read_local.fd, read_local.buffer
+
+    def _read_blocks(self, blocks: List[DereferencedBlock]) -> List[Tuple[DereferencedBlock, bytes]]:
+        """ Reads blocks with adjacent ids with one read system call. The data of each block is copied out of the
+        thread's read buffer.
+        """
+        fd, buffer = self._read_fd_and_buffer()
+        offset = blocks[0].id * self.block_size
+        length = sum([block.size for block in blocks])
+        if self._direct_io:
+            # The last block of a file can be short
+            alignment = self._DIRECT_IO_ALIGNMENT
+            read_length = (length + alignment - 1) // alignment * alignment
+        else:
+            read_length = length
+
+        self._throttling.throttle_read(length)
+        t1 = time.time()
+        position = 0
+        while position < length:
+            if hasattr(os, 'preadv'):
+                bytes_read = os.preadv(fd, [buffer[position:read_length]], offset + position)
+            else:
+                # Python 3.6
+                data = os.pread(fd, read_length - position, offset + position)
+                bytes_read = len(data)
+                buffer[position:position + bytes_read] = data
+            if bytes_read == 0:
+                break
+            position += bytes_read
+        if not self._direct_io:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
         t2 = time.time()
 
-        if not data:
-            raise EOFError('End of file reached on {} when there should be data.'.format(self.url))
+        results = []
+        block_offset = 0
+        for block in blocks:
+            if block_offset >= position:
+                raise EOFError('End of file reached on {} when there should be data.'.format(self.url))
+            results.append((block, bytes(buffer[block_offset:min(block_offset + block.size, position)])))
+            block_offset += block.size
 
-        logger.debug('{} read block {} in {:.3f}s'.format(
+        logger.debug('{} read block{} {} in {:.3f}s'.format(
             threading.current_thread().name,
-            block.id,
+            's' if len(blocks) > 1 else '',
+            blocks[0].id if len(blocks) == 1 else '{}-{}'.format(blocks[0].id, blocks[-1].id),
             t2 - t1,
             ))
 
-        return block, data
+        return results
 
-    def read(self, block: Union[DereferencedBlock, Block]) -> None:
-        block_deref = block.deref() if isinstance(block, Block) else block
+    def _read_blocks_job(
+            self, blocks: List[DereferencedBlock]) -> List[Union[Tuple[DereferencedBlock, bytes], BaseException]]:
+        try:
+            return self._read_blocks(blocks)
+        except Exception as exception:
+            if len(blocks) == 1:
+                return [exception]
+
+        # Retry the blocks one by one so that only the blocks which are really affected report an error
+        results: List[Union[Tuple[DereferencedBlock, bytes], BaseException]] = []
+        for block in blocks:
+            try:
+                results.extend(self._read_blocks([block]))
+            except Exception as exception:
+                results.append(exception)
+        return results
 
-        def job():
-            return self._read(block_deref)
+    def _submit_pending_reads(self) -> None:
+        if not self._pending_reads:
+            return
+
+        blocks = self._pending_reads
+        self._pending_reads = []
+        self._pending_reads_size = 0
 
         assert self._read_executor is not None
-        self._read_executor.submit(job)
+        self._read_executor.submit(lambda: self._read_blocks_job(blocks))
+
+    def read(self, block: Union[DereferencedBlock, Block]) -> None:
+        block_deref = block.deref() if isinstance(block, Block) else block
+
+        # Adjacent blocks are merged into one read up to a size of maxReadSize
+        if self._pending_reads and (block_deref.id != self._pending_reads[-1].id + 1
+                                    or self._pending_reads[-1].size != self.block_size
+                                    or self._pending_reads_size + block_deref.size > self._max_read_size):
+            self._submit_pending_reads()
+        self._pending_reads.append(block_deref)
+        self._pending_reads_size += block_deref.size
 
     def read_sync(self, block: Union[DereferencedBlock, Block]) -> bytes:
         block_deref = block.deref() if isinstance(block, Block) else block
-        return self._read(block_deref)[1]
+        return self._read_blocks([block_deref])[0][1]
 
     def read_get_completed(
             self, timeout: Optional[int] = None) -> Iterator[Union[Tuple[DereferencedBlock, bytes], BaseException]]:
+        self._submit_pending_reads()
+        # Merged reads complete several blocks at once, the ones not taken by the caller yet are kept here
+        completed_reads = self._completed_reads
+        while completed_reads:
+            yield completed_reads.popleft()
         assert self._read_executor is not None
-        return self._read_executor.get_completed(timeout=timeout)
+        for results in self._read_executor.get_completed(timeout=timeout):
+            if isinstance(results, BaseException):
+                completed_reads.append(results)
+            else:
+                completed_reads.extend(results)
+            while completed_reads:
+                yield completed_reads.popleft()
+
+    def _is_zero(self, data: bytes) -> bool:
+        # The comparison stops at the first differing byte, so this is cheap for blocks containing data. Blocks
+        # passed in by write_zeroes share the buffer with self._zero_block and are compared by identity.
+        if len(data) == self.block_size:
+            return data == self._zero_block
+        return data == bytes(len(data))
+
+    def _zero_out(self, offset: int, length: int) -> bool:
+        """ Deallocates or zeroes out the given range of the target without transferring any data. Returns False if
+        this isn't supported.
+        """
+        assert self._write_fd is not None
+        if not self._zero_out_supported:
+            return False
 
-    def _write(self, block: DereferencedBlock, data: bytes) -> DereferencedBlock:
-        offset = block.id * self.block_size
+        try:
+            if self._write_fd_is_block_device:
+                if offset % self._SECTOR_SIZE != 0 or length % self._SECTOR_SIZE != 0:
+                    return False
+                fcntl.ioctl(self._write_fd, _BLKZEROOUT, struct.pack('QQ', offset, length))
+            else:
+                if _fallocate is None:
+                    raise OSError(errno.EOPNOTSUPP, 'fallocate is not available')
+                if _fallocate(self._write_fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+                    error = ctypes.get_errno()
+                    raise OSError(error, os.strerror(error))
+        except OSError as exception:
+            if exception.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS):
+                logger.debug('Zeroing out ranges is not supported for {}, writing zeroes instead: {}'.format(
+                    self.url, exception))
+                self._zero_out_supported = False
+                return False
+            raise
+
+        return True
+
+    def _pwritev(self, offset: int, buffers: List[bytes]) -> None:
+        assert self._write_fd is not None
+        views = [memoryview(buffer) for buffer in buffers]
+        while views:
+            if hasattr(os, 'pwritev'):
+                written = os.pwritev(self._write_fd, views, offset)
+            else:
+                # Python 3.6
+                written = os.pwrite(self._write_fd, views[0], offset)
+            offset += written
+            # Skip over the fully written buffers and continue with the rest after a short write
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if views and written > 0:
+                views[0] = views[0][written:]
+
+    def _write_blocks(self, blocks: List[Tuple[DereferencedBlock, bytes]]) -> List[DereferencedBlock]:
+        """ Writes blocks with adjacent ids. Runs of blocks which only contain zeros are deallocated instead of
+        written if the target supports it, all other runs are written with one system call each.
+        """
         t1 = time.time()
-        with open(self.parsed_url.path, 'rb+') as f:
-            f.seek(offset)
-            written = f.write(data)
-            os.posix_fadvise(f.fileno(), offset, len(data), os.POSIX_FADV_DONTNEED)
+        run_start = 0
+        while run_start < len(blocks):
+            run_zero = self._is_zero(blocks[run_start][1])
+            run_end = run_start + 1
+            while run_end < len(blocks) and self._is_zero(blocks[run_end][1]) == run_zero:
+                run_end += 1
+
+            offset = blocks[run_start][0].id * self.block_size
+            buffers = [data for _, data in blocks[run_start:run_end]]
+            if run_zero and self._write_target_created:
+                # A newly created target file is one big hole and reads as zeros already
+                pass
+            elif run_zero:
+                # Deallocating a range doesn't transfer any data but still counts as an I/O operation
+                self._throttling.throttle_write(0)
+                if not self._zero_out(offset, sum([len(buffer) for buffer in buffers])):
+                    self._pwritev(offset, buffers)
+            else:
+                self._throttling.throttle_write(sum([len(buffer) for buffer in buffers]))
+                self._pwritev(offset, buffers)
+            run_start = run_end
         t2 = time.time()
 
-        logger.debug('{} wrote block {} in {:.3f}s'.format(
+        logger.debug('{} wrote block{} {} in {:.3f}s'.format(
             threading.current_thread().name,
-            block.id,
+            's' if len(blocks) > 1 else '',
+            blocks[0][0].id if len(blocks) == 1 else '{}-{}'.format(blocks[0][0].id, blocks[-1][0].id),
             t2 - t1,
             ))
 
-        assert written == len(data)
-        return block
+        return [block for block, _ in blocks]
 
-    def write(self, block: DereferencedBlock, data: bytes) -> None:
+    def _submit_pending_writes(self) -> None:
+        if not self._pending_writes:
+            return
 
-        def job():
-            return self._write(block, data)
+        blocks = self._pending_writes
+        self._pending_writes = []
+        self._pending_writes_size = 0
 
         assert self._write_executor is not None
-        self._write_executor.submit(job)
+        self._write_executor.submit(lambda: self._write_blocks(blocks))
+
+    def write(self, block: DereferencedBlock, data: bytes) -> None:
+        # Adjacent blocks are merged into one write up to a size of maxWriteSize
+        if self._pending_writes:
+            last_block, last_data = self._pending_writes[-1]
+            if block.id != last_block.id + 1 or len(last_data) != self.block_size \
+                    or self._pending_writes_size + len(data) > self._max_write_size:
+                self._submit_pending_writes()
+        self._pending_writes.append((block, data))
+        self._pending_writes_size += len(data)
 
     def write_sync(self, block: DereferencedBlock, data: bytes) -> None:
-        self._write(block, data)
+        self._write_blocks([(block, data)])
 
     def write_get_completed(self, timeout: Optional[int] = None) -> Iterator[Union[DereferencedBlock, BaseException]]:
+        # Polling with a timeout of zero leaves the pending writes alone so that they can still be merged with
+        # further writes
+        if timeout != 0:
+            self._submit_pending_writes()
+        completed_writes = self._completed_writes
+        while completed_writes:
+            yield completed_writes.popleft()
         assert self._write_executor is not None
-        return self._write_executor.get_completed(timeout=timeout)
\ No newline at end of file
+        for results in self._write_executor.get_completed(timeout=timeout):
+            if isinstance(results, BaseException):
+                completed_writes.append(results)
+            else:
+                completed_writes.extend(results)
+            while completed_writes:
+                yield completed_writes.popleft()
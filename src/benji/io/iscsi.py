@@ -2,13 +2,15 @@
 # -*- encoding: utf-8 -*-
 import threading
 import time
-from typing import Tuple, Optional, Callable, Any, List, Union, Iterator
+from collections import deque
+from typing import Tuple, Optional, Callable, Any, List, Union, Iterator, Deque
 
 import libiscsi.libiscsi as libiscsi
 from benji.config import ConfigDict, Config
 from benji.database import DereferencedBlock, Block
 from benji.exception import ConfigurationError, UsageError
 from benji.io.base import IOBase
+from benji.jobexecutor import JobExecutor
 from benji.logging import logger
 
 
@@ -26,8 +28,25 @@ class IO(IOBase):
         if self.parsed_url.params or self.parsed_url.fragment:
             raise UsageError('The supplied URL {} is invalid.'.format(self.url))
 
-        self._read_queue: List[DereferencedBlock] = []
-        self._outstanding_write: Optional[Tuple[DereferencedBlock, bytes]] = None
+        self._simultaneous_reads = config.get_from_dict(module_configuration, 'simultaneousReads', types=int)
+        self._simultaneous_writes = config.get_from_dict(module_configuration, 'simultaneousWrites', types=int)
+        self._max_read_size = config.get_from_dict(module_configuration, 'maxReadSize', types=int)
+        self._max_write_size = config.get_from_dict(module_configuration, 'maxWriteSize', types=int)
+        self._read_executor: Optional[JobExecutor] = None
+        self._write_executor: Optional[JobExecutor] = None
+
+        # Blocks with adjacent ids which have been queued but not yet submitted to the executors
+        self._pending_reads: List[DereferencedBlock] = []
+        self._pending_writes: List[Tuple[DereferencedBlock, bytes]] = []
+        # Merged commands complete several blocks at once, the ones not taken by the caller yet are kept here
+        self._completed_reads: Deque[Union[Tuple[DereferencedBlock, bytes], BaseException]] = deque()
+        self._completed_writes: Deque[Union[DereferencedBlock, BaseException]] = deque()
+
+        # Each worker thread has its own iSCSI session with one command in flight. So the number of
+        # worker threads determines the queue depth.
+        self._local = threading.local()
+        self._iscsi_contexts: List[Any] = []
+        self._iscsi_contexts_lock = threading.Lock()
 
         self._username = config.get_from_dict(module_configuration, 'username', None, types=str)
         self._password = config.get_from_dict(module_configuration, 'password', None, types=str)
@@ -65,14 +84,11 @@ class IO(IOBase):
             raise RuntimeError('{} failed: {}'.format(operation, libiscsi.iscsi_get_error(iscsi_context).rstrip()))
         return result
 
-    def _open(self) -> None:
-        if self._iscsi_context is not None:
-            return
-
+    def _connect(self) -> Tuple[Any, Any]:
         # netloc includes username, password and port
         url = 'iscsi://{}{}?{}'.format(self.parsed_url.netloc, self.parsed_url.path, self.parsed_url.query)
         iscsi_context = libiscsi.iscsi_create_context(self._initiator_name)
-        iscsi_url = self._iscsi_call_sync('URL parsing', libiscsi.iscsi_parse_full_url, self._iscsi_context, url)
+        iscsi_url = self._iscsi_call_sync('URL parsing', libiscsi.iscsi_parse_full_url, iscsi_context, url)
 
         libiscsi.iscsi_set_targetname(iscsi_context, iscsi_url.target)
         libiscsi.iscsi_set_session_type(iscsi_context, libiscsi.ISCSI_SESSION_NORMAL)
@@ -92,6 +108,17 @@ class IO(IOBase):
         self._iscsi_call_sync('iSCSI connect', libiscsi.iscsi_full_connect_sync, iscsi_context, iscsi_url.portal,
                               iscsi_url.lun)
 
+        with self._iscsi_contexts_lock:
+            self._iscsi_contexts.append(iscsi_context)
+
+        return iscsi_context, iscsi_url
+
+    def _open(self) -> None:
+        if self._iscsi_context is not None:
+            return
+
+        iscsi_context, iscsi_url = self._connect()
+
         task = self._iscsi_execute_sync('READ CAPACITY(16)', libiscsi.iscsi_readcapacity16_sync, iscsi_context,
                                         iscsi_url.lun)
         task_data = libiscsi.scsi_datain_unmarshall(task)
@@ -114,112 +141,198 @@ class IO(IOBase):
                     self.block_size % self._iscsi_block_size))
 
         self._iscsi_context = iscsi_context
+        self._local.iscsi_context = iscsi_context
 
         logger.debug('Opened iSCSI device {} with block size {} and {} blocks.'.format(
             self.url, self._iscsi_block_size, self._iscsi_num_blocks))
 
+    def _thread_iscsi_context(self) -> Any:
+        if getattr(self._local, 'iscsi_context', None) is None:
+            self._local.iscsi_context = self._connect()[0]
+        return self._local.iscsi_context
+
     def open_r(self) -> None:
         self._open()
+        self._read_executor = JobExecutor(name='IO-Read', workers=self._simultaneous_reads, blocking_submit=False)
 
     def open_w(self, size: int, force: bool = False, sparse: bool = False) -> None:
         self._open()
+        self._write_executor = JobExecutor(name='IO-Write', workers=self._simultaneous_writes, blocking_submit=True)
 
     def close(self) -> None:
-        if len(self._read_queue) > 0:
-            logger.warning('Closing IO module with {} read outstanding jobs.'.format(self._name, len(self._read_queue)))
-            self._read_queue = []
-
-        if self._outstanding_write is not None:
-            logger.warning('Closing IO module with one outstanding write.'.format(self._name))
-            self._outstanding_write = None
-
+        if len(self._pending_reads) > 0:
+            logger.warning('Closing IO module {} with {} pending read jobs.'.format(self._name,
+                                                                                   len(self._pending_reads)))
+            self._pending_reads = []
+        if len(self._pending_writes) > 0:
+            logger.warning('Closing IO module {} with {} pending write jobs.'.format(
+                self._name, len(self._pending_writes)))
+            self._pending_writes = []
+        self._completed_reads.clear()
+        self._completed_writes.clear()
+
+        if self._read_executor:
+            self._read_executor.shutdown()
+        if self._write_executor:
+            self._write_executor.shutdown()
+
+        with self._iscsi_contexts_lock:
+            for iscsi_context in self._iscsi_contexts:
+                libiscsi.iscsi_logout_sync(iscsi_context)
+                libiscsi.iscsi_destroy_context(iscsi_context)
+            self._iscsi_contexts = []
+        self._local = threading.local()
         self._iscsi_context = None
 
     def size(self) -> int:
         self._open()
         return self._iscsi_block_size * self._iscsi_num_blocks
 
-    def _read(self, block: DereferencedBlock) -> Tuple[DereferencedBlock, bytes]:
-        assert block.size == self.block_size
-        lba = (block.id * self.block_size) // self._iscsi_block_size
-        num_blocks = self.block_size // self._iscsi_block_size
+    def _lba_range(self, operation: str, blocks: List[DereferencedBlock]) -> Tuple[int, int]:
+        for block in blocks:
+            assert block.size == self.block_size
+        lba = (blocks[0].id * self.block_size) // self._iscsi_block_size
+        num_blocks = len(blocks) * self.block_size // self._iscsi_block_size
 
         if lba >= self._iscsi_num_blocks:
             raise RuntimeError(
-                'Attempt to read outside of the device. Requested LBA is {}, but device has only {} blocks. (1)'.format(
-                    lba, self._iscsi_num_blocks))
+                'Attempt to {} outside of the device. Requested LBA is {}, but device has only {} blocks. (1)'.format(
+                    operation, lba, self._iscsi_num_blocks))
 
         if lba + num_blocks > self._iscsi_num_blocks:
             raise RuntimeError(
-                'Attempt to read outside of the device. Requested LBA is {}, but device has only {} blocks. (2)'.format(
-                    lba + num_blocks, self._iscsi_num_blocks))
+                'Attempt to {} outside of the device. Requested LBA is {}, but device has only {} blocks. (2)'.format(
+                    operation, lba + num_blocks, self._iscsi_num_blocks))
+
+        return lba, num_blocks
 
+    @staticmethod
+    def _blocks_str(blocks: List[DereferencedBlock]) -> str:
+        if len(blocks) == 1:
+            return 'block {}'.format(blocks[0].id)
+        return 'blocks {}-{}'.format(blocks[0].id, blocks[-1].id)
+
+    def _read_blocks(self, blocks: List[DereferencedBlock]) -> List[Tuple[DereferencedBlock, bytes]]:
+        """ Reads blocks with adjacent ids with one READ(16) command. """
+        lba, _ = self._lba_range('read', blocks)
+        length = len(blocks) * self.block_size
+
+        self._throttling.throttle_read(length)
         t1 = time.time()
-        task = self._iscsi_execute_sync('READ(16)', libiscsi.iscsi_read16_sync, self._iscsi_context, self._iscsi_lun,
-                                        lba, self.block_size, self._iscsi_block_size, 0, 0, 0, 0, 0)
+        task = self._iscsi_execute_sync('READ(16)', libiscsi.iscsi_read16_sync, self._thread_iscsi_context(),
+                                        self._iscsi_lun, lba, length, self._iscsi_block_size, 0, 0, 0, 0, 0)
 
         data = task.datain
-        assert len(data) == self.block_size
+        assert len(data) == length
         t2 = time.time()
 
-        logger.debug('{} read block {} in {:.3f}s'.format(
+        logger.debug('{} read {} in {:.3f}s'.format(
             threading.current_thread().name,
-            block.id,
+            self._blocks_str(blocks),
             t2 - t1,
         ))
 
-        return block, data
+        if len(blocks) == 1:
+            return [(blocks[0], data)]
+        return [(block, data[i * self.block_size:(i + 1) * self.block_size]) for i, block in enumerate(blocks)]
+
+    def _submit_pending_reads(self) -> None:
+        if not self._pending_reads:
+            return
+
+        blocks = self._pending_reads
+        self._pending_reads = []
+
+        def job():
+            try:
+                return self._read_blocks(blocks)
+            except Exception as exception:
+                # Report the error for each block so that the number of completed reads matches the submitted ones
+                return [exception] * len(blocks)
+
+        assert self._read_executor is not None
+        self._read_executor.submit(job)
 
     def read(self, block: Union[DereferencedBlock, Block]) -> None:
         block_deref = block.deref() if isinstance(block, Block) else block
-        self._read_queue.append(block_deref)
+
+        # Adjacent blocks are merged into one command up to a size of maxReadSize
+        if self._pending_reads and (block_deref.id != self._pending_reads[-1].id + 1 or
+                                    (len(self._pending_reads) + 1) * self.block_size > self._max_read_size):
+            self._submit_pending_reads()
+        self._pending_reads.append(block_deref)
 
     def read_sync(self, block: Union[DereferencedBlock, Block]) -> bytes:
         block_deref = block.deref() if isinstance(block, Block) else block
-        return self._read(block_deref)[1]
+        return self._read_blocks([block_deref])[0][1]
 
     def read_get_completed(
             self, timeout: Optional[int] = None) -> Iterator[Union[Tuple[DereferencedBlock, bytes], BaseException]]:
-        while len(self._read_queue) > 0:
-            yield self._read(self._read_queue.pop())
-
-    def _write(self, block: DereferencedBlock, data: bytes) -> DereferencedBlock:
-        assert block.size == self.block_size
-        lba = (block.id * self.block_size) // self._iscsi_block_size
-        num_blocks = self.block_size // self._iscsi_block_size
-
-        if lba >= self._iscsi_num_blocks:
-            raise RuntimeError(
-                'Attempt to write outside of the device. Requested LBA is {}, but device has only {} blocks. (1)'.format(
-                    lba, self._iscsi_num_blocks))
+        self._submit_pending_reads()
+        completed_reads = self._completed_reads
+        while completed_reads:
+            yield completed_reads.popleft()
+        assert self._read_executor is not None
+        for results in self._read_executor.get_completed(timeout=timeout):
+            if isinstance(results, BaseException):
+                completed_reads.append(results)
+            else:
+                completed_reads.extend(results)
+            while completed_reads:
+                yield completed_reads.popleft()
 
-        if lba + num_blocks > self._iscsi_num_blocks:
-            raise RuntimeError(
-                'Attempt to write outside of the device. Requested LBA is {}, but device has only {} blocks. (2)'.format(
-                    lba + num_blocks, self._iscsi_num_blocks))
+    def _write_blocks(self, blocks: List[Tuple[DereferencedBlock, bytes]]) -> List[DereferencedBlock]:
+        """ Writes blocks with adjacent ids with one WRITE(16) command. """
+        lba, _ = self._lba_range('write', [block for block, _ in blocks])
+        data = blocks[0][1] if len(blocks) == 1 else b''.join([data for _, data in blocks])
 
+        self._throttling.throttle_write(len(data))
         t1 = time.time()
-        self._iscsi_execute_sync('WRITE(16)', libiscsi.iscsi_write16_sync, self._iscsi_context, self._iscsi_lun, lba,
-                                 data, self._iscsi_block_size, 0, 0, 0, 0, 0)
+        self._iscsi_execute_sync('WRITE(16)', libiscsi.iscsi_write16_sync, self._thread_iscsi_context(),
+                                 self._iscsi_lun, lba, data, self._iscsi_block_size, 0, 0, 0, 0, 0)
         t2 = time.time()
 
-        logger.debug('{} wrote block {} in {:.3f}s'.format(
+        logger.debug('{} wrote {} in {:.3f}s'.format(
             threading.current_thread().name,
-            block.id,
+            self._blocks_str([block for block, _ in blocks]),
             t2 - t1,
         ))
 
-        return block
+        return [block for block, _ in blocks]
+
+    def _submit_pending_writes(self) -> None:
+        if not self._pending_writes:
+            return
+
+        blocks = self._pending_writes
+        self._pending_writes = []
+
+        assert self._write_executor is not None
+        self._write_executor.submit(lambda: self._write_blocks(blocks))
 
     def write(self, block: DereferencedBlock, data: bytes) -> None:
-        assert self._outstanding_write is None
-        self._outstanding_write = (block, data)
+        # Adjacent blocks are merged into one command up to a size of maxWriteSize
+        if self._pending_writes and (block.id != self._pending_writes[-1][0].id + 1 or
+                                     (len(self._pending_writes) + 1) * self.block_size > self._max_write_size):
+            self._submit_pending_writes()
+        self._pending_writes.append((block, data))
 
     def write_sync(self, block: DereferencedBlock, data: bytes) -> None:
-        self._write(block, data)
+        self._write_blocks([(block, data)])
 
     def write_get_completed(self, timeout: Optional[int] = None) -> Iterator[Union[DereferencedBlock, BaseException]]:
-        if self._outstanding_write is not None:
-            yield self._write(*self._outstanding_write)
-            self._outstanding_write = None
-
+        # Polling with a timeout of zero leaves the pending writes alone so that they can still be merged with
+        # further writes
+        if timeout != 0:
+            self._submit_pending_writes()
+        completed_writes = self._completed_writes
+        while completed_writes:
+            yield completed_writes.popleft()
+        assert self._write_executor is not None
+        for results in self._write_executor.get_completed(timeout=timeout):
+            if isinstance(results, BaseException):
+                completed_writes.append(results)
+            else:
+                completed_writes.extend(results)
+            while completed_writes:
+                yield completed_writes.popleft()
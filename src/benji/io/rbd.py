@@ -3,7 +3,7 @@
 import re
 import threading
 import time
-from typing import Tuple, Optional, Union, Iterator
+from typing import Tuple, Optional, Union, Iterator, List
 
 import rados
 import rbd
@@ -14,6 +14,59 @@ from benji.io.base import IOBase
 from benji.jobexecutor import JobExecutor
 from benji.logging import logger
 
+# Number of RBD objects covered by each call to diff_iterate when generating hints
+_HINTS_CHUNK_OBJECTS = 4096
+
+
+def base_snapshot_usable(image: rbd.Image, *, base_snapshot_name: str, snapshot_name: Optional[str],
+                         url: str) -> bool:
+    """ Checks if the changes since the snapshot of the base version can be used as hints. The snapshot is only
+    matched by name, so it must exist, mustn't be the backup source itself and must be older than the backup source.
+    Otherwise a snapshot recreated under the same name would yield an empty or incomplete diff and the backup would
+    silently keep stale data of the base version.
+    """
+    snapshot_ids = {snapshot['name']: snapshot['id'] for snapshot in image.list_snaps()}
+    if base_snapshot_name not in snapshot_ids:
+        # Only listing the allocated regions isn't enough here, as the base version might contain data
+        # where the source is unallocated now
+        logger.info('Snapshot {} of base version not found, not generating hints for {}.'.format(
+            base_snapshot_name, url))
+        return False
+    if snapshot_name is not None and (base_snapshot_name == snapshot_name or
+                                      snapshot_ids[base_snapshot_name] >= snapshot_ids[snapshot_name]):
+        logger.warning('Snapshot {} of base version is not older than the backup source, not generating hints for '
+                       '{}.'.format(base_snapshot_name, url))
+        return False
+    return True
+
+
+def diff_hints(image: rbd.Image, *, from_snapshot: Optional[str], url: str) -> Iterator[Tuple[int, int, bool]]:
+    """ Yields the changed regions of an RBD image relative to from_snapshot or its allocated regions if from_snapshot
+    is None. The image is processed in chunks of _HINTS_CHUNK_OBJECTS objects, so that the hints can be consumed while
+    they are being generated and don't need to be held in memory all at once.
+    """
+    size = image.size()
+    chunk_size = image.stat()['obj_size'] * _HINTS_CHUNK_OBJECTS
+    hints_count = 0
+    t1 = time.time()
+    for chunk_offset in range(0, size, chunk_size):
+        hints: List[Tuple[int, int, bool]] = []
+
+        def iterate_cb(offset: int, length: int, exists: bool) -> None:
+            hints.append((offset, length, exists))
+
+        image.diff_iterate(chunk_offset,
+                           min(chunk_size, size - chunk_offset),
+                           from_snapshot,
+                           iterate_cb,
+                           whole_object=True)
+        hints_count += len(hints)
+        yield from hints
+    t2 = time.time()
+
+    logger.debug('Generated {} hints for {}{} in {:.2f}s.'.format(
+        hints_count, url, ' relative to snapshot {}'.format(from_snapshot) if from_snapshot else '', t2 - t1))
+
 
 class IO(IOBase):
 
@@ -51,8 +104,11 @@ class IO(IOBase):
 
         self._simultaneous_reads = config.get_from_dict(module_configuration, 'simultaneousReads', types=int)
         self._simultaneous_writes = config.get_from_dict(module_configuration, 'simultaneousWrites', types=int)
+        self._generate_hints = config.get_from_dict(module_configuration, 'generateHints', types=bool)
         self._read_executor: Optional[JobExecutor] = None
         self._write_executor: Optional[JobExecutor] = None
+        # A newly created image doesn't have any objects and reads as zeros
+        self._image_created = False
 
     def open_r(self) -> None:
         self._read_executor = JobExecutor(name='IO-Read', workers=self._simultaneous_reads, blocking_submit=False)
@@ -93,6 +149,7 @@ class IO(IOBase):
         except rbd.ImageNotFound:
             rbd.RBD().create(ioctx, self._image_name, size, old_format=False, features=self._new_image_features)
             rbd.Image(ioctx, self._image_name)
+            self._image_created = True
         else:
             try:
                 if not force:
@@ -132,8 +189,33 @@ class IO(IOBase):
             size = image.size()
         return size
 
+    def hints(self,
+              base_snapshot_name: str = None,
+              generate: bool = False) -> Optional[Iterator[Tuple[int, int, bool]]]:
+        if not (generate or self._generate_hints):
+            return None
+
+        assert self._pool_name is not None and self._image_name is not None
+        ioctx = self._cluster.open_ioctx(self._pool_name)
+        from_snapshot = None
+        if base_snapshot_name:
+            with rbd.Image(ioctx, self._image_name, self._snapshot_name, read_only=True) as image:
+                if not base_snapshot_usable(image,
+                                            base_snapshot_name=base_snapshot_name,
+                                            snapshot_name=self._snapshot_name,
+                                            url=self.url):
+                    return None
+            from_snapshot = base_snapshot_name
+
+        def hints_iter() -> Iterator[Tuple[int, int, bool]]:
+            with rbd.Image(ioctx, self._image_name, self._snapshot_name, read_only=True) as image:
+                yield from diff_hints(image, from_snapshot=from_snapshot, url=self.url)
+
+        return hints_iter()
+
     def _read(self, block: DereferencedBlock) -> Tuple[DereferencedBlock, bytes]:
         offset = block.id * self.block_size
+        self._throttling.throttle_read(block.size)
         t1 = time.time()
         ioctx = self._cluster.open_ioctx(self._pool_name)
         with rbd.Image(ioctx, self._image_name, self._snapshot_name, read_only=True) as image:
@@ -171,6 +253,7 @@ class IO(IOBase):
 
     def _write(self, block: DereferencedBlock, data: bytes) -> DereferencedBlock:
         offset = block.id * self.block_size
+        self._throttling.throttle_write(len(data))
         t1 = time.time()
         ioctx = self._cluster.open_ioctx(self._pool_name)
         with rbd.Image(ioctx, self._image_name, self._snapshot_name) as image:
@@ -194,6 +277,39 @@ class IO(IOBase):
         assert self._write_executor is not None
         self._write_executor.submit(job)
 
+    def _write_zeroes(self, block: DereferencedBlock) -> DereferencedBlock:
+        offset = block.id * self.block_size
+        self._throttling.throttle_write(0 if hasattr(rbd.Image, 'write_zeroes') else block.size)
+        t1 = time.time()
+        ioctx = self._cluster.open_ioctx(self._pool_name)
+        with rbd.Image(ioctx, self._image_name, self._snapshot_name) as image:
+            if hasattr(image, 'write_zeroes'):
+                # This deallocates the objects which are completely covered
+                image.write_zeroes(offset, block.size)
+            else:
+                # Older versions of librbd
+                written = image.write(bytes(block.size), offset, rados.LIBRADOS_OP_FLAG_FADVISE_DONTNEED)
+                assert written == block.size
+        t2 = time.time()
+
+        logger.debug('{} zeroed out block {} in {:.3f}s'.format(
+            threading.current_thread().name,
+            block.id,
+            t2 - t1,
+        ))
+
+        return block
+
+    def write_zeroes(self, block: DereferencedBlock) -> None:
+
+        def job():
+            if self._image_created:
+                return block
+            return self._write_zeroes(block)
+
+        assert self._write_executor is not None
+        self._write_executor.submit(job)
+
     def write_sync(self, block: DereferencedBlock, data: bytes) -> None:
         self._write(block, data)
 
@@ -5,7 +5,7 @@ import re
 import threading
 import time
 from collections import deque
-from typing import Tuple, Optional, Union, Iterator, Deque
+from typing import Tuple, Optional, Union, Iterator, Deque, List, Dict
 
 import rados
 import rbd
@@ -14,6 +14,7 @@ from benji.config import ConfigDict, Config
 from benji.database import DereferencedBlock, Block
 from benji.exception import UsageError, ConfigurationError
 from benji.io.base import IOBase
+from benji.io.rbd import diff_hints, base_snapshot_usable
 from benji.logging import logger
 
 
@@ -53,16 +54,32 @@ class IO(IOBase):
         self._rbd_image = None
 
         self._simultaneous_reads = config.get_from_dict(module_configuration, 'simultaneousReads', types=int)
+        self._min_simultaneous_reads = min(
+            config.get_from_dict(module_configuration, 'minSimultaneousReads', types=int), self._simultaneous_reads)
         self._simultaneous_writes = config.get_from_dict(module_configuration, 'simultaneousWrites', types=int)
-        self._read_queue: Deque[DereferencedBlock] = deque()
-        self._write_queue: Deque[Tuple[DereferencedBlock, bytes]] = deque()
+        self._generate_hints = config.get_from_dict(module_configuration, 'generateHints', types=bool)
+        self._max_read_size = config.get_from_dict(module_configuration, 'maxReadSize', types=int)
+        # Each entry is a run of blocks with adjacent ids which is read with one aio_read
+        self._read_queue: Deque[List[DereferencedBlock]] = deque()
+        self._read_queue_tail_size = 0
+        # Reads submitted to librbd, indexed by their completion
+        self._aio_reads: Dict[rbd.Completion, Tuple[float, List[DereferencedBlock]]] = {}
+        # Merged reads complete several blocks at once, the ones not taken by the caller yet are kept here
+        self._completed_reads: Deque[Union[Tuple[DereferencedBlock, bytes], BaseException]] = deque()
+        # Read queue depth adapted to the latency of the completed reads, see _adapt_read_queue_depth
+        self._read_queue_depth = float(self._simultaneous_reads)
+        self._read_latency_floor: Optional[float] = None
+        self._reads_since_decrease = 0
+        # Entries without data are written with zeros
+        self._write_queue: Deque[Tuple[DereferencedBlock, Optional[bytes]]] = deque()
+        # A newly created image doesn't have any objects and reads as zeros
+        self._image_created = False
         self._outstanding_aio_reads = 0
         self._outstanding_aio_writes = 0
         self._submitted_aio_writes = threading.BoundedSemaphore(self._simultaneous_writes)
-        self._read_completion_queue: queue.Queue[
-            Tuple[rbd.Completion, float, float, DereferencedBlock, bytes]] = queue.Queue()
+        self._read_completion_queue: queue.Queue[Tuple[rbd.Completion, bytes, float]] = queue.Queue()
         self._write_completion_queue: queue.Queue[
-            Tuple[rbd.Completion, float, float, DereferencedBlock]] = queue.Queue()
+            Tuple[Optional[rbd.Completion], float, float, DereferencedBlock]] = queue.Queue()
 
     def open_r(self) -> None:
         re_match = re.match('^([^/]+)/([^@]+)(?:@(.+))?$', self.parsed_url.path)
@@ -99,6 +116,7 @@ class IO(IOBase):
         except rbd.ImageNotFound:
             rbd.RBD().create(ioctx, self._image_name, size, old_format=False, features=self._new_image_features)
             self._rbd_image = rbd.Image(ioctx, self._image_name)
+            self._image_created = True
         else:
             assert self._rbd_image is not None
             if not force:
@@ -125,33 +143,100 @@ class IO(IOBase):
 
     def close(self) -> None:
         assert self._rbd_image is not None
+        if self._read_latency_floor is not None:
+            logger.debug('Read queue depth for {} was {:.1f} at the end.'.format(self.url, self._read_queue_depth))
         self._rbd_image.close()
 
     def size(self) -> int:
         assert self._rbd_image is not None
         return self._rbd_image.size()
 
-    def _submit_aio_reads(self):
-        while len(self._read_queue) > 0 and self._outstanding_aio_reads < self._simultaneous_reads:
-            block = self._read_queue.pop()
-            t1 = time.time()
+    def hints(self,
+              base_snapshot_name: str = None,
+              generate: bool = False) -> Optional[Iterator[Tuple[int, int, bool]]]:
+        if not (generate or self._generate_hints):
+            return None
 
-            def aio_callback(completion, data):
-                t2 = time.time()
-                self._read_completion_queue.put((completion, t1, t2, block, data))
+        assert self._rbd_image is not None
+        from_snapshot = None
+        if base_snapshot_name:
+            if not base_snapshot_usable(self._rbd_image,
+                                        base_snapshot_name=base_snapshot_name,
+                                        snapshot_name=self._snapshot_name,
+                                        url=self.url):
+                return None
+            from_snapshot = base_snapshot_name
 
-            offset = block.id * self.block_size
-            self._rbd_image.aio_read(offset, block.size, aio_callback, rados.LIBRADOS_OP_FLAG_FADVISE_DONTNEED)
+        return diff_hints(self._rbd_image, from_snapshot=from_snapshot, url=self.url)
+
+    def _read_callback(self, completion: rbd.Completion, data: bytes) -> None:
+        # This is called from a librbd thread for each completed read, so it only does the bare minimum
+        self._read_completion_queue.put((completion, data, time.monotonic()))
+
+    def _submit_aio_reads(self):
+        assert self._rbd_image is not None
+        while len(self._read_queue) > 0 and self._outstanding_aio_reads < int(self._read_queue_depth):
+            blocks = self._read_queue.popleft()
+            if len(self._read_queue) == 0:
+                self._read_queue_tail_size = 0
+
+            offset = blocks[0].id * self.block_size
+            length = sum([block.size for block in blocks])
+            self._throttling.throttle_read(length)
+            t1 = time.monotonic()
+            completion = self._rbd_image.aio_read(offset, length, self._read_callback,
+                                                  rados.LIBRADOS_OP_FLAG_FADVISE_DONTNEED)
+            # The callback can't have been processed yet as this happens in the same thread
+            self._aio_reads[completion] = (t1, blocks)
             self._outstanding_aio_reads += 1
 
+    def _adapt_read_queue_depth(self, latency: float, length: int) -> None:
+        """ Adapts the read queue depth with additive increase and multiplicative decrease (AIMD) between
+        minSimultaneousReads and simultaneousReads. While the latency per byte stays close to the lowest latency seen
+        recently, the queue depth grows by one per round of reads. When it rises to more than twice that, the
+        cluster is considered congested and the queue depth is halved, at most once per round.
+        """
+        if self._min_simultaneous_reads == self._simultaneous_reads:
+            return
+
+        latency_per_byte = latency / length
+        if self._read_latency_floor is None:
+            self._read_latency_floor = latency_per_byte
+        else:
+            # Let the floor rise slowly so that it follows permanent changes
+            self._read_latency_floor = min(latency_per_byte, self._read_latency_floor * 1.001)
+
+        self._reads_since_decrease += 1
+        if latency_per_byte > 2 * self._read_latency_floor:
+            if self._reads_since_decrease >= self._read_queue_depth:
+                self._read_queue_depth = max(self._read_queue_depth / 2, float(self._min_simultaneous_reads))
+                self._reads_since_decrease = 0
+        else:
+            self._read_queue_depth = min(self._read_queue_depth + 1 / self._read_queue_depth,
+                                         float(self._simultaneous_reads))
+
     def read(self, block: Union[DereferencedBlock, Block]) -> None:
         block_deref = block.deref() if isinstance(block, Block) else block
-        self._read_queue.appendleft(block_deref)
+
+        # Adjacent blocks are merged into one read up to a size of maxReadSize as long as the read hasn't been
+        # submitted yet
+        if len(self._read_queue) > 0:
+            last_blocks = self._read_queue[-1]
+            if block_deref.id == last_blocks[-1].id + 1 and last_blocks[-1].size == self.block_size \
+                    and self._read_queue_tail_size + block_deref.size <= self._max_read_size:
+                last_blocks.append(block_deref)
+                self._read_queue_tail_size += block_deref.size
+                self._submit_aio_reads()
+                return
+
+        self._read_queue.append([block_deref])
+        self._read_queue_tail_size = block_deref.size
         self._submit_aio_reads()
 
     def read_sync(self, block: Union[DereferencedBlock, Block]) -> bytes:
         assert self._rbd_image is not None
         offset = block.id * self.block_size
+        self._throttling.throttle_read(block.size)
         t1 = time.time()
         data = self._rbd_image.read(offset, block.size, rados.LIBRADOS_OP_FLAG_FADVISE_DONTNEED)
         t2 = time.time()
@@ -166,43 +251,66 @@ class IO(IOBase):
     def _reads_finished(self) -> bool:
         return len(self._read_queue) == 0 and self._outstanding_aio_reads == 0
 
+    def _read_completed(self, completion: rbd.Completion, data: bytes, t2: float) -> None:
+        t1, blocks = self._aio_reads.pop(completion)
+        length = sum([block.size for block in blocks])
+
+        try:
+            completion.wait_for_complete_and_cb()
+        except Exception as exception:
+            self._completed_reads.extend([exception] * len(blocks))
+            return
+
+        read_return_value = completion.get_return_value()
+        if read_return_value < 0 or not data:
+            # Checking data shouldn't be necessary because a failed read should be caught by the
+            # "read_return_value < 0" check. See:
+            # https://github.com/ceph/ceph/blob/880468b4bf6f0a1995de5bd98c09007a00222cbf/src/pybind/rbd/rbd.pyx#L4145.
+            exception: Exception = IOError('Read of block {} failed.'.format(blocks[0].id))
+            self._completed_reads.extend([exception] * len(blocks))
+            return
+        if read_return_value != length:
+            exception = IOError('Short read of block {}. Wanted {} bytes but got {}.'.format(
+                blocks[0].id, length, read_return_value))
+            self._completed_reads.extend([exception] * len(blocks))
+            return
+
+        self._adapt_read_queue_depth(t2 - t1, length)
+
+        if len(blocks) == 1:
+            logger.debug('Read block {} in {:.3f}s'.format(blocks[0].id, t2 - t1))
+            self._completed_reads.append((blocks[0], data))
+        else:
+            logger.debug('Read blocks {}-{} in {:.3f}s'.format(blocks[0].id, blocks[-1].id, t2 - t1))
+            data_view = memoryview(data)
+            offset = 0
+            for block in blocks:
+                self._completed_reads.append((block, bytes(data_view[offset:offset + block.size])))
+                offset += block.size
+
     def read_get_completed(self, timeout: Optional[int] = None
                           ) -> Iterator[Union[Tuple[DereferencedBlock, bytes], BaseException]]:
+        completed_reads = self._completed_reads
+        while completed_reads:
+            yield completed_reads.popleft()
+
         try:
             while not self._reads_finished():
-                logger.debug('Read queue length, outstanding reads, completion queue length: {}, {}, {}.'.format(
-                    len(self._read_queue), self._outstanding_aio_reads, self._read_completion_queue.qsize()))
+                logger.debug('Read queue length, outstanding reads, queue depth, completion queue length: '
+                             '{}, {}, {:.1f}, {}.'.format(len(self._read_queue), self._outstanding_aio_reads,
+                                                          self._read_queue_depth, self._read_completion_queue.qsize()))
                 self._submit_aio_reads()
 
-                completion, t1, t2, block, data = self._read_completion_queue.get(
+                completion, data, t2 = self._read_completion_queue.get(
                     block=True if timeout is None or timeout != 0 else False, timeout=timeout)
                 assert self._outstanding_aio_reads > 0
                 self._outstanding_aio_reads -= 1
+                self._read_completed(completion, data, t2)
+                # Don't keep a reference to the data, completed_reads is the only owner now
+                del data
 
-                try:
-                    completion.wait_for_complete_and_cb()
-                except Exception as exception:
-                    yield exception
-                else:
-                    read_return_value = completion.get_return_value()
-
-                    if read_return_value < 0:
-                        raise IOError('Read of block {} failed.'.format(block.id))
-
-                    if read_return_value != block.size:
-                        raise IOError('Short read of block {}. Wanted {} bytes but got {}.'.format(
-                            block.id, block.size, read_return_value))
-
-                    if not data:
-                        # We shouldn't get here because a failed read should be caught by the "read_return_value < 0"
-                        # check above. See: https://github.com/ceph/ceph/blob/880468b4bf6f0a1995de5bd98c09007a00222cbf/src/pybind/rbd/rbd.pyx#L4145.
-                        raise IOError('Read of block {} failed.'.format(block.id))
-
-                    logger.debug('Read block {} in {:.3f}s'.format(block.id, t2 - t1))
-
-                    yield block, data
-
-                self._read_completion_queue.task_done()
+                while completed_reads:
+                    yield completed_reads.popleft()
         except queue.Empty:
             return
         else:
@@ -212,6 +320,8 @@ class IO(IOBase):
         assert self._rbd_image is not None
         while len(self._write_queue) > 0 and self._outstanding_aio_writes < self._simultaneous_writes:
             block, data = self._write_queue.pop()
+            zeroes_deallocated = data is None and hasattr(self._rbd_image, 'aio_write_zeroes')
+            self._throttling.throttle_write(0 if zeroes_deallocated else block.size)
             t1 = time.time()
 
             def aio_callback(completion):
@@ -221,16 +331,34 @@ class IO(IOBase):
 
             self._submitted_aio_writes.acquire()
             offset = block.id * self.block_size
-            self._rbd_image.aio_write(data, offset, aio_callback, rados.LIBRADOS_OP_FLAG_FADVISE_DONTNEED)
+            if data is not None:
+                self._rbd_image.aio_write(data, offset, aio_callback, rados.LIBRADOS_OP_FLAG_FADVISE_DONTNEED)
+            elif zeroes_deallocated:
+                # This deallocates the objects which are completely covered
+                self._rbd_image.aio_write_zeroes(offset, block.size, aio_callback)
+            else:
+                # Older versions of librbd
+                self._rbd_image.aio_write(bytes(block.size), offset, aio_callback,
+                                          rados.LIBRADOS_OP_FLAG_FADVISE_DONTNEED)
             self._outstanding_aio_writes += 1
 
     def write(self, block: DereferencedBlock, data: bytes) -> None:
         self._write_queue.appendleft((block, data))
         self._submit_aio_writes()
 
+    def write_zeroes(self, block: DereferencedBlock) -> None:
+        if self._image_created:
+            # Nothing to do, but the completion still has to be reported by write_get_completed
+            self._write_completion_queue.put((None, time.time(), time.time(), block))
+            self._outstanding_aio_writes += 1
+        else:
+            self._write_queue.appendleft((block, None))
+            self._submit_aio_writes()
+
     def write_sync(self, block: DereferencedBlock, data: bytes) -> None:
         assert self._rbd_image is not None
         offset = block.id * self.block_size
+        self._throttling.throttle_write(len(data))
         t1 = time.time()
         written = self._rbd_image.write(data, offset, rados.LIBRADOS_OP_FLAG_FADVISE_DONTNEED)
         t2 = time.time()
@@ -254,6 +382,12 @@ class IO(IOBase):
                 assert self._outstanding_aio_writes > 0
                 self._outstanding_aio_writes -= 1
 
+                if completion is None:
+                    logger.debug('Skipped zeroing out block {} of newly created image.'.format(block.id))
+                    yield block
+                    self._write_completion_queue.task_done()
+                    continue
+
                 try:
                     completion.wait_for_complete_and_cb()
                 except Exception as exception:
@@ -1,7 +1,8 @@
-import concurrent
-from concurrent.futures import ThreadPoolExecutor, Future
-from threading import BoundedSemaphore
-from typing import List, Callable, Iterator, Any
+import time
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError
+from queue import Queue, Empty
+from threading import BoundedSemaphore, Condition
+from typing import Callable, Iterator, Any, Dict, Tuple
 
 from benji.logging import logger
 
@@ -15,63 +16,153 @@ class JobExecutor:
     # outstanding results is limited.
     # In the case of a storage read for example this ensures that we don't have to many outstanding read blocks
     # at once and so use up all available memory.
+    #
+    # The workers put the result of each job (or the exception it raised) onto a completion queue. get_completed
+    # takes the results from this queue in completion order, so each result is retrieved in constant time.
+    # submit and get_completed must be called from the same thread.
     def __init__(self, *, workers: int, blocking_submit: bool, name: str) -> None:
         self._name = name
         self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
-        self._futures: List[Future] = []
+        # Each entry is a tuple of (result, semaphore_acquired, submit_time, start_time, end_time)
+        self._completion_queue: Queue = Queue()
         self._blocking_submit = blocking_submit
         # Set the queue limit to two times the number of workers plus one to ensure that there are always
         # enough jobs available even when all futures finish at the same time.
         self._semaphore = BoundedSemaphore(2 * workers + 1)
+        self._cancelled = False
+        # Number of jobs whose results haven't been retrieved yet
+        self._outstanding = 0
+        # Number of jobs which haven't finished executing yet, protected by _unfinished_condition
+        self._unfinished = 0
+        self._unfinished_condition = Condition()
+
+        self._jobs_submitted = 0
+        self._jobs_completed = 0
+        self._jobs_cancelled = 0
+        self._queue_time = 0.0
+        self._run_time = 0.0
+        self._completion_time = 0.0
+        self._max_completion_queue_depth = 0
+
+    def _execute(self, function: Callable, submit_time: float) -> None:
+        start_time = time.monotonic()
+        semaphore_acquired = False
+        result: Any
+        try:
+            if self._cancelled:
+                raise CancelledError()
+            if not self._blocking_submit:
+                self._semaphore.acquire()
+                semaphore_acquired = True
+                # We might have been waiting for the semaphore for quite some time
+                if self._cancelled:
+                    raise CancelledError()
+            result = function()
+        except BaseException as exception:
+            result = exception
+        finally:
+            if self._blocking_submit:
+                self._semaphore.release()
+            end_time = time.monotonic()
+            with self._unfinished_condition:
+                self._unfinished -= 1
+                self._unfinished_condition.notify_all()
+        self._completion_queue.put((result, semaphore_acquired, submit_time, start_time, end_time))
 
     def submit(self, function: Callable) -> None:
         if self._blocking_submit:
             self._semaphore.acquire()
 
-            def execute_with_release():
-                try:
-                    return function()
-                except Exception:
-                    raise
-                finally:
-                    self._semaphore.release()
-
-            self._futures.append(self._executor.submit(execute_with_release))
-        else:
+        with self._unfinished_condition:
+            self._unfinished += 1
+        self._outstanding += 1
+        self._jobs_submitted += 1
+        self._executor.submit(self._execute, function, time.monotonic())
 
-            def execute_with_acquire():
-                self._semaphore.acquire()
-                return function()
+    def _retrieve(self, entry: Tuple[Any, bool, float, float, float]) -> Any:
+        result, semaphore_acquired, submit_time, start_time, end_time = entry
+        self._outstanding -= 1
+        if semaphore_acquired:
+            self._semaphore.release()
 
-            self._futures.append(self._executor.submit(execute_with_acquire))
+        if isinstance(result, CancelledError):
+            self._jobs_cancelled += 1
+        else:
+            self._jobs_completed += 1
+            self._queue_time += start_time - submit_time
+            self._run_time += end_time - start_time
+            self._completion_time += time.monotonic() - end_time
+        return result
 
-    # This is tricky to implement as we need to make sure that we don't hold a reference to the completed Future anymore.
-    # Indeed it's so tricky that older Python versions had the same problem. See https://bugs.python.org/issue27144.
+    # Results are yielded in completion order until all submitted jobs have been retrieved. If timeout is given and
+    # there are still outstanding jobs after timeout seconds, TimeoutError is raised. A timeout of zero only returns
+    # the results which are already available.
     def get_completed(self, timeout: int = None) -> Iterator[Any]:
-        for future in concurrent.futures.as_completed(self._futures, timeout=timeout):
-            self._futures.remove(future)
-            if not self._blocking_submit and not future.cancelled():
-                self._semaphore.release()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self._outstanding > 0:
+            self._max_completion_queue_depth = max(self._max_completion_queue_depth, self._completion_queue.qsize())
             try:
-                result = future.result()
-            except Exception as exception:
-                result = exception
-            del future
+                if deadline is None:
+                    entry = self._completion_queue.get()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        entry = self._completion_queue.get(timeout=remaining)
+                    else:
+                        entry = self._completion_queue.get_nowait()
+            except Empty:
+                raise TimeoutError('{} jobs still outstanding in job executor "{}".'.format(
+                    self._outstanding, self._name)) from None
+            result = self._retrieve(entry)
+            # Make sure we don't hold a reference to the result anymore when the consumer is done with it
+            del entry
             yield result
 
+    @property
+    def outstanding_jobs(self) -> int:
+        return self._outstanding
+
+    @property
+    def completion_queue_depth(self) -> int:
+        return self._completion_queue.qsize()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'jobs_submitted': self._jobs_submitted,
+            'jobs_completed': self._jobs_completed,
+            'jobs_cancelled': self._jobs_cancelled,
+            'jobs_outstanding': self._outstanding,
+            'completion_queue_depth': self._completion_queue.qsize(),
+            'max_completion_queue_depth': self._max_completion_queue_depth,
+            'queue_time': self._queue_time,
+            'run_time': self._run_time,
+            'completion_time': self._completion_time,
+        }
+
+    def log_stats(self) -> None:
+        if self._jobs_completed == 0:
+            return
+        logger.debug('Job executor "{}": {} jobs completed, {} cancelled, average queue time {:.3f}s, '
+                     'average run time {:.3f}s, average completion time {:.3f}s, '
+                     'maximum completion queue depth {}.'.format(self._name, self._jobs_completed,
+                                                                 self._jobs_cancelled,
+                                                                 self._queue_time / self._jobs_completed,
+                                                                 self._run_time / self._jobs_completed,
+                                                                 self._completion_time / self._jobs_completed,
+                                                                 self._max_completion_queue_depth))
+
     def shutdown(self) -> None:
-        if len(self._futures) > 0:
+        if self._outstanding > 0:
             logger.warning('Job executor "{}" is being shutdown with {} outstanding jobs, cancelling them.'.format(
-                self._name, len(self._futures)))
-            for future in self._futures:
-                future.cancel()
+                self._name, self._outstanding))
+            self._cancelled = True
+            # Get all results so that the semaphore gets released and still waiting jobs can complete
+            for _ in self.get_completed():
+                pass
             logger.debug('Job executor "{}" cancelled all outstanding jobs.'.format(self._name))
-            if not self._blocking_submit:
-                # Get all jobs so that the semaphore gets released and still waiting jobs can complete
-                for _ in self.get_completed():
-                    pass
-                logger.debug('Job executor "{}" read results for all outstanding jobs.'.format(self._name))
+        self.log_stats()
         self._executor.shutdown()
 
     def wait_for_all(self) -> None:
-        concurrent.futures.wait(self._futures)
+        with self._unfinished_condition:
+            self._unfinished_condition.wait_for(lambda: self._unfinished == 0)
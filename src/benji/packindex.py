@@ -0,0 +1,65 @@
+from typing import Optional, Sequence, Tuple, Iterable, Set, List
+
+from benji.database import DatabaseBackend, BlockUid, PackUid, PackLocation
+from benji.repr import ReprMixIn
+
+
+class PackIndex(ReprMixIn):
+    """ Locates the blocks of one storage which are stored inside of pack objects.
+
+    The authoritative list of the entries of each pack is stored in the storage alongside the pack itself. This index
+    mirrors these lists in the database so that a block can be found without consulting the storage and it can be
+    rebuilt from the storage at any time. All methods use the database session and must only be called from the thread
+    owning it.
+    """
+
+    def __init__(self, *, database_backend: DatabaseBackend, storage_id: int) -> None:
+        self._database_backend = database_backend
+        self._storage_id = storage_id
+        # Most storages will never contain any packs, this saves a database query per block in that case
+        self._has_packs: Optional[bool] = None
+
+    @property
+    def storage_id(self) -> int:
+        return self._storage_id
+
+    def _packs_present(self, refresh: bool = False) -> bool:
+        # Other processes can write the first pack at any time, so the absence of packs is only a hint
+        if self._has_packs is None or (refresh and not self._has_packs):
+            self._has_packs = self._database_backend.has_packs(self._storage_id)
+        return self._has_packs
+
+    def locate(self, uid: BlockUid, refresh: bool = False) -> Optional[PackLocation]:
+        """ Returns the location of a packed block or None if the block isn't packed. If refresh is true, the
+        database is queried again even if it didn't contain any packs before. This must be used before treating
+        a block which wasn't located as missing.
+        """
+        if not self._packs_present(refresh):
+            return None
+        return self._database_backend.get_pack_location(self._storage_id, uid)
+
+    def add_pack(self, pack_uid: PackUid, size: int, entries: Sequence[Tuple[BlockUid, int, int]]) -> None:
+        self._database_backend.add_pack(storage_id=self._storage_id, pack_uid=pack_uid, size=size, entries=entries)
+        self._has_packs = True
+
+    def is_pack_known(self, pack_uid: PackUid) -> bool:
+        return self._database_backend.is_pack_known(self._storage_id, pack_uid)
+
+    def packed_blocks(self, pack_uid: PackUid) -> List[Tuple[BlockUid, int, int]]:
+        return self._database_backend.get_packed_blocks(self._storage_id, pack_uid)
+
+    def remove(self, uids: Iterable[BlockUid]) -> Set[BlockUid]:
+        if not self._packs_present():
+            return set()
+        return self._database_backend.rm_packed_blocks(self._storage_id, uids)
+
+    def compaction_candidates(self, threshold: int) -> List[Tuple[PackUid, int, int]]:
+        if not self._packs_present():
+            return []
+        return self._database_backend.get_pack_compaction_candidates(self._storage_id, threshold)
+
+    def rm_pack(self, pack_uid: PackUid) -> None:
+        self._database_backend.rm_pack(self._storage_id, pack_uid)
+
+    def commit(self) -> None:
+        self._database_backend.commit()
@@ -0,0 +1,267 @@
+import time
+from concurrent.futures import CancelledError, TimeoutError
+from typing import Callable, Iterator, Any, Iterable, Optional, List, Dict
+
+from benji.exception import InternalError
+from benji.jobexecutor import JobExecutor
+from benji.logging import logger
+from benji.repr import ReprMixIn
+from benji.utils import MemoryBudgetLease
+
+
+class PipelineStage(ReprMixIn):
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        # Number of items submitted to and completed by this stage
+        self.submitted = 0
+        self.completed = 0
+        # Time the calling thread spent waiting for results of this stage
+        self.wait_time = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {'submitted': self.submitted, 'completed': self.completed, 'wait_time': self.wait_time}
+
+
+class ReadStage(PipelineStage):
+    """ The first stage of a pipeline. Each item is submitted to an asynchronous read operation of an I/O or storage
+    module and its result is passed on when it arrives.
+    """
+
+    def __init__(self, name: str, *, submit: Callable[[Any], None], get_completed: Callable[..., Iterator[Any]],
+                 item_size: Callable[[Any], int] = None) -> None:
+        super().__init__(name)
+        self.submit = submit
+        self.get_completed = get_completed
+        self.item_size = item_size
+        # Time spent waiting for the memory budget
+        self.budget_wait_time = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(super().stats(), budget_wait_time=self.budget_wait_time)
+
+
+class MapStage(PipelineStage):
+    """ Applies function to each result of the previous stage using a pool of worker threads. Results are passed on
+    in completion order. Exceptions raised by function are passed on instead of the result. Exceptions received
+    from the previous stage are passed through unchanged.
+    """
+
+    def __init__(self, name: str, *, function: Callable[[Any], Any], workers: int) -> None:
+        super().__init__(name)
+        self.function = function
+        self.workers = workers
+        self.executor_stats: Dict[str, Any] = {}
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(super().stats(), run_time=self.executor_stats.get('run_time', 0.0))
+
+
+class WriteStage(PipelineStage):
+    """ Items are submitted to this stage explicitly by the consumer of the pipeline with Pipeline.write. completed
+    is called in the calling thread for each finished write. Failed writes raise their exception.
+    """
+
+    def __init__(self, name: str, *, submit: Callable[..., None], get_completed: Callable[..., Iterator[Any]],
+                 completed: Callable[[Any], None]) -> None:
+        super().__init__(name)
+        self.submit = submit
+        self.get_completed = get_completed
+        self.completed_callback = completed
+
+
+class Pipeline(ReprMixIn):
+    """ Streams items through a read stage, any number of map stages and an optional write stage.
+
+    Pipeline.run yields the results of the last map stage (or of the read stage if there are no map stages) to the
+    consumer which runs in the calling thread. The consumer does everything which needs the database session and
+    can hand data on to the write stage. At most window items are in flight in the read stage, the map stages have
+    bounded queues, and if a memory budget lease is given the read stage acquires item_size(item) bytes before
+    submitting an item. The consumer and the write stage's completion callback are responsible for releasing them.
+    While the budget is exhausted, the pipeline waits for results of later stages instead of reading more data.
+
+    When the pipeline has run to completion, the number of submitted and completed items is checked for each stage
+    and the time spent in each stage is logged.
+    """
+
+    def __init__(self, name: str, *, window: int, lease: MemoryBudgetLease = None) -> None:
+        self.name = name
+        self._window = window
+        self._lease = lease
+        self._read_stage: Optional[ReadStage] = None
+        self._map_stages: List[MapStage] = []
+        self._write_stage: Optional[WriteStage] = None
+        # Time the consumer spent processing results
+        self._consumer_time = 0.0
+
+    def read_stage(self, name: str, **kwargs) -> 'Pipeline':
+        assert self._read_stage is None
+        self._read_stage = ReadStage(name, **kwargs)
+        return self
+
+    def map_stage(self, name: str, **kwargs) -> 'Pipeline':
+        self._map_stages.append(MapStage(name, **kwargs))
+        return self
+
+    def write_stage(self, name: str, **kwargs) -> 'Pipeline':
+        assert self._write_stage is None
+        self._write_stage = WriteStage(name, **kwargs)
+        return self
+
+    @property
+    def _budget_exhausted(self) -> bool:
+        return self._lease is not None and self._lease.exhausted
+
+    def _read(self, items: Iterable[Any]) -> Iterator[Any]:
+        stage = self._read_stage
+        assert stage is not None
+        window = self._window
+
+        def completed() -> Iterator[Any]:
+            t1 = time.time()
+            for result in stage.get_completed():
+                stage.completed += 1
+                stage.wait_time += time.time() - t1
+                yield result
+                t1 = time.time()
+
+        for item in items:
+            if stage.submitted - stage.completed >= window:
+                for result in completed():
+                    yield result
+                    if stage.submitted - stage.completed <= window // 2:
+                        break
+            if self._lease is not None and stage.item_size is not None:
+                size = stage.item_size(item)
+                if not self._lease.try_acquire(size):
+                    t1 = time.time()
+                    while stage.submitted - stage.completed > 0 and not self._lease.try_acquire(size):
+                        for result in completed():
+                            yield result
+                            break
+                    # When nothing is in flight anymore, the memory is held by the consumer itself and waiting
+                    # for it would deadlock, so the item is admitted regardless.
+                    if stage.submitted == stage.completed:
+                        self._lease.charge(size)
+                    duration = time.time() - t1
+                    stage.budget_wait_time += duration
+                    self._lease.record_wait(stage.name, duration)
+            stage.submit(item)
+            stage.submitted += 1
+
+        yield from completed()
+
+    def _map(self, stage: MapStage, entries: Iterator[Any]) -> Iterator[Any]:
+        executor = JobExecutor(name=stage.name, workers=stage.workers, blocking_submit=True)
+        try:
+            for entry in entries:
+                if isinstance(entry, BaseException):
+                    yield entry
+                    continue
+
+                executor.submit(lambda entry=entry: stage.function(entry))
+                stage.submitted += 1
+
+                if self._budget_exhausted:
+                    # Give the consumer a chance to release memory before more entries are taken
+                    t1 = time.time()
+                    for result in executor.get_completed():
+                        stage.completed += 1
+                        stage.wait_time += time.time() - t1
+                        yield result
+                        if not self._budget_exhausted:
+                            break
+                        t1 = time.time()
+                else:
+                    try:
+                        for result in executor.get_completed(timeout=0):
+                            stage.completed += 1
+                            yield result
+                    except (TimeoutError, CancelledError):
+                        pass
+
+            t1 = time.time()
+            for result in executor.get_completed():
+                stage.completed += 1
+                stage.wait_time += time.time() - t1
+                yield result
+                t1 = time.time()
+        finally:
+            # This will also cancel any outstanding jobs if we were interrupted
+            executor.shutdown()
+            stage.executor_stats = executor.stats()
+
+    def write(self, *args, **kwargs) -> None:
+        stage = self._write_stage
+        assert stage is not None
+        stage.submit(*args, **kwargs)
+        stage.submitted += 1
+        self.process_writes()
+
+    def process_writes(self, wait: bool = False) -> None:
+        """ Processes finished writes. If wait is True, this waits for all outstanding writes. Otherwise it only waits
+        while the memory budget is exhausted.
+        """
+        stage = self._write_stage
+        if stage is None or stage.submitted == stage.completed:
+            return
+
+        wait_for_budget = not wait and self._budget_exhausted
+        t1 = time.time()
+        try:
+            for result in stage.get_completed(timeout=None if wait or wait_for_budget else 0):
+                stage.completed += 1
+                stage.wait_time += time.time() - t1
+                if isinstance(result, Exception):
+                    raise result
+                stage.completed_callback(result)
+                if wait_for_budget and not self._budget_exhausted:
+                    break
+                t1 = time.time()
+        except (TimeoutError, CancelledError):
+            pass
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        results = self._read(items)
+        for stage in self._map_stages:
+            results = self._map(stage, results)
+
+        for result in results:
+            t1 = time.time()
+            yield result
+            self._consumer_time += time.time() - t1
+            self.process_writes()
+        self.process_writes(wait=True)
+
+        self._check()
+        self.log_stats()
+
+    def _stages(self) -> List[PipelineStage]:
+        stages: List[PipelineStage] = [self._read_stage] if self._read_stage is not None else []
+        stages.extend(self._map_stages)
+        if self._write_stage is not None:
+            stages.append(self._write_stage)
+        return stages
+
+    def _check(self) -> None:
+        for stage in self._stages():
+            if stage.submitted != stage.completed:
+                raise InternalError('Number of submitted and completed jobs of pipeline stage {} inconsistent '
+                                    '(submitted: {}, completed {}).'.format(stage.name, stage.submitted,
+                                                                            stage.completed))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {stage.name: stage.stats() for stage in self._stages()}
+        stats['consumer'] = {'time': self._consumer_time}
+        return stats
+
+    @staticmethod
+    def _format_stat(key: str, value: Any) -> str:
+        return '{} {}'.format(key.replace('_', ' '), '{:.2f}s'.format(value) if isinstance(value, float) else value)
+
+    def log_stats(self) -> None:
+        for stage in self._stages():
+            logger.debug('Pipeline {}, stage {}: {}.'.format(
+                self.name, stage.name,
+                ', '.join([self._format_stat(key, value) for key, value in stage.stats().items()])))
+        logger.debug('Pipeline {}, consumer: {:.2f}s.'.format(self.name, self._consumer_time))
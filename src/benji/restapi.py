@@ -1,5 +1,6 @@
 import functools
 import json
+from contextlib import ExitStack
 from io import StringIO
 from typing import List, Optional
 
@@ -11,7 +12,7 @@ import benji.exception
 from benji import __version__
 from benji.benji import Benji
 from benji.database import Version, VersionUid
-from benji.utils import hints_from_rbd_diff, InputValidation
+from benji.utils import hints_from_rbd_diff_file, InputValidation
 from benji.versions import VERSIONS
 
 
@@ -112,7 +113,8 @@ class RestAPI:
     def _backup(self, version_name: fields.Str(required=True), snapshot_name: fields.Str(required=True),
                 source: fields.Str(required=True), rbd_hints: fields.Str(missing=None),
                 base_version_uid: fields.Str(missing=None), block_size: fields.Int(missing=None),
-                labels: fields.DelimitedList(fields.Str(), missing=None), storage_name: fields.Str(missing=None)) -> str:
+                labels: fields.DelimitedList(fields.Str(), missing=None), storage_name: fields.Str(missing=None),
+                generate_hints: fields.Bool(missing=False)) -> str:
         # Validate version_name and snapshot_name
         if not InputValidation.is_backup_name(version_name):
             raise benji.exception.UsageError('Version name {} is invalid.'.format(version_name))
@@ -124,12 +126,17 @@ class RestAPI:
         benji_obj = None
         try:
             benji_obj = Benji(self._config, block_size=block_size)
-            hints = None
-            if rbd_hints:
-                with open(rbd_hints, 'r') as f:
-                    hints = hints_from_rbd_diff(f.read())
-            backup_version = benji_obj.backup(version_name, snapshot_name, source, hints, base_version_uid_obj,
-                                              storage_name)
+            with ExitStack() as stack:
+                hints = None
+                if rbd_hints:
+                    hints = hints_from_rbd_diff_file(stack.enter_context(open(rbd_hints, 'r')))
+                backup_version = benji_obj.backup(version_name,
+                                                  snapshot_name,
+                                                  source,
+                                                  hints,
+                                                  base_version_uid_obj,
+                                                  storage_name,
+                                                  generate_hints=generate_hints)
 
             result = StringIO()
             benji_obj.export_any({'versions': [backup_version]},
@@ -4,7 +4,9 @@
 
 import argparse
 import os
+import signal
 import sys
+import threading
 from functools import partial
 from typing import NamedTuple, Type, Optional
 
@@ -37,6 +39,48 @@ def integer_range(minimum: int, maximum: int, arg: str) -> Optional[int]:
     return value
 
 
+def _install_io_throttling_reload(config_file: Optional[str]) -> None:
+    """ On SIGHUP the configuration is read again and the bandwidth and IOPS limits of all I/O modules are updated.
+    This can be used to adjust the limits of a running backup or restore.
+    """
+    from benji.config import Config
+    from benji.factory import IOFactory
+    from benji.logging import logger
+
+    def reload() -> None:
+        try:
+            if config_file is not None and config_file != '':
+                with open(config_file, 'r', encoding='utf-8') as f:
+                    config = Config(ad_hoc_config=f.read())
+            else:
+                config = Config()
+            IOFactory.update_throttling(config)
+        except Exception as exception:
+            logger.error('Reloading the I/O limits failed: {}'.format(exception))
+        else:
+            logger.info('Reloaded the I/O limits.')
+
+    # The signal handler interrupts the main thread at an arbitrary point and must not take any locks itself. So it
+    # only writes to a pipe and the actual reload is done by a long-lived thread waiting on the other end.
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
+
+    def reload_loop() -> None:
+        while True:
+            os.read(read_fd, 1)
+            reload()
+
+    def handler(signum, frame) -> None:
+        try:
+            os.write(write_fd, b'\0')
+        except BlockingIOError:
+            # A reload is already pending
+            pass
+
+    threading.Thread(target=reload_loop, name='Reload-IO-Limits', daemon=True).start()
+    signal.signal(signal.SIGHUP, handler)
+
+
 def main():
     if sys.hexversion < 0x030600F0:
         raise InternalError('Benji only supports Python 3.6 or above.')
@@ -76,10 +120,23 @@ def main():
                    default=None,
                    help='Labels for this version (can be repeated)')
     p.add_argument('-S', '--storage', default='', help='Destination storage (if unspecified the default is used)')
+    p.add_argument('-g',
+                   '--generate-hints',
+                   action='store_true',
+                   default=False,
+                   help='Let the I/O module generate hints even if its configuration doesn\'t enable this')
     p.add_argument('source', help='Source URL')
     p.add_argument('version_name', help='Backup version name (e.g. the hostname)')
     p.set_defaults(func='backup')
 
+    # BATCH-BACKUP
+    p = subparsers_root.add_parser('batch-backup',
+                                   help='Perform multiple backups sequentially in one process',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-b', '--block-size', type=int, default=None, help='Block size in bytes')
+    p.add_argument('jobs_file', help='Backup jobs in JSON format')
+    p.set_defaults(func='batch_backup')
+
     # BATCH-DEEP-SCRUB
     p = subparsers_root.add_parser('batch-deep-scrub',
                                    help='Check data and metadata integrity of multiple versions at once',
@@ -296,6 +353,8 @@ def main():
     if sys.hexversion < 0x030604F0:
         logger.warning('The installed Python version will use excessive amounts of memory when used with Benji. Upgrade Python to at least 3.6.4.')
 
+    _install_io_throttling_reload(args.config_file)
+
     import benji.commands
     commands = benji.commands.Commands(args.machine_output, config)
     func = getattr(commands, args.func)
@@ -0,0 +1,39 @@
+"""Add packs
+
+Revision ID: d4f1c9a2b7e3
+Revises: 368014edd88c
+Create Date: 2019-05-06 14:02:31.514230
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'd4f1c9a2b7e3'
+down_revision = '368014edd88c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('packs', sa.Column('storage_id', sa.Integer(), nullable=False),
+                    sa.Column('uid', sa.String(length=32), nullable=False),
+                    sa.Column('size', sa.BigInteger(), nullable=False),
+                    sa.Column('date', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('storage_id', 'uid', name=op.f('pk_packs')))
+    op.create_table('packed_blocks', sa.Column('storage_id', sa.Integer(), nullable=False),
+                    sa.Column('uid_left', sa.Integer(), nullable=False),
+                    sa.Column('uid_right', sa.Integer(), nullable=False),
+                    sa.Column('pack_uid', sa.String(length=32), nullable=False),
+                    sa.Column('offset', sa.BigInteger(), nullable=False),
+                    sa.Column('length', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['storage_id', 'pack_uid'], ['packs.storage_id', 'packs.uid'],
+                                            name=op.f('fk_packed_blocks_storage_id_packs'),
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('storage_id', 'uid_left', 'uid_right', name=op.f('pk_packed_blocks')))
+    with op.batch_alter_table('packed_blocks', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_packed_blocks_storage_id'), ['storage_id', 'pack_uid'], unique=False)
+
+
+def downgrade():
+    pass
@@ -3,7 +3,7 @@
 import logging
 import random
 import time
-from typing import Any, Union, Iterable, Tuple
+from typing import Any, Union, Iterable, Tuple, Sequence, List
 
 import b2
 import b2.api
@@ -105,6 +105,28 @@ class Storage(ReadCacheStorageBase):
 
         return data_io.get_bytes_written()
 
+    def _read_object_range(self, key: str, offset: int, length: int) -> bytes:
+        for i in range(self._read_object_attempts):
+            data_io = DownloadDestBytes()
+            try:
+                self.bucket.download_file_by_name(key, data_io, range_=(offset, offset + length - 1))
+            except (B2Error, B2ConnectionError) as exception:
+                if isinstance(exception, FileNotPresent):
+                    raise FileNotFoundError('Object {} not found.'.format(key)) from None
+                else:
+                    if i + 1 < self._read_object_attempts:
+                        sleep_time = (2**(i + 1)) + (random.randint(0, 1000) / 1000)
+                        logger.warning(
+                            'Download of object with key {} to B2 failed, will try again in {:.2f} seconds.'.format(
+                                key, sleep_time))
+                        time.sleep(sleep_time)
+                        continue
+                    raise
+            else:
+                break
+
+        return data_io.get_bytes_written()
+
     def _file_info(self, key: str) -> Any:
         r = self.bucket.list_file_names(key, 1)
         for entry in r['files']:
@@ -145,17 +167,16 @@ class Storage(ReadCacheStorageBase):
             else:
                 raise
 
-    # def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
-    #     """ Deletes many keys from the storage and returns a list of keys that couldn't be deleted.
-    #     """
-    #     errors = []
-    #     for key in keys:
-    #         try:
-    #             file_version_info = self._file_info(key)
-    #             self.bucket.delete_file_version(file_version_info.id_, file_version_info.file_name)
-    #         except (B2Error, FileNotFoundError):
-    #             errors.append(key)
-    #     return errors
+    def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
+        # B2 has no call to delete many files at once, the batches are removed in parallel by the removal threads
+        errors: List[str] = []
+        for key in keys:
+            try:
+                file_version_info = self._file_info(key)
+                self.bucket.delete_file_version(file_version_info.id_, file_version_info.file_name)
+            except (B2Error, FileNotFoundError):
+                errors.append(key)
+        return errors
 
     def _list_objects(self, prefix: str = None,
                       include_size: bool = False) -> Union[Iterable[str], Iterable[Tuple[str, int]]]:
@@ -4,22 +4,28 @@ import base64
 import datetime
 import json
 import os
+import struct
 import threading
 import time
 from abc import ABCMeta, abstractmethod
-from typing import Union, Optional, Dict, Tuple, List, Sequence, cast, Iterator, Iterable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Union, Optional, Dict, Tuple, List, Sequence, cast, Iterator, Iterable, AbstractSet, NamedTuple, \
+    Deque
 
 import semantic_version
 from benji.config import Config, ConfigDict
-from benji.database import VersionUid, DereferencedBlock, BlockUid, Block
+from benji.database import VersionUid, DereferencedBlock, BlockUid, Block, PackUid, PackLocation
 from benji.exception import ConfigurationError, BenjiException
 from benji.factory import TransformFactory
 from benji.jobexecutor import JobExecutor
 from benji.logging import logger
+from benji.packindex import PackIndex
 from benji.repr import ReprMixIn
 from benji.storage.dicthmac import DictHMAC
+from benji.storage.metadatacodec import MetadataCodec
 from benji.transform.base import TransformBase
-from benji.utils import TokenBucket, derive_key
+from benji.utils import TokenBucket, derive_key, memory_budget
 from benji.versions import VERSIONS
 from diskcache import FanoutCache
 
@@ -48,6 +54,20 @@ class BlockNotFoundError(BenjiException, IOError):
         return self._uid
 
 
+class _UnlocatedRead(NamedTuple):
+    # A read of a block which wasn't found inside of a pack and whose separate object doesn't exist
+    block: DereferencedBlock
+    metadata_only: bool
+    exception: InvalidBlockException
+
+
+class _WrittenPack(NamedTuple):
+    uid: PackUid
+    size: int
+    entries: List[Tuple[BlockUid, int, int]]
+    blocks: List[DereferencedBlock]
+
+
 class StorageBase(ReprMixIn, metaclass=ABCMeta):
 
     _CHECKSUM_KEY = 'checksum'
@@ -56,11 +76,22 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
     _HMAC_KEY = 'hmac'
     _METADATA_VERSION_KEY = 'metadata_version'
     _OBJECT_SIZE_KEY = 'object_size'
+    _PACK_ENTRIES_KEY = 'pack_entries'
     _SIZE_KEY = 'size'
     _TRANSFORMS_KEY = 'transforms'
 
     _META_SUFFIX = '.meta'
 
+    # Number of objects removed by one call to _rm_many_objects
+    _RM_MANY_OBJECTS_BATCH_SIZE = 100
+
+    # A block is stored as a single object consisting of a header, its metadata and its encapsulated data. The header
+    # contains a magic number and the length of the metadata. The entries of a pack use the same format.
+    _BLOCK_OBJECT_MAGIC = b'BNJ\x01'
+    _BLOCK_OBJECT_HEADER = struct.Struct('!4sI')
+    # Number of bytes read from the start of a block object when only its metadata is needed
+    _BLOCK_OBJECT_HEAD_LENGTH = 4096
+
     def __init__(self, *, config: Config, name: str, storage_id: int, module_configuration: ConfigDict) -> None:
         self._name = name
         self._storage_id = storage_id
@@ -80,6 +111,20 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         bandwidth_read = Config.get_from_dict(module_configuration, 'bandwidthRead', types=int)
         bandwidth_write = Config.get_from_dict(module_configuration, 'bandwidthWrite', types=int)
 
+        self._pack_size = Config.get_from_dict(module_configuration, 'packSize', types=int)
+        self._pack_compaction_threshold = Config.get_from_dict(module_configuration,
+                                                               'packCompactionThreshold',
+                                                               types=int)
+        # Set by StorageFactory when a database backend is available, see set_pack_index()
+        self._pack_index: Optional[PackIndex] = None
+        # The pack currently being filled by the write threads, protected by _pack_lock
+        self._pack_lock = threading.Lock()
+        self._pack_data = bytearray()
+        self._pack_entries: List[Tuple[BlockUid, int, int]] = []
+        self._pack_blocks: List[DereferencedBlock] = []
+        # Written blocks whose results haven't been retrieved by write_get_completed yet
+        self._completed_writes: Deque[Union[DereferencedBlock, BaseException]] = deque()
+
         self._consistency_check_writes = Config.get_from_dict(module_configuration,
                                                               'consistencyCheckWrites',
                                                               False,
@@ -98,10 +143,12 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
                                       password=hmac_password)
         else:
             hmac_key = base64.b64decode(hmac_key_encoded)
+        # DictHMAC is only used to verify object metadata written in the legacy JSON format
         self._dict_hmac: Optional[DictHMAC] = None
         if hmac_key is not None:
             logger.info('Enabling HMAC object metadata integrity protection for storage {}.'.format(name))
             self._dict_hmac = DictHMAC(hmac_key=self._HMAC_KEY, secret_key=hmac_key)
+        self._metadata_codec = MetadataCodec(secret_key=hmac_key)
 
         self.read_throttling = TokenBucket()
         self.read_throttling.set_rate(bandwidth_read)  # 0 disables throttling
@@ -111,6 +158,15 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         self._read_executor = JobExecutor(name='Storage-Read', workers=simultaneous_reads, blocking_submit=False)
         self._write_executor = JobExecutor(name='Storage-Write', workers=simultaneous_writes, blocking_submit=True)
         self._remove_executor = JobExecutor(name='Storage-Remove', workers=simultaneous_removals, blocking_submit=True)
+        # Fetches the separate metadata objects of blocks written by older versions concurrently to their data
+        self._legacy_metadata_executor = ThreadPoolExecutor(max_workers=simultaneous_reads,
+                                                            thread_name_prefix='Storage-Read-Metadata')
+        # The left part of a block UID is the UID of the version which wrote the block object. All blocks written
+        # for one version have the same layout, so the layout seen last is remembered per writing version. This is
+        # still correct for versions referencing blocks written before and after an upgrade, for example after a
+        # differential backup.
+        self._legacy_layouts: Dict[int, bool] = {}
+        self._legacy_layouts_lock = threading.Lock()
 
     @property
     def name(self) -> str:
@@ -120,12 +176,21 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
     def storage_id(self) -> int:
         return self._storage_id
 
+    def set_pack_index(self, pack_index: PackIndex) -> None:
+        self._pack_index = pack_index
+
+    @property
+    def _packing(self) -> bool:
+        # Packs are only written when enabled, but blocks inside of existing packs can always be read
+        return self._pack_size > 0 and self._pack_index is not None
+
     def _build_metadata(self,
                         *,
                         size: int,
                         object_size: int,
                         transforms_metadata: List[Dict] = None,
-                        checksum: str = None) -> Tuple[Dict, bytes]:
+                        checksum: str = None,
+                        pack_entries: List[List[int]] = None) -> Tuple[Dict, bytes]:
 
         timestamp = datetime.datetime.utcnow().isoformat(timespec='microseconds')
         metadata: Dict = {
@@ -142,16 +207,19 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         if transforms_metadata:
             metadata[self._TRANSFORMS_KEY] = transforms_metadata
 
-        if self._dict_hmac:
-            self._dict_hmac.add_digest(metadata)
-
-        return metadata, json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+        if pack_entries is not None:
+            metadata[self._PACK_ENTRIES_KEY] = pack_entries
 
-    def _decode_metadata(self, *, metadata_json: bytes, key: str, data_length: int) -> Dict:
-        metadata = json.loads(metadata_json.decode('utf-8'))
+        return metadata, self._metadata_codec.encode(metadata)
 
-        if self._dict_hmac:
-            self._dict_hmac.verify_digest(metadata)
+    def _decode_metadata(self, *, metadata_bytes: bytes, key: str, data_length: int) -> Dict:
+        if MetadataCodec.is_encoded(metadata_bytes):
+            metadata = self._metadata_codec.decode(metadata_bytes)
+        else:
+            # Legacy JSON format
+            metadata = json.loads(metadata_bytes.decode('utf-8'))
+            if self._dict_hmac:
+                self._dict_hmac.verify_digest(metadata)
 
         # We currently support only one object metadata version
         if self._METADATA_VERSION_KEY not in metadata:
@@ -173,31 +241,117 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
 
     def _check_write(self, *, key: str, metadata_key: str, data_expected: bytes) -> None:
         data_actual = self._read_object(key)
-        metadata_actual_json = self._read_object(metadata_key)
+        metadata_actual_bytes = self._read_object(metadata_key)
 
         # Return value is ignored
-        self._decode_metadata(metadata_json=metadata_actual_json, key=key, data_length=len(data_actual))
+        self._decode_metadata(metadata_bytes=metadata_actual_bytes, key=key, data_length=len(data_actual))
 
         # Comparing encapsulated data here
         if data_expected != data_actual:
             raise ValueError('Written and read data of {} differ.'.format(key))
 
     def _write(self, block: DereferencedBlock, data: bytes) -> DereferencedBlock:
-        data, transforms_metadata = self._encapsulate(data)
+        encapsulated_data, transforms_metadata = self._encapsulate(data)
+        # The transformed data only exists while the object is written. This must not wait for the budget as
+        # the memory is probably held by the caller waiting for us.
+        transformed_size = len(encapsulated_data) if encapsulated_data is not data else 0
+        memory_budget.charge(transformed_size)
+        try:
+            return self._write_encapsulated(block, encapsulated_data, transforms_metadata)
+        finally:
+            memory_budget.release(transformed_size)
+
+    def _build_block_object(self, block: DereferencedBlock, data: bytes, transforms_metadata: List[Dict]) -> bytes:
+        metadata, metadata_bytes = self._build_metadata(size=block.size,
+                                                        object_size=len(data),
+                                                        checksum=block.checksum,
+                                                        transforms_metadata=transforms_metadata)
+        return b''.join(
+            (self._BLOCK_OBJECT_HEADER.pack(self._BLOCK_OBJECT_MAGIC, len(metadata_bytes)), metadata_bytes, data))
+
+    def _block_object_metadata_length(self, head: bytes) -> Optional[int]:
+        # Returns None for objects written by older versions. These only contain the data and their metadata is
+        # stored in a separate object.
+        if len(head) < self._BLOCK_OBJECT_HEADER.size:
+            return None
+        magic, metadata_length = self._BLOCK_OBJECT_HEADER.unpack_from(head)
+        return metadata_length if magic == self._BLOCK_OBJECT_MAGIC else None
+
+    def _split_block_object(self, *, block_object: bytes, key: str) -> Tuple[bytes, bytes]:
+        metadata_length = self._block_object_metadata_length(block_object)
+        if metadata_length is None:
+            raise ValueError('Object {} has an invalid header.'.format(key))
+        data_offset = self._BLOCK_OBJECT_HEADER.size + metadata_length
+        if data_offset > len(block_object):
+            raise ValueError('Object {} is truncated. Expected at least {} bytes, got {}.'.format(
+                key, data_offset, len(block_object)))
+        return block_object[self._BLOCK_OBJECT_HEADER.size:data_offset], block_object[data_offset:]
+
+    def _check_write_block_object(self, *, key: str, block_object_expected: bytes) -> None:
+        block_object_actual = self._read_object(key)
+        metadata_bytes, data = self._split_block_object(block_object=block_object_actual, key=key)
+
+        # Return value is ignored
+        self._decode_metadata(metadata_bytes=metadata_bytes, key=key, data_length=len(data))
 
-        metadata, metadata_json = self._build_metadata(size=block.size,
-                                                       object_size=len(data),
-                                                       checksum=block.checksum,
-                                                       transforms_metadata=transforms_metadata)
+        if block_object_expected != block_object_actual:
+            raise ValueError('Written and read data of {} differ.'.format(key))
 
+    def _write_encapsulated(self, block: DereferencedBlock, data: bytes,
+                            transforms_metadata: List[Dict]) -> DereferencedBlock:
+        block_object = self._build_block_object(block, data, transforms_metadata)
         key = block.uid.storage_object_to_path()
+
+        # Like in _write this must not wait for the budget
+        memory_budget.charge(len(block_object))
+        try:
+            time.sleep(self.write_throttling.consume(len(block_object)))
+            t1 = time.time()
+            try:
+                self._write_object(key, block_object)
+            except:
+                try:
+                    self._rm_object(key)
+                except FileNotFoundError:
+                    pass
+                raise
+            t2 = time.time()
+
+            logger.debug('{} wrote data of uid {} in {:.3f}s'.format(threading.current_thread().name, block.uid,
+                                                                     t2 - t1))
+
+            if self._consistency_check_writes:
+                try:
+                    self._check_write_block_object(key=key, block_object_expected=block_object)
+                except (KeyError, ValueError) as exception:
+                    raise InvalidBlockException(
+                        'Check write of block {} (UID {}) failed.'.format(block.id, block.uid), block) from exception
+        finally:
+            memory_budget.release(len(block_object))
+
+        return block
+
+    def _pack_entry(self, block: DereferencedBlock, data: bytes) -> bytes:
+        encapsulated_data, transforms_metadata = self._encapsulate(data)
+        return self._build_block_object(block, encapsulated_data, transforms_metadata)
+
+    def _write_pack(self, data: bytes, entries: List[Tuple[BlockUid, int, int]],
+                    blocks: List[DereferencedBlock]) -> _WrittenPack:
+        pack_uid = PackUid.new()
+        # The list of entries is stored alongside the pack so that the pack index can be rebuilt from the storage
+        metadata, metadata_bytes = self._build_metadata(
+            size=len(data),
+            object_size=len(data),
+            pack_entries=[[uid.left, uid.right, offset, length] for uid, offset, length in entries])
+
+        key = pack_uid.storage_object_to_path()
         metadata_key = key + self._META_SUFFIX
 
-        time.sleep(self.write_throttling.consume(len(data) + len(metadata_json)))
+        time.sleep(self.write_throttling.consume(len(data) + len(metadata_bytes)))
         t1 = time.time()
         try:
             self._write_object(key, data)
-            self._write_object(metadata_key, metadata_json)
+            self._write_object(metadata_key, metadata_bytes)
         except:
             try:
                 self._rm_object(key)
@@ -207,56 +361,204 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
             raise
         t2 = time.time()
 
-        logger.debug('{} wrote data of uid {} in {:.3f}s'.format(threading.current_thread().name, block.uid, t2 - t1))
+        logger.debug('{} wrote pack {} with {} blocks in {:.3f}s'.format(threading.current_thread().name, pack_uid,
+                                                                        len(entries), t2 - t1))
 
         if self._consistency_check_writes:
-            try:
-                self._check_write(key=key, metadata_key=metadata_key, data_expected=data)
-            except (KeyError, ValueError) as exception:
-                raise InvalidBlockException('Check write of block {} (UID {}) failed.'.format(block.id, block.uid),
-                                            block) from exception
+            self._check_write(key=key, metadata_key=metadata_key, data_expected=data)
 
-        return block
+        return _WrittenPack(uid=pack_uid, size=len(data), entries=entries, blocks=blocks)
+
+    def _take_pack(self) -> Tuple[bytes, List[Tuple[BlockUid, int, int]], List[DereferencedBlock]]:
+        # Must be called with _pack_lock held
+        pack = (bytes(self._pack_data), self._pack_entries, self._pack_blocks)
+        self._pack_data = bytearray()
+        self._pack_entries = []
+        self._pack_blocks = []
+        return pack
+
+    def _write_taken_pack(self, data: bytes, entries: List[Tuple[BlockUid, int, int]],
+                          blocks: List[DereferencedBlock]) -> _WrittenPack:
+        try:
+            return self._write_pack(data, entries, blocks)
+        finally:
+            memory_budget.release(len(data))
+
+    def _write_packed(self, block: DereferencedBlock, data: bytes) -> Optional[_WrittenPack]:
+        entry = self._pack_entry(block, data)
+        # The entry is kept in memory until its pack is written. Like in _write this must not wait for the budget.
+        memory_budget.charge(len(entry))
+        with self._pack_lock:
+            self._pack_entries.append((block.uid, len(self._pack_data), len(entry)))
+            self._pack_blocks.append(block)
+            self._pack_data += entry
+            if len(self._pack_data) < self._pack_size:
+                return None
+            pack = self._take_pack()
+        return self._write_taken_pack(*pack)
+
+    def _flush_pack(self) -> Optional[_WrittenPack]:
+        with self._pack_lock:
+            if not self._pack_entries:
+                return None
+            pack = self._take_pack()
+        return self._write_taken_pack(*pack)
 
     def write_block_async(self, block: Union[DereferencedBlock, Block], data: bytes) -> None:
         block_deref = block.deref() if isinstance(block, Block) else block
 
-        def job():
-            return self._write(block_deref, data)
+        if self._packing:
+
+            def job():
+                return self._write_packed(block_deref, data)
+        else:
+
+            def job():
+                return self._write(block_deref, data)
 
         self._write_executor.submit(job)
 
     def write_block(self, block: Union[DereferencedBlock, Block], data: bytes) -> None:
+        # Single blocks are always written as separate objects, there is nothing to pack them with
         block_deref = block.deref() if isinstance(block, Block) else block
         self._write(block_deref, data)
 
+    def _write_get_completed_packed(self, timeout: Optional[int]) -> Iterator[Union[DereferencedBlock, BaseException]]:
+        assert self._pack_index is not None
+        while True:
+            while self._completed_writes:
+                yield self._completed_writes.popleft()
+
+            if self._write_executor.outstanding_jobs == 0:
+                with self._pack_lock:
+                    pack_empty = not self._pack_entries
+                if timeout == 0 or pack_empty:
+                    return
+                # Nothing else is going to fill up the current pack while we're waiting, so write it out now
+                self._write_executor.submit(self._flush_pack)
+
+            # Results are buffered as the consumer might stop iterating at any time
+            for result in self._write_executor.get_completed(timeout=timeout):
+                if isinstance(result, BaseException):
+                    self._completed_writes.append(result)
+                elif result is not None:
+                    # The pack index is updated here as the write threads must not use the database session
+                    self._pack_index.add_pack(result.uid, result.size, result.entries)
+                    self._completed_writes.extend(result.blocks)
+                if self._completed_writes:
+                    break
+
     def write_get_completed(self, timeout: int = None) -> Iterator[Union[DereferencedBlock, BaseException]]:
+        if self._packing:
+            # Blocks are only completed when their pack has been written. Writes of blocks which are still waiting
+            # for their pack to fill up are outstanding, so waiting for all writes forces out the current pack.
+            return self._write_get_completed_packed(timeout)
         return self._write_executor.get_completed(timeout=timeout)
 
-    def _read(self, block: DereferencedBlock, metadata_only: bool) -> Tuple[DereferencedBlock, Optional[bytes], Dict]:
-        key = block.uid.storage_object_to_path()
-        metadata_key = key + self._META_SUFFIX
+    def _read(self,
+              block: DereferencedBlock,
+              metadata_only: bool,
+              location: PackLocation = None) -> Tuple[DereferencedBlock, Optional[bytes], Dict]:
         data: Optional[bytes] = None
-        try:
-            t1 = time.time()
-            if not metadata_only:
-                data = self._read_object(key)
-                data_length = len(data)
-            else:
-                data_length = self._read_object_length(key)
-            metadata_json = self._read_object(metadata_key)
-            time.sleep(self.read_throttling.consume(len(data) if data else 0 + len(metadata_json)))
-            t2 = time.time()
-        except FileNotFoundError as exception:
-            raise InvalidBlockException(
-                'Object metadata or data of block {} (UID{}) not found.'.format(block.id, block.uid),
-                block) from exception
+        metadata: Optional[Dict] = None
+        if location is not None:
+            key = location.pack_uid.storage_object_to_path()
+            try:
+                t1 = time.time()
+                # The entry contains the metadata, so this is a single ranged read even when only the metadata is needed
+                entry = self._read_object_range(key, location.offset, location.length)
+                time.sleep(self.read_throttling.consume(len(entry)))
+                t2 = time.time()
+            except FileNotFoundError as exception:
+                raise InvalidBlockException(
+                    'Pack {} of block {} (UID {}) not found.'.format(location.pack_uid, block.id, block.uid),
+                    block) from exception
 
-        try:
-            metadata = self._decode_metadata(metadata_json=metadata_json, key=key, data_length=data_length)
-        except (KeyError, ValueError) as exception:
-            raise InvalidBlockException('Object metadata of block {} (UID{}) is invalid.'.format(block.id, block.uid),
-                                        block) from exception
+            try:
+                metadata_bytes, data = self._split_block_object(block_object=entry, key=key)
+            except ValueError as exception:
+                raise InvalidBlockException('Pack entry of block {} (UID {}) is invalid.'.format(block.id, block.uid),
+                                            block) from exception
+            data_length = len(data)
+            if metadata_only:
+                data = None
+        else:
+            key = block.uid.storage_object_to_path()
+            legacy_metadata_future: Optional[Future] = None
+            with self._legacy_layouts_lock:
+                legacy_layout_likely = self._legacy_layouts.get(block.uid.left, False)
+            try:
+                t1 = time.time()
+                if legacy_layout_likely:
+                    legacy_metadata_future = self._legacy_metadata_executor.submit(self._read_object,
+                                                                                   key + self._META_SUFFIX)
+                if not metadata_only:
+                    head = self._read_object(key)
+                    object_length = len(head)
+                else:
+                    head, object_length = self._read_object_head(key, self._BLOCK_OBJECT_HEAD_LENGTH)
+                read_length = len(head)
+                inline_exception: Optional[Exception] = None
+                metadata_length = self._block_object_metadata_length(head)
+                if metadata_length is not None:
+                    data_offset = self._BLOCK_OBJECT_HEADER.size + metadata_length
+                    try:
+                        if data_offset > object_length:
+                            raise ValueError('Object {} is truncated. Expected at least {} bytes, got {}.'.format(
+                                key, data_offset, object_length))
+                        if metadata_only and len(head) < data_offset:
+                            head = self._read_object_range(key, 0, data_offset)
+                            read_length = len(head)
+                        metadata_bytes = head[self._BLOCK_OBJECT_HEADER.size:data_offset]
+                        metadata = self._decode_metadata(metadata_bytes=metadata_bytes,
+                                                         key=key,
+                                                         data_length=object_length - data_offset)
+                    except (KeyError, ValueError) as exception:
+                        # The data of a block written by an older version can start with the magic number by chance
+                        inline_exception = exception
+                    else:
+                        if legacy_metadata_future is not None:
+                            # The guess was wrong, the metadata object doesn't exist. Its read is cancelled below.
+                            self._set_legacy_layout(block.uid, False)
+                        if not metadata_only:
+                            data = head[data_offset:]
+                if metadata is None:
+                    # Blocks written by older versions have their metadata in a separate object
+                    try:
+                        if legacy_metadata_future is not None:
+                            metadata_bytes = legacy_metadata_future.result()
+                        else:
+                            metadata_bytes = self._read_object(key + self._META_SUFFIX)
+                    except FileNotFoundError:
+                        if inline_exception is None:
+                            raise
+                        raise InvalidBlockException(
+                            'Object metadata of block {} (UID{}) is invalid.'.format(block.id, block.uid),
+                            block) from inline_exception
+                    if legacy_metadata_future is None:
+                        self._set_legacy_layout(block.uid, True)
+                    data_length = object_length
+                    if not metadata_only:
+                        data = head
+                    read_length += len(metadata_bytes)
+                time.sleep(self.read_throttling.consume(read_length))
+                t2 = time.time()
+            except FileNotFoundError as exception:
+                raise InvalidBlockException(
+                    'Object metadata or data of block {} (UID{}) not found.'.format(block.id, block.uid),
+                    block) from exception
+            finally:
+                # Don't leave the metadata object being fetched when it isn't needed or the read failed
+                if legacy_metadata_future is not None:
+                    legacy_metadata_future.cancel()
+
+        if metadata is None:
+            try:
+                metadata = self._decode_metadata(metadata_bytes=metadata_bytes, key=key, data_length=data_length)
+            except (KeyError, ValueError) as exception:
+                raise InvalidBlockException(
+                    'Object metadata of block {} (UID{}) is invalid.'.format(block.id, block.uid),
+                    block) from exception
 
         if self._CHECKSUM_KEY not in metadata:
             raise InvalidBlockException(
@@ -271,19 +573,55 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
 
         return block, data, metadata
 
-    def read_block_async(self, block: Block, metadata_only: bool = False) -> None:
+    def _set_legacy_layout(self, uid: BlockUid, legacy_layout: bool) -> None:
+        with self._legacy_layouts_lock:
+            self._legacy_layouts[uid.left] = legacy_layout
+
+    def _locate(self, uid: BlockUid, refresh: bool = False) -> Optional[PackLocation]:
+        return self._pack_index.locate(uid, refresh=refresh) if self._pack_index is not None else None
+
+    def _submit_read(self, block: DereferencedBlock, metadata_only: bool, location: Optional[PackLocation]) -> None:
 
         def job():
-            return self._read(block.deref(), metadata_only)
+            try:
+                return self._read(block, metadata_only, location)
+            except InvalidBlockException as exception:
+                if location is None and isinstance(exception.__cause__, FileNotFoundError):
+                    return _UnlocatedRead(block, metadata_only, exception)
+                raise
 
         self._read_executor.submit(job)
 
+    def read_block_async(self, block: Union[DereferencedBlock, Block], metadata_only: bool = False) -> None:
+        # Dereference the block and locate it here as the database session must not be used by the worker threads
+        block_deref = block.deref() if isinstance(block, Block) else block
+        self._submit_read(block_deref, metadata_only, self._locate(block_deref.uid))
+
     def read_block(self, block: Block, metadata_only: bool = False) -> Optional[bytes]:
-        return self._read(block.deref(), metadata_only)[1]
+        block_deref = block.deref()
+        location = self._locate(block_deref.uid)
+        try:
+            return self._read(block_deref, metadata_only, location)[1]
+        except InvalidBlockException as exception:
+            if location is None and isinstance(exception.__cause__, FileNotFoundError):
+                # Another process might have packed the block after the pack index found no packs
+                location = self._locate(block_deref.uid, refresh=True)
+                if location is not None:
+                    return self._read(block_deref, metadata_only, location)[1]
+            raise
 
     def read_get_completed(self,
                            timeout: int = None) -> Iterator[Union[Tuple[DereferencedBlock, bytes, Dict], BaseException]]:
-        return self._read_executor.get_completed(timeout=timeout)
+        for result in self._read_executor.get_completed(timeout=timeout):
+            if isinstance(result, _UnlocatedRead):
+                # Another process might have packed the block after the pack index found no packs. The block is
+                # read again from its pack, its result is retrieved later by this loop.
+                location = self._locate(result.block.uid, refresh=True)
+                if location is not None:
+                    self._submit_read(result.block, result.metadata_only, location)
+                    continue
+                result = result.exception
+            yield result
 
     def check_block_metadata(self, *, block: DereferencedBlock, data_length: Optional[int], metadata: Dict) -> None:
         # Existence of keys has already been checked in _decode_metadata() and _read()
@@ -317,15 +655,25 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
                 pass
         return uid
 
+    def _rm_packed_blocks(self, uids: Iterable[BlockUid]) -> AbstractSet[BlockUid]:
+        # Blocks inside of packs are only removed from the pack index, their space is reclaimed by compact_packs()
+        return self._pack_index.remove(uids) if self._pack_index is not None else set()
+
     def rm_block_async(self, uid: BlockUid) -> None:
+        if uid in self._rm_packed_blocks([uid]):
 
-        def job():
-            return self._rm_block(uid)
+            def job():
+                return uid
+        else:
+
+            def job():
+                return self._rm_block(uid)
 
         self._remove_executor.submit(job)
 
     def rm_block(self, uid: BlockUid) -> None:
-        self._rm_block(uid)
+        if uid not in self._rm_packed_blocks([uid]):
+            self._rm_block(uid)
 
     def rm_get_completed(self, timeout: int = None) -> Iterator[Union[BlockUid, BaseException]]:
         return self._remove_executor.get_completed(timeout=timeout)
@@ -333,13 +681,40 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
     def wait_rms_finished(self):
         self._remove_executor.wait_for_all()
 
-    # def rm_many_blocks(self, uids: Union[Sequence[BlockUid], AbstractSet[BlockUid]]) -> List[BlockUid]:
-    #     keys = [uid.storage_object_to_path() for uid in uids]
-    #     metadata_keys = [key + self._META_SUFFIX for key in keys]
-    #
-    #     errors = self._rm_many_objects(keys)
-    #     self._rm_many_objects(metadata_keys)
-    #     return [cast(BlockUid, BlockUid.storage_path_to_object(error)) for error in errors]
+    def rm_many_blocks(self, uids: Union[Sequence[BlockUid], AbstractSet[BlockUid]]) -> List[BlockUid]:
+        """ Removes many blocks at once. The objects are split into batches which are removed by the removal
+        threads in parallel. This must not be mixed with outstanding calls to rm_block_async. Returns the UIDs of the
+        blocks which couldn't be removed.
+        """
+        packed_uids = self._rm_packed_blocks(uids)
+        keys: List[str] = []
+        for uid in uids:
+            if uid in packed_uids:
+                continue
+            key = uid.storage_object_to_path()
+            keys.extend((key, key + self._META_SUFFIX))
+
+        batch_size = self._RM_MANY_OBJECTS_BATCH_SIZE
+        for i in range(0, len(keys), batch_size):
+            self._remove_executor.submit(lambda batch=keys[i:i + batch_size]: self._rm_many_objects(batch))
+
+        errors: List[str] = []
+        exception: Optional[BaseException] = None
+        # Wait for all batches to finish even when one of them fails so that no jobs are left behind
+        for result in self._remove_executor.get_completed():
+            if isinstance(result, BaseException):
+                exception = exception or result
+            else:
+                errors.extend(result)
+        if exception is not None:
+            raise exception
+
+        # A missing metadata object is ignored just like in _rm_block
+        return [
+            cast(BlockUid, BlockUid.storage_path_to_object(key))
+            for key in errors
+            if not key.endswith(self._META_SUFFIX)
+        ]
 
     def list_blocks(self) -> Iterable[BlockUid]:
         keys = self._list_objects(BlockUid.storage_prefix())
@@ -353,6 +728,100 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
                 # Ignore any keys which don't match our pattern to account for stray objects/files
                 pass
 
+        for pack_uid in self._list_packs():
+            for uid, _, _ in self._read_pack_entries(pack_uid)[1]:
+                yield uid
+
+    def _list_packs(self) -> Iterable[PackUid]:
+        keys = self._list_objects(PackUid.storage_prefix())
+        for key in keys:
+            assert isinstance(key, str)
+            # Packs are only complete once their metadata has been written
+            if not key.endswith(self._META_SUFFIX):
+                continue
+            try:
+                yield PackUid.storage_path_to_object(key[:-len(self._META_SUFFIX)])
+            except (RuntimeError, ValueError):
+                # Ignore any keys which don't match our pattern to account for stray objects/files
+                pass
+
+    def _read_pack_entries(self, pack_uid: PackUid) -> Tuple[int, List[Tuple[BlockUid, int, int]]]:
+        key = pack_uid.storage_object_to_path()
+        metadata_bytes = self._read_object(key + self._META_SUFFIX)
+        metadata = self._decode_metadata(metadata_bytes=metadata_bytes,
+                                         key=key,
+                                         data_length=self._read_object_length(key))
+        if self._PACK_ENTRIES_KEY not in metadata:
+            raise KeyError('Required object metadata key {} is missing for object {}.'.format(
+                self._PACK_ENTRIES_KEY, key))
+        return metadata[self._SIZE_KEY], [(BlockUid(left, right), offset, length)
+                                          for left, right, offset, length in metadata[self._PACK_ENTRIES_KEY]]
+
+    def rebuild_pack_index(self) -> None:
+        """ Adds the packs found in the storage which are unknown to the pack index. All entries of a pack are added,
+        even those belonging to blocks which aren't referenced by any version (yet), so that later metadata restores
+        find them. This is needed after a metadata restore or import into a fresh database.
+        """
+        if self._pack_index is None:
+            return
+        added_packs = 0
+        for pack_uid in self._list_packs():
+            if self._pack_index.is_pack_known(pack_uid):
+                continue
+            size, entries = self._read_pack_entries(pack_uid)
+            self._pack_index.add_pack(pack_uid, size, entries)
+            added_packs += 1
+        if added_packs > 0:
+            self._pack_index.commit()
+            logger.info('Added {} pack(s) of storage {} to the pack index.'.format(added_packs, self.name))
+
+    def compact_packs(self) -> None:
+        """ Copies the remaining blocks of packs which are mostly unused into new packs and removes the old packs.
+        Packs without any remaining blocks are removed directly. This must not be called while writes are outstanding.
+        """
+        if self._pack_index is None:
+            return
+        candidates = self._pack_index.compaction_candidates(self._pack_compaction_threshold)
+        if not candidates:
+            return
+
+        # When packing has been disabled in the meantime the new packs aren't made larger than the old ones
+        pack_size = self._pack_size if self._pack_size > 0 else max([size for _, size, _ in candidates])
+        new_packs: List[_WrittenPack] = []
+        pack_data = bytearray()
+        pack_entries: List[Tuple[BlockUid, int, int]] = []
+        for pack_uid, _, live_size in candidates:
+            if live_size == 0:
+                continue
+            # The entries are copied verbatim, their metadata (including its HMAC) stays valid
+            data = self._read_object(pack_uid.storage_object_to_path())
+            for uid, offset, length in self._pack_index.packed_blocks(pack_uid):
+                pack_entries.append((uid, len(pack_data), length))
+                pack_data += data[offset:offset + length]
+                if len(pack_data) >= pack_size:
+                    new_packs.append(self._write_pack(bytes(pack_data), pack_entries, []))
+                    pack_data = bytearray()
+                    pack_entries = []
+        if pack_entries:
+            new_packs.append(self._write_pack(bytes(pack_data), pack_entries, []))
+
+        for new_pack in new_packs:
+            self._pack_index.add_pack(new_pack.uid, new_pack.size, new_pack.entries)
+        for pack_uid, _, _ in candidates:
+            self._pack_index.rm_pack(pack_uid)
+        # The old packs may only be removed once the new locations of their blocks have been committed
+        self._pack_index.commit()
+
+        keys: List[str] = []
+        for pack_uid, _, _ in candidates:
+            key = pack_uid.storage_object_to_path()
+            keys.extend((key, key + self._META_SUFFIX))
+        for key in self._rm_many_objects(keys):
+            logger.warning('Unable to remove object {} of compacted pack from storage {}.'.format(key, self.name))
+
+        logger.info('Compacted {} pack(s) of storage {} into {} new pack(s).'.format(
+            len(candidates), self.name, len(new_packs)))
+
     def list_versions(self) -> Iterable[VersionUid]:
         keys = self._list_objects(VersionUid.storage_prefix())
         for key in keys:
@@ -369,9 +838,9 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         key = version_uid.storage_object_to_path()
         metadata_key = key + self._META_SUFFIX
         data = self._read_object(key)
-        metadata_json = self._read_object(metadata_key)
+        metadata_bytes = self._read_object(metadata_key)
 
-        metadata = self._decode_metadata(metadata_json=metadata_json, key=key, data_length=len(data))
+        metadata = self._decode_metadata(metadata_bytes=metadata_bytes, key=key, data_length=len(data))
 
         if self._TRANSFORMS_KEY in metadata:
             data = self._decapsulate(data, metadata[self._TRANSFORMS_KEY])
@@ -398,13 +867,13 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         size = len(data_bytes)
 
         data_bytes, transforms_metadata = self._encapsulate(data_bytes)
-        metadata, metadata_json = self._build_metadata(size=size,
-                                                       object_size=len(data_bytes),
-                                                       transforms_metadata=transforms_metadata)
+        metadata, metadata_bytes = self._build_metadata(size=size,
+                                                        object_size=len(data_bytes),
+                                                        transforms_metadata=transforms_metadata)
 
         try:
             self._write_object(key, data_bytes)
-            self._write_object(metadata_key, metadata_json)
+            self._write_object(metadata_key, metadata_bytes)
         except:
             try:
                 self._rm_object(key)
@@ -476,6 +945,10 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         self._read_executor.shutdown()
         self._write_executor.shutdown()
         self._remove_executor.shutdown()
+        self._legacy_metadata_executor.shutdown()
+        if self._pack_entries:
+            logger.warning('Storage {} is being closed with {} blocks waiting to be packed, discarding them.'.format(
+                self.name, len(self._pack_entries)))
 
     @abstractmethod
     def _write_object(self, key: str, data: bytes):
@@ -485,6 +958,18 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
     def _read_object(self, key: str) -> bytes:
         raise NotImplementedError
 
+    def _read_object_head(self, key: str, length: int) -> Tuple[bytes, int]:
+        """ Reads at least the first length bytes of an object and returns them together with the length of the whole
+        object. Storage modules should override this if their backend supports ranged reads.
+        """
+        data = self._read_object(key)
+        return data, len(data)
+
+    def _read_object_range(self, key: str, offset: int, length: int) -> bytes:
+        """ Reads part of an object. Storage modules should override this if their backend supports ranged reads.
+        """
+        return self._read_object(key)[offset:offset + length]
+
     @abstractmethod
     def _read_object_length(self, key: str) -> int:
         raise NotImplementedError
@@ -493,6 +978,18 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
     def _rm_object(self, key: str) -> None:
         raise NotImplementedError
 
+    def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
+        """ Removes a batch of objects and returns the keys of the objects which couldn't be removed. Storage
+        modules should override this if their backend supports removing many objects with one request.
+        """
+        errors: List[str] = []
+        for key in keys:
+            try:
+                self._rm_object(key)
+            except FileNotFoundError:
+                errors.append(key)
+        return errors
+
     @abstractmethod
     def _list_objects(self, prefix: str = None,
                       include_size: bool = False) -> Union[Iterable[str], Iterable[Tuple[str, int]]]:
@@ -529,7 +1026,10 @@ class ReadCacheStorageBase(StorageBase):
         # Start reader and write threads after the disk cached is created, so that they see it.
         super().__init__(config=config, name=name, storage_id=storage_id, module_configuration=module_configuration)
 
-    def _read(self, block: DereferencedBlock, metadata_only: bool) -> Tuple[DereferencedBlock, Optional[bytes], Dict]:
+    def _read(self,
+              block: DereferencedBlock,
+              metadata_only: bool,
+              location: PackLocation = None) -> Tuple[DereferencedBlock, Optional[bytes], Dict]:
         key = block.uid.storage_object_to_path()
         metadata_key = key + self._META_SUFFIX
         if self._read_cache is not None and self._use_read_cache:
@@ -541,7 +1041,7 @@ class ReadCacheStorageBase(StorageBase):
                 if data:
                     return block, data, metadata
 
-        block, data, metadata = super()._read(block, metadata_only)
+        block, data, metadata = super()._read(block, metadata_only, location)
 
         # We always put blocks into the cache even when self._use_read_cache is False
         if self._read_cache is not None:
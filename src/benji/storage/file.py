@@ -3,7 +3,7 @@
 
 import os
 from os.path import getsize
-from typing import Union, Iterable, Tuple
+from typing import Union, Iterable, Tuple, Sequence, List
 
 from benji.config import Config, ConfigDict
 from benji.storage.base import StorageBase
@@ -50,6 +50,30 @@ class Storage(StorageBase):
 
         return data
 
+    def _read_object_head(self, key: str, length: int) -> Tuple[bytes, int]:
+        filename = os.path.join(self.path, key)
+
+        if not os.path.exists(filename):
+            raise FileNotFoundError('File {} not found.'.format(filename))
+
+        with open(filename, 'rb') as f:
+            data = f.read(length)
+            object_length = os.fstat(f.fileno()).st_size
+
+        return data, object_length
+
+    def _read_object_range(self, key: str, offset: int, length: int) -> bytes:
+        filename = os.path.join(self.path, key)
+
+        if not os.path.exists(filename):
+            raise FileNotFoundError('File {} not found.'.format(filename))
+
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+
+        return data
+
     def _read_object_length(self, key: str) -> int:
         filename = os.path.join(self.path, key)
 
@@ -65,14 +89,15 @@ class Storage(StorageBase):
             raise FileNotFoundError('File {} not found.'.format(filename))
         os.unlink(filename)
 
-    # def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
-    #     errors = []
-    #     for key in keys:
-    #         try:
-    #             self._rm_object(key)
-    #         except FileNotFoundError:
-    #             errors.append(key)
-    #     return errors
+    def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
+        errors: List[str] = []
+        for key in keys:
+            # Unlink directly instead of checking for existence first as _rm_object does, this saves a system call
+            try:
+                os.unlink(os.path.join(self.path, key))
+            except FileNotFoundError:
+                errors.append(key)
+        return errors
 
     def _list_objects(self, prefix: str = None,
                       include_size: bool = False) -> Union[Iterable[str], Iterable[Tuple[str, int]]]:
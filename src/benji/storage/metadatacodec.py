@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+import hashlib
+import hmac
+import struct
+from typing import Dict, List, Optional, Tuple, Any
+
+from benji.exception import InternalError
+from benji.repr import ReprMixIn
+
+
+class MetadataCodec(ReprMixIn):
+    """ Compact binary encoding of object metadata.
+
+    The encoded form consists of a magic number including the format version, an HMAC algorithm identifier, the
+    metadata serialized with a canonical subset of MessagePack (maps are always written with sorted keys) and the
+    HMAC digest. The digest covers everything before it and is calculated over the serialized bytes in one go.
+    """
+
+    _MAGIC = b'BJM\x01'
+    _HMAC_NONE = 0
+    _HMAC_SHA256 = 1
+    _DIGEST_LENGTH = 32
+
+    _CHARSET = 'utf-8'
+
+    _UINT8 = struct.Struct('!B')
+    _UINT16 = struct.Struct('!H')
+    _UINT32 = struct.Struct('!I')
+    _UINT64 = struct.Struct('!Q')
+    _INT8 = struct.Struct('!b')
+    _INT16 = struct.Struct('!h')
+    _INT32 = struct.Struct('!i')
+    _INT64 = struct.Struct('!q')
+    _FLOAT64 = struct.Struct('!d')
+
+    def __init__(self, *, secret_key: Optional[bytes]) -> None:
+        self._secret_key = secret_key
+
+    @classmethod
+    def is_encoded(cls, data: bytes) -> bool:
+        return data[:len(cls._MAGIC)] == cls._MAGIC
+
+    def _calculate_digest(self, data: bytes) -> bytes:
+        assert self._secret_key is not None
+        return hmac.new(self._secret_key, data, hashlib.sha256).digest()
+
+    def encode(self, metadata: Dict) -> bytes:
+        parts: List[bytes] = [self._MAGIC]
+        parts.append(self._UINT8.pack(self._HMAC_NONE if self._secret_key is None else self._HMAC_SHA256))
+        self._pack(metadata, parts)
+        data = b''.join(parts)
+        if self._secret_key is not None:
+            data += self._calculate_digest(data)
+        return data
+
+    def decode(self, data: bytes) -> Dict:
+        if not self.is_encoded(data):
+            raise ValueError('Invalid magic number in encoded metadata.')
+        offset = len(self._MAGIC)
+        if len(data) < offset + 1:
+            raise ValueError('Encoded metadata is truncated.')
+        algorithm = data[offset]
+        offset += 1
+        if algorithm == self._HMAC_NONE:
+            payload_end = len(data)
+        elif algorithm == self._HMAC_SHA256:
+            payload_end = len(data) - self._DIGEST_LENGTH
+            if payload_end < offset:
+                raise ValueError('Encoded metadata is truncated.')
+        else:
+            raise ValueError('Unsupported HMAC algorithm identifier {} in encoded metadata.'.format(algorithm))
+
+        if self._secret_key is not None:
+            if algorithm == self._HMAC_NONE:
+                raise ValueError('Encoded metadata is missing the required HMAC.')
+            if not hmac.compare_digest(self._calculate_digest(data[:payload_end]), data[payload_end:]):
+                raise ValueError('Encoded metadata HMAC is invalid.')
+
+        try:
+            metadata, offset = self._unpack(data, offset)
+        except (IndexError, struct.error, UnicodeDecodeError) as exception:
+            raise ValueError('Encoded metadata is invalid: {}.'.format(str(exception))) from None
+        if offset != payload_end:
+            raise ValueError('Encoded metadata has {} bytes of trailing garbage.'.format(payload_end - offset))
+        if not isinstance(metadata, dict):
+            raise ValueError('Encoded metadata has an invalid type of {}.'.format(type(metadata)))
+
+        return metadata
+
+    def _pack_length(self, length: int, fix_type: int, fix_limit: int, type_16: int, type_32: int,
+                     parts: List[bytes]) -> None:
+        if length < fix_limit:
+            parts.append(self._UINT8.pack(fix_type | length))
+        elif length <= 0xffff:
+            parts.append(self._UINT8.pack(type_16) + self._UINT16.pack(length))
+        elif length <= 0xffffffff:
+            parts.append(self._UINT8.pack(type_32) + self._UINT32.pack(length))
+        else:
+            raise InternalError('Value is too long to be encoded ({} elements).'.format(length))
+
+    def _pack(self, value: Any, parts: List[bytes]) -> None:
+        # bool is a subclass of int and needs to be checked first
+        if value is None:
+            parts.append(b'\xc0')
+        elif value is True:
+            parts.append(b'\xc3')
+        elif value is False:
+            parts.append(b'\xc2')
+        elif isinstance(value, int):
+            if 0 <= value < 0x80:
+                parts.append(self._UINT8.pack(value))
+            elif -0x20 <= value < 0:
+                parts.append(self._INT8.pack(value))
+            elif 0 <= value <= 0xffffffff:
+                parts.append(b'\xce' + self._UINT32.pack(value))
+            elif 0 <= value <= 0xffffffffffffffff:
+                parts.append(b'\xcf' + self._UINT64.pack(value))
+            elif -0x8000000000000000 <= value < 0:
+                parts.append(b'\xd3' + self._INT64.pack(value))
+            else:
+                raise InternalError('Integer {} is out of range.'.format(value))
+        elif isinstance(value, str):
+            encoded_value = value.encode(self._CHARSET)
+            if len(encoded_value) < 0x20:
+                parts.append(self._UINT8.pack(0xa0 | len(encoded_value)))
+            elif len(encoded_value) <= 0xff:
+                parts.append(b'\xd9' + self._UINT8.pack(len(encoded_value)))
+            elif len(encoded_value) <= 0xffff:
+                parts.append(b'\xda' + self._UINT16.pack(len(encoded_value)))
+            else:
+                parts.append(b'\xdb' + self._UINT32.pack(len(encoded_value)))
+            parts.append(encoded_value)
+        elif isinstance(value, (bytes, bytearray)):
+            if len(value) <= 0xff:
+                parts.append(b'\xc4' + self._UINT8.pack(len(value)))
+            elif len(value) <= 0xffff:
+                parts.append(b'\xc5' + self._UINT16.pack(len(value)))
+            else:
+                parts.append(b'\xc6' + self._UINT32.pack(len(value)))
+            parts.append(bytes(value))
+        elif isinstance(value, float):
+            parts.append(b'\xcb' + self._FLOAT64.pack(value))
+        elif isinstance(value, (list, tuple)):
+            self._pack_length(len(value), 0x90, 0x10, 0xdc, 0xdd, parts)
+            for element in value:
+                self._pack(element, parts)
+        elif isinstance(value, dict):
+            self._pack_length(len(value), 0x80, 0x10, 0xde, 0xdf, parts)
+            for key in sorted(value.keys()):
+                if not isinstance(key, str):
+                    raise InternalError('Dictionary keys must be of type str, but key {} is of type {}.'.format(
+                        key, type(key)))
+                self._pack(key, parts)
+                self._pack(value[key], parts)
+        else:
+            raise InternalError('Values of type {} cannot be encoded.'.format(type(value)))
+
+    def _unpack_str(self, data: bytes, offset: int, length: int) -> Tuple[str, int]:
+        end = offset + length
+        if end > len(data):
+            raise IndexError('string extends beyond the end of the data')
+        return data[offset:end].decode(self._CHARSET), end
+
+    def _unpack_bytes(self, data: bytes, offset: int, length: int) -> Tuple[bytes, int]:
+        end = offset + length
+        if end > len(data):
+            raise IndexError('binary value extends beyond the end of the data')
+        return data[offset:end], end
+
+    def _unpack_list(self, data: bytes, offset: int, length: int) -> Tuple[List, int]:
+        values = []
+        for _ in range(length):
+            value, offset = self._unpack(data, offset)
+            values.append(value)
+        return values, offset
+
+    def _unpack_dict(self, data: bytes, offset: int, length: int) -> Tuple[Dict, int]:
+        values = {}
+        for _ in range(length):
+            key, offset = self._unpack(data, offset)
+            if not isinstance(key, str):
+                raise IndexError('dictionary key of type {}'.format(type(key)))
+            values[key], offset = self._unpack(data, offset)
+        return values, offset
+
+    def _unpack(self, data: bytes, offset: int) -> Tuple[Any, int]:
+        type_byte = data[offset]
+        offset += 1
+
+        if type_byte < 0x80:
+            return type_byte, offset
+        elif type_byte >= 0xe0:
+            return type_byte - 0x100, offset
+        elif 0xa0 <= type_byte <= 0xbf:
+            return self._unpack_str(data, offset, type_byte & 0x1f)
+        elif 0x90 <= type_byte <= 0x9f:
+            return self._unpack_list(data, offset, type_byte & 0x0f)
+        elif 0x80 <= type_byte <= 0x8f:
+            return self._unpack_dict(data, offset, type_byte & 0x0f)
+        elif type_byte == 0xc0:
+            return None, offset
+        elif type_byte == 0xc2:
+            return False, offset
+        elif type_byte == 0xc3:
+            return True, offset
+        elif type_byte in self._SCALARS:
+            scalar_struct = self._SCALARS[type_byte]
+            return scalar_struct.unpack_from(data, offset)[0], offset + scalar_struct.size
+        elif type_byte in self._CONTAINERS:
+            length_struct, unpack = self._CONTAINERS[type_byte]
+            length = length_struct.unpack_from(data, offset)[0]
+            return unpack(self, data, offset + length_struct.size, length)
+        else:
+            raise IndexError('unsupported type 0x{:02x}'.format(type_byte))
+
+    _SCALARS = {
+        0xca: struct.Struct('!f'),
+        0xcb: _FLOAT64,
+        0xcc: _UINT8,
+        0xcd: _UINT16,
+        0xce: _UINT32,
+        0xcf: _UINT64,
+        0xd0: _INT8,
+        0xd1: _INT16,
+        0xd2: _INT32,
+        0xd3: _INT64,
+    }
+
+    _CONTAINERS = {
+        0xc4: (_UINT8, _unpack_bytes),
+        0xc5: (_UINT16, _unpack_bytes),
+        0xc6: (_UINT32, _unpack_bytes),
+        0xd9: (_UINT8, _unpack_str),
+        0xda: (_UINT16, _unpack_str),
+        0xdb: (_UINT32, _unpack_str),
+        0xdc: (_UINT16, _unpack_list),
+        0xdd: (_UINT32, _unpack_list),
+        0xde: (_UINT16, _unpack_dict),
+        0xdf: (_UINT32, _unpack_dict),
+    }
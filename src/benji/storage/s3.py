@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 import threading
-from typing import Iterable, Union, Tuple
+from typing import Iterable, Union, Tuple, Sequence, List
 
 import boto3
 from botocore.client import Config as BotoCoreClientConfig
@@ -18,6 +18,8 @@ class Storage(ReadCacheStorageBase):
     WRITE_QUEUE_LENGTH = 20
     READ_QUEUE_LENGTH = 20
 
+    _RM_MANY_OBJECTS_BATCH_SIZE = 1000
+
     def __init__(self, *, config: Config, name: str, storage_id: int, module_configuration: ConfigDict):
         aws_access_key_id = Config.get_from_dict(module_configuration, 'awsAccessKeyId', None, types=str)
         if aws_access_key_id is None:
@@ -95,6 +97,37 @@ class Storage(ReadCacheStorageBase):
 
         return data
 
+    def _read_object_head(self, key: str, length: int) -> Tuple[bytes, int]:
+        self._init_connection()
+        object = self._local.bucket.Object(key)
+        try:
+            data_dict = object.get(Range='bytes=0-{}'.format(length - 1))
+            data = data_dict['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
+                raise FileNotFoundError('Key {} not found.'.format(key)) from None
+            else:
+                raise
+
+        # The Content-Range header has the form "bytes 0-4095/123456". It is missing when the server ignored the range
+        # and returned the whole object.
+        content_range = data_dict.get('ContentRange')
+        return data, int(content_range.split('/')[-1]) if content_range else len(data)
+
+    def _read_object_range(self, key: str, offset: int, length: int) -> bytes:
+        self._init_connection()
+        object = self._local.bucket.Object(key)
+        try:
+            data_dict = object.get(Range='bytes={}-{}'.format(offset, offset + length - 1))
+            data = data_dict['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
+                raise FileNotFoundError('Key {} not found.'.format(key)) from None
+            else:
+                raise
+
+        return data
+
     def _read_object_length(self, key: str) -> int:
         self._init_connection()
         object = self._local.bucket.Object(key)
@@ -122,29 +155,24 @@ class Storage(ReadCacheStorageBase):
         else:
             object.delete()
 
-    # def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
-    #     self._init_connection()
-    #     errors: List[str] = []
-    #     if self._multi_delete:
-    #         # Amazon (at least) only handles 1000 deletes at a time
-    #         # Split list into parts of at most 1000 elements
-    #         keys_parts = [islice(keys, i, i + 1000) for i in range(0, len(keys), 1000)]
-    #         for part in keys_parts:
-    #             response = self._local.resource.meta.client.delete_objects(
-    #                 Bucket=self._local.bucket.name, Delete={
-    #                     'Objects': [{
-    #                         'Key': key
-    #                     } for key in part],
-    #                 })
-    #             if 'Errors' in response:
-    #                 errors += list(map(lambda object: object['Key'], response['Errors']))
-    #     else:
-    #         for key in keys:
-    #             try:
-    #                 self._local.bucket.Object(key).delete()
-    #             except ClientError:
-    #                 errors.append(key)
-    #     return errors
+    def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
+        self._init_connection()
+        errors: List[str] = []
+        # DeleteObjects handles at most 1000 keys per request. It doesn't report missing keys as errors.
+        for i in range(0, len(keys), self._RM_MANY_OBJECTS_BATCH_SIZE):
+            response = self._local.resource.meta.client.delete_objects(
+                Bucket=self._bucket_name,
+                Delete={
+                    'Objects': [{
+                        'Key': key
+                    } for key in keys[i:i + self._RM_MANY_OBJECTS_BATCH_SIZE]],
+                    'Quiet': True,
+                })
+            for error in response.get('Errors', []):
+                logger.warning('Unable to delete key {}: {} ({}).'.format(error['Key'], error.get('Message'),
+                                                                         error.get('Code')))
+                errors.append(error['Key'])
+        return errors
 
     def _list_objects(self, prefix: str = None,
                       include_size: bool = False) -> Union[Iterable[str], Iterable[Tuple[str, int]]]:
@@ -1,4 +1,7 @@
+import json
 import random
+from concurrent.futures import Future
+from unittest.mock import patch
 
 from benji.database import Block, BlockUid, VersionUid
 from benji.logging import logger
@@ -90,6 +93,31 @@ class StorageTestCase(StorageTestCaseBase):
         saved_uids = list(self.storage.list_blocks())
         self.assertEqual(0, len(saved_uids))
 
+    def test_write_rm_many(self):
+        NUM_BLOBS = 250
+        BLOB_SIZE = 512
+
+        blocks = [
+            Block(uid=BlockUid(i + 1, i + 100), size=BLOB_SIZE, checksum='0000000000000000') for i in range(NUM_BLOBS)
+        ]
+        for block in blocks:
+            self.storage.write_block_async(block, self.random_bytes(BLOB_SIZE))
+        self.storage.wait_writes_finished()
+        for _ in self.storage.write_get_completed(timeout=1):
+            pass
+        self.assertEqual(NUM_BLOBS, len(list(self.storage.list_blocks())))
+
+        # Some blocks don't exist anymore
+        not_existing_uids = [block.uid for block in blocks[:10]]
+        for uid in not_existing_uids:
+            self.storage.rm_block(uid)
+
+        no_del_uids = self.storage.rm_many_blocks([block.uid for block in blocks])
+        self.assertEqual(0, len(list(self.storage.list_blocks())))
+        # Some storages don't report missing objects
+        self.assertTrue(set(no_del_uids) <= set(not_existing_uids))
+        self.assertEqual([], self.storage.rm_many_blocks([]))
+
     def test_not_exists(self):
         block = Block(uid=BlockUid(1, 2), size=15, checksum='00000000000000000000')
         self.storage.write_block(block, b'test_not_exists')
@@ -102,6 +130,103 @@ class StorageTestCase(StorageTestCaseBase):
         self.assertRaises(BlockNotFoundError, lambda: self.storage.rm_block(block.uid))
         self.assertRaises(InvalidBlockException, lambda: self.storage.read_block(block))
 
+    def test_read_metadata_only(self):
+        block = Block(uid=BlockUid(1, 2), size=4096, checksum='0000000000000000')
+        self.storage.write_block(block, self.random_bytes(4096))
+
+        self.storage.read_block_async(block, metadata_only=True)
+        results = list(self.storage.read_get_completed(timeout=5))
+        self.assertEqual(1, len(results))
+        block_deref, data, metadata = results[0]
+        self.assertIsNone(data)
+        self.assertEqual(4096, metadata['size'])
+        self.storage.check_block_metadata(block=block_deref, data_length=None, metadata=metadata)
+
+        self.storage.rm_block(block.uid)
+
+    def test_read_legacy_layout(self):
+        # Blocks written by older versions consist of the data object and a separate metadata object
+        block = Block(uid=BlockUid(1, 2), size=4096, checksum='0000000000000000')
+        data = self.random_bytes(4096)
+        encapsulated_data, transforms_metadata = self.storage._encapsulate(data)
+        metadata, _ = self.storage._build_metadata(size=block.size,
+                                                   object_size=len(encapsulated_data),
+                                                   checksum=block.checksum,
+                                                   transforms_metadata=transforms_metadata)
+        # Older versions also used object metadata version 1 and encoded the metadata as JSON
+        metadata[self.storage._METADATA_VERSION_KEY] = '1.0.0'
+        if self.storage._dict_hmac:
+            self.storage._dict_hmac.add_digest(metadata)
+        metadata_json = json.dumps(metadata).encode('utf-8')
+        key = block.uid.storage_object_to_path()
+        self.storage._write_object(key, encapsulated_data)
+        self.storage._write_object(key + '.meta', metadata_json)
+
+        self.assertEqual(data, self.storage.read_block(block))
+        self.storage.read_block_async(block, metadata_only=True)
+        results = list(self.storage.read_get_completed(timeout=5))
+        self.assertEqual(1, len(results))
+        self.assertEqual(4096, results[0][2]['size'])
+        # The metadata object has been fetched concurrently to the data
+        self.assertTrue(self.storage._legacy_layouts[1])
+        self.assertEqual(data, self.storage.read_block(block))
+
+        # A block of the same version in the current layout is still read correctly after the guess
+        block_2 = Block(uid=BlockUid(1, 3), size=4096, checksum='0000000000000000')
+        data_2 = self.random_bytes(4096)
+        self.storage.write_block(block_2, data_2)
+        self.assertEqual(data_2, self.storage.read_block(block_2))
+        self.assertFalse(self.storage._legacy_layouts[1])
+
+        # The layout is remembered per writing version
+        block_3 = Block(uid=BlockUid(2, 1), size=4096, checksum='0000000000000000')
+        self.storage.write_block(block_3, data_2)
+        self.assertEqual(data, self.storage.read_block(block))
+        self.assertEqual(data_2, self.storage.read_block(block_3))
+        self.assertTrue(self.storage._legacy_layouts[1])
+        self.assertFalse(self.storage._legacy_layouts.get(2, False))
+
+        self.storage.rm_block(block.uid)
+        self.storage.rm_block(block_2.uid)
+        self.storage.rm_block(block_3.uid)
+        self.assertRaises(FileNotFoundError, lambda: self.storage._read_object(key + '.meta'))
+
+    def test_read_legacy_layout_failed(self):
+        # A failed read of a block guessed to have the legacy layout cancels the fetch of its metadata object
+        block = Block(uid=BlockUid(1, 1), size=4096, checksum='0000000000000000')
+        self.storage._set_legacy_layout(block.uid, True)
+        legacy_metadata_future = Future()
+        with patch.object(self.storage._legacy_metadata_executor, 'submit',
+                          return_value=legacy_metadata_future) as submit:
+            self.assertRaises(InvalidBlockException, lambda: self.storage.read_block(block))
+        submit.assert_called_once()
+        self.assertTrue(legacy_metadata_future.cancelled())
+
+    def test_read_legacy_layout_with_magic(self):
+        # The data of a block written by an older version can start with the magic number of the current layout
+        for i, metadata_length in enumerate((16, 2**31)):
+            block = Block(uid=BlockUid(1, i + 1), size=4096, checksum='0000000000000000')
+            data = self.storage._BLOCK_OBJECT_HEADER.pack(self.storage._BLOCK_OBJECT_MAGIC,
+                                                          metadata_length) + self.random_bytes(4088)
+            metadata, _ = self.storage._build_metadata(size=block.size, object_size=len(data), checksum=block.checksum)
+            metadata[self.storage._METADATA_VERSION_KEY] = '1.0.0'
+            if self.storage._dict_hmac:
+                self.storage._dict_hmac.add_digest(metadata)
+            key = block.uid.storage_object_to_path()
+            self.storage._write_object(key, data)
+            self.storage._write_object(key + '.meta', json.dumps(metadata).encode('utf-8'))
+
+            self.assertEqual(data, self.storage.read_block(block))
+            self.storage.read_block_async(block, metadata_only=True)
+            results = list(self.storage.read_get_completed(timeout=5))
+            self.assertEqual(1, len(results))
+            self.assertEqual(4096, results[0][2]['size'])
+
+            # Without the metadata object the block is invalid
+            self.storage._rm_object(key + '.meta')
+            self.assertRaises(InvalidBlockException, lambda: self.storage.read_block(block))
+            self.storage.rm_block(block.uid)
+
     def test_block_uid_to_key(self):
         for i in range(100):
             block_uid = BlockUid(random.randint(1, pow(2, 32) - 1), random.randint(1, pow(2, 32) - 1))
@@ -149,7 +274,7 @@ class StorageTestCase(StorageTestCaseBase):
 
         logger.debug(f'Storage stats: {objects_count} objects using {objects_size} bytes.')
 
-        self.assertEqual(NUM_BLOBS * 2, objects_count)  # Also counts the metadata objects
+        self.assertEqual(NUM_BLOBS, objects_count)  # The metadata is part of each object
         self.assertGreater(objects_size, 0)
 
         for block in blocks:
@@ -0,0 +1,397 @@
+import io
+import json
+import os
+import random
+import time
+from unittest import TestCase
+from unittest.mock import patch, ANY
+
+from sparsebitfield import SparseBitfield
+
+from benji.benji import Benji
+from benji.database import DereferencedBlock, VersionUid, VersionStatus
+from benji.config import Config
+from benji.factory import IOFactory, StorageFactory
+from benji.io.base import IOThrottling
+from benji.pipeline import Pipeline
+from benji.tests.testcase import BenjiTestCaseBase
+from benji.utils import hints_from_rbd_diff, hints_from_rbd_diff_file, memory_budget
+
+kB = 1024
+
+
+class BackupTestCase(BenjiTestCaseBase):
+
+    def _create_image(self, name: str, data: bytes) -> str:
+        image_filename = os.path.join(self.testpath.path, name)
+        with open(image_filename, 'wb') as f:
+            f.write(data)
+        return image_filename
+
+    def test_zero_blocks(self):
+        block_size = 64 * kB
+        # Five zero blocks, two blocks with data, one block with a single non-zero byte at the end and a short last
+        # block which only contains zeros
+        image = b'\0' * 5 * block_size + self.random_bytes(2 * block_size) + b'\0' * (block_size - 1) + b'\1' + \
+            b'\0' * 123
+        image_filename = self._create_image('image', image)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        version = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename)
+        self.assertEqual(len(image), version.bytes_read)
+        self.assertEqual(5 * block_size, version.bytes_sparse)
+        self.assertEqual(3 * block_size + 123, version.bytes_written)
+
+        blocks = list(benji_obj._database_backend.get_blocks_by_version(version.uid))
+        self.assertEqual([None] * 5, [block.checksum for block in blocks[0:5]])
+        self.assertTrue(all([block.checksum is not None for block in blocks[5:]]))
+
+        restore_filename = os.path.join(self.testpath.path, 'restore')
+        benji_obj.restore(version.uid, 'file:' + restore_filename, sparse=False, force=False)
+        with open(restore_filename, 'rb') as f:
+            self.assertEqual(image, f.read())
+        benji_obj.close()
+
+    def test_file_holes(self):
+        block_size = 64 * kB
+        size = 64 * block_size + 123
+        data_1 = self.random_bytes(block_size + 1000)
+        data_2 = self.random_bytes(2000)
+        image_filename = os.path.join(self.testpath.path, 'image')
+        with open(image_filename, 'wb') as f:
+            f.truncate(size)
+            f.seek(3 * block_size - 500)
+            f.write(data_1)
+            f.seek(size - len(data_2))
+            f.write(data_2)
+        with open(image_filename, 'rb') as f:
+            image = f.read()
+
+        benji_obj = self.benjiOpen(init_database=True)
+        version = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename)
+        # Only the blocks containing data have been read
+        self.assertLessEqual(version.bytes_read, 4 * block_size + 123)
+        self.assertGreater(version.bytes_read, 0)
+
+        # A second backup based on the first one uses the hints, too
+        version_2 = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename,
+                                     base_version_uid=version.uid)
+        self.assertLessEqual(version_2.bytes_read, 4 * block_size + 123)
+
+        for restore_version in (version, version_2):
+            restore_filename = os.path.join(self.testpath.path, 'restore-' + restore_version.uid.v_string)
+            benji_obj.restore(restore_version.uid, 'file:' + restore_filename, sparse=False, force=False)
+            with open(restore_filename, 'rb') as f:
+                self.assertEqual(image, f.read())
+        benji_obj.close()
+
+    def test_generate_hints(self):
+        block_size = 64 * kB
+        image_filename = self._create_image('image', self.random_bytes(4 * block_size))
+
+        benji_obj = self.benjiOpen(init_database=True)
+        try:
+            with patch('benji.io.file.IO.hints', autospec=True, return_value=None) as hints:
+                version = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename)
+                hints.assert_called_once_with(ANY, base_snapshot_name=None, generate=False)
+                hints.reset_mock()
+                benji_obj.backup('data-backup',
+                                 'snapshot-name',
+                                 'file:' + image_filename,
+                                 base_version_uid=version.uid,
+                                 generate_hints=True)
+                hints.assert_called_once_with(ANY, base_snapshot_name='snapshot-name', generate=True)
+        finally:
+            benji_obj.close()
+
+    def test_blocks_from_hints(self):
+        block_size = 4096
+        for run in range(20):
+            hints = []
+            for _ in range(random.randint(0, 50)):
+                hints.append((random.randint(0, 1000 * block_size), random.randint(0, 10 * block_size),
+                              random.choice((True, False))))
+
+            expected_sparse_blocks = set()
+            expected_read_blocks = set()
+            for offset, length, exists in hints:
+                start_block = offset // block_size
+                end_block = (offset + length - 1) // block_size
+                if exists:
+                    expected_read_blocks.update(range(start_block, end_block + 1))
+                else:
+                    if offset % block_size > 0:
+                        expected_read_blocks.add(start_block)
+                    if (offset + length) % block_size > 0:
+                        expected_read_blocks.add(end_block)
+                    expected_sparse_blocks.update(range(start_block, end_block + 1))
+
+            sparse_blocks, read_blocks, hinted_runs = Benji._blocks_from_hints(hints, block_size)
+            self.assertEqual(sorted(expected_sparse_blocks), list(sparse_blocks))
+            self.assertEqual(sorted(expected_read_blocks), list(read_blocks))
+            self.assertEqual(sorted(expected_sparse_blocks | expected_read_blocks),
+                             [block_id for start, length in hinted_runs for block_id in range(start, start + length)])
+            for (start_1, length_1), (start_2, _) in zip(hinted_runs, hinted_runs[1:]):
+                # Adjacent runs are merged
+                self.assertLess(start_1 + length_1, start_2)
+
+    def test_hints_from_rbd_diff_file(self):
+        for extents_count in (0, 1, 1000):
+            extents = [{
+                'offset': random.randint(0, 1 << 40),
+                'length': random.randint(1, 1 << 22),
+                'exists': random.choice(('true', 'false', True, False))
+            } for _ in range(extents_count)]
+            rbd_diff = json.dumps(extents, indent=random.choice((None, 4)))
+            for read_size in (1, 7, 1024 * 1024):
+                self.assertEqual(hints_from_rbd_diff(rbd_diff),
+                                 list(hints_from_rbd_diff_file(io.StringIO(rbd_diff), read_size=read_size)))
+
+        for invalid_rbd_diff in ('', '{}', '[{"offset": 0, "length": 1, "exists": "true"}', '[1 2]'):
+            with self.assertRaises(ValueError):
+                list(hints_from_rbd_diff_file(io.StringIO(invalid_rbd_diff)))
+
+    def test_coalesced_reads(self):
+        block_size = 64 * kB
+        image = self.random_bytes(40 * block_size + 123)
+        image_filename = self._create_image('image', image)
+        blocks_count = 41
+
+        benji_obj = self.benjiOpen(init_database=True)
+        try:
+            version_uid = VersionUid(1)
+            for block_ids in (list(range(blocks_count)), random.sample(range(blocks_count), 20), [3, 4, 5, 40, 7, 6]):
+                io = IOFactory.get('file:' + image_filename, block_size)
+                io.open_r()
+                for block_id in block_ids:
+                    size = block_size if block_id < blocks_count - 1 else 123
+                    io.read(DereferencedBlock(None, version_uid, block_id, None, size, True))
+                results = list(io.read_get_completed())
+                io.close()
+
+                self.assertEqual(sorted(block_ids), sorted([block.id for block, _ in results]))
+                for block, data in results:
+                    self.assertEqual(image[block.id * block_size:block.id * block_size + block.size], data)
+        finally:
+            benji_obj.close()
+
+    def test_restore_overwrite(self):
+        block_size = 64 * kB
+        image = b'\0' * 20 * block_size + self.random_bytes(3 * block_size) + b'\0' * 10 * block_size + \
+            self.random_bytes(block_size) + b'\0' * 123
+        image_filename = self._create_image('image', image)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        version = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename)
+
+        # The zero blocks must also be restored correctly when the target already contains data
+        restore_filename = self._create_image('restore', self.random_bytes(len(image)))
+        benji_obj.restore(version.uid, 'file:' + restore_filename, sparse=False, force=True)
+        with open(restore_filename, 'rb') as f:
+            self.assertEqual(image, f.read())
+        benji_obj.close()
+
+    def test_restore_invalid_metadata(self):
+        block_size = 64 * kB
+        image = self.random_bytes(8 * block_size)
+        image_filename = self._create_image('image', image)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        version = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename)
+
+        # Make the metadata of one block undecodable
+        invalid_block = benji_obj._database_backend.get_block_by_id(version.uid, 3)
+        storage = StorageFactory.get_by_storage_id(version.storage_id)
+        key = invalid_block.uid.storage_object_to_path()
+        block_object = storage._read_object(key)
+        _, metadata_length = storage._BLOCK_OBJECT_HEADER.unpack_from(block_object)
+        data_offset = storage._BLOCK_OBJECT_HEADER.size + metadata_length
+        storage._write_object(
+            key, block_object[:storage._BLOCK_OBJECT_HEADER.size] + b'\xff' * metadata_length +
+            block_object[data_offset:])
+
+        restore_filename = os.path.join(self.testpath.path, 'restore')
+        benji_obj.restore(version.uid, 'file:' + restore_filename, sparse=False, force=False)
+        self.assertEqual(0, memory_budget.used)
+
+        # Only the block with the invalid metadata has been marked as invalid, all others have been restored
+        blocks = list(benji_obj._database_backend.get_blocks_by_version(version.uid))
+        self.assertEqual([3], [block.id for block in blocks if not block.valid])
+        self.assertEqual(VersionStatus.invalid, benji_obj._database_backend.get_version(version.uid).status)
+        with open(restore_filename, 'rb') as f:
+            restored_image = f.read()
+        for block in blocks:
+            if block.id != 3:
+                self.assertEqual(image[block.id * block_size:(block.id + 1) * block_size],
+                                 restored_image[block.id * block_size:(block.id + 1) * block_size])
+        benji_obj.close()
+
+    def test_restore_mixed_layouts(self):
+        block_size = 64 * kB
+        image = self.random_bytes(8 * block_size)
+        image_filename = self._create_image('image', image)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        version = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename)
+
+        # Convert all blocks of the first version to the layout written by older versions of Benji
+        storage = StorageFactory.get_by_storage_id(version.storage_id)
+        for block in benji_obj._database_backend.get_blocks_by_version(version.uid):
+            key = block.uid.storage_object_to_path()
+            metadata_bytes, data = storage._split_block_object(block_object=storage._read_object(key), key=key)
+            metadata = storage._decode_metadata(metadata_bytes=metadata_bytes, key=key, data_length=len(data))
+            metadata[storage._METADATA_VERSION_KEY] = '1.0.0'
+            if storage._dict_hmac:
+                storage._dict_hmac.add_digest(metadata)
+            storage._write_object(key, data)
+            storage._write_object(key + '.meta', json.dumps(metadata).encode('utf-8'))
+
+        # After an upgrade a differential backup references the old blocks and writes new ones in the current layout
+        changed_block_ids = (1, 4, 5)
+        image = bytearray(image)
+        for block_id in changed_block_ids:
+            image[block_id * block_size:(block_id + 1) * block_size] = self.random_bytes(block_size)
+        image = bytes(image)
+        image_filename = self._create_image('image', image)
+        version_2 = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename,
+                                     base_version_uid=version.uid)
+        blocks = list(benji_obj._database_backend.get_blocks_by_version(version_2.uid))
+        self.assertEqual(list(changed_block_ids),
+                         [block.id for block in blocks if block.uid.left == version_2.uid.integer])
+
+        restore_filename = os.path.join(self.testpath.path, 'restore')
+        benji_obj.restore(version_2.uid, 'file:' + restore_filename, sparse=False, force=False)
+        with open(restore_filename, 'rb') as f:
+            self.assertEqual(image, f.read())
+        # Only the blocks written by the first version have been guessed to have the legacy layout
+        self.assertTrue(storage._legacy_layouts[version.uid.integer])
+        self.assertFalse(storage._legacy_layouts.get(version_2.uid.integer, False))
+        benji_obj.close()
+
+    def test_io_throttling(self):
+        block_size = 64 * kB
+        image = self.random_bytes(20 * block_size)
+        image_filename = self._create_image('image', image)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        io = IOFactory.get('file:' + image_filename, block_size)
+        try:
+            version_uid = VersionUid(1)
+            for limits in ({'bandwidthRead': 10 * block_size}, {'iopsRead': 10}):
+                io._throttling.set_limits(**limits)
+                io.open_r()
+                t1 = time.time()
+                # The bucket is full initially, so only the reads exceeding one second's worth are delayed
+                for block_id in range(20):
+                    data = io.read_sync(DereferencedBlock(None, version_uid, block_id, None, block_size, True))
+                    self.assertEqual(image[block_id * block_size:(block_id + 1) * block_size], data)
+                self.assertGreaterEqual(time.time() - t1, 0.9)
+                io.close()
+                io._throttling.set_limits(bandwidthRead=0, iopsRead=0)
+        finally:
+            io._throttling.set_limits(bandwidthRead=0, iopsRead=0)
+            benji_obj.close()
+
+    def test_io_throttling_reload(self):
+
+        def config(limits: str) -> Config:
+            return Config(ad_hoc_config=self.CONFIG.format(testpath=self.testpath.path).replace(
+                'module: file\n', 'module: file\n              configuration: {{{}}}\n'.format(limits), 1))
+
+        throttling = IOThrottling.get('file', {})
+        try:
+            IOFactory.update_throttling(config('bandwidthRead: 1000'))
+            self.assertEqual({'bandwidthRead': 1000, 'bandwidthWrite': 0, 'iopsRead': 0, 'iopsWrite': 0},
+                             throttling.limits())
+
+            # Limits changed at runtime are kept until the configuration changes
+            throttling.set_limits(iopsWrite=5)
+            IOFactory.update_throttling(config('bandwidthRead: 1000'))
+            self.assertEqual(5, throttling.limits()['iopsWrite'])
+            IOFactory.update_throttling(config('bandwidthRead: 2000, iopsWrite: 100'))
+            self.assertEqual({'bandwidthRead': 2000, 'bandwidthWrite': 0, 'iopsRead': 0, 'iopsWrite': 100},
+                             throttling.limits())
+        finally:
+            IOFactory.update_throttling(config(''))
+        self.assertEqual({'bandwidthRead': 0, 'bandwidthWrite': 0, 'iopsRead': 0, 'iopsWrite': 0},
+                         throttling.limits())
+
+    def test_small_window(self):
+        block_size = 64 * kB
+        image = self.random_bytes(50 * block_size + 123)
+        image_filename = self._create_image('image', image)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        benji_obj._BLOCKS_IN_FLIGHT = 4
+        version = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename)
+        self.assertEqual(len(image), version.bytes_written)
+
+        restore_filename = os.path.join(self.testpath.path, 'restore')
+        benji_obj.restore(version.uid, 'file:' + restore_filename, sparse=False, force=False)
+        with open(restore_filename, 'rb') as f:
+            self.assertEqual(image, f.read())
+        benji_obj.close()
+
+    def test_memory_budget(self):
+        block_size = 64 * kB
+        image = self.random_bytes(30 * block_size) + b'\0' * 5 * block_size + self.random_bytes(123)
+        image_filename = self._create_image('image', image)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        memory_budget.set_limit(3 * block_size)
+        try:
+            in_flight = []
+            pipeline_run = Pipeline.run
+
+            def pipeline_run_check(pipeline, items):
+                for result in pipeline_run(pipeline, items):
+                    in_flight.append(memory_budget.used)
+                    yield result
+
+            with patch.object(Pipeline, 'run', pipeline_run_check):
+                version = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename)
+            self.assertEqual(0, memory_budget.used)
+
+            restore_filename = os.path.join(self.testpath.path, 'restore')
+            benji_obj.restore(version.uid, 'file:' + restore_filename, sparse=False, force=False)
+            self.assertEqual(0, memory_budget.used)
+            with open(restore_filename, 'rb') as f:
+                self.assertEqual(image, f.read())
+
+            self.assertGreater(len(in_flight), 0)
+            # One block may exceed the limit when nothing else is in flight
+            self.assertLessEqual(max(in_flight), 4 * block_size)
+        finally:
+            memory_budget.set_limit(0)
+            benji_obj.close()
+
+    def test_sanity_check_blocks(self):
+        for blocks_count, ignored_intervals in ((100, []), (100, [(10, 15)]), (1000000, [(100, 200)]),
+                                                (1000000, [(0, 500000), (600000, 1000000)])):
+            ignored_blocks = SparseBitfield.from_intervals(ignored_intervals)
+            check_blocks = Benji._sanity_check_blocks(ignored_blocks, blocks_count)
+            expected_count = max(min(len(ignored_blocks), 10), len(ignored_blocks) // 1000)
+            self.assertLessEqual(len(check_blocks), expected_count)
+            self.assertGreaterEqual(len(check_blocks), expected_count // 2)
+            self.assertTrue(all([block_id in ignored_blocks for block_id in check_blocks]))
+
+
+class BackupTestCaseSQLLite(BackupTestCase, TestCase):
+
+    CONFIG = """
+            configurationVersion: '1'
+            processName: benji
+            logFile: /dev/stderr
+            blockSize: 65536
+            ios:
+            - name: file
+              module: file
+            defaultStorage: s1
+            storages:
+            - name: s1
+              storageId: 1
+              module: file
+              configuration:
+                path: {testpath}/data
+            databaseEngine: sqlite:///{testpath}/benji.sqlite
+            """
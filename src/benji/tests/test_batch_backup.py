@@ -0,0 +1,98 @@
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from benji.benji import BackupJob
+from benji.database import Version, DatabaseBackend
+from benji.storage.file import Storage as FileStorage
+from benji.tests.testcase import BenjiTestCaseBase
+
+kB = 1024
+
+
+class BatchBackupTestCase(BenjiTestCaseBase):
+
+    def _create_image(self, name: str, data: bytes) -> str:
+        image_filename = os.path.join(self.testpath.path, name)
+        with open(image_filename, 'wb') as f:
+            f.write(data)
+        return image_filename
+
+    def test_batch_backup(self):
+        image = self.random_bytes(512 * kB + 123)
+        image_1_filename = self._create_image('image-1', image)
+        image_2_filename = self._create_image('image-2', image)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        jobs = [
+            BackupJob('data-backup-1', 'snapshot-name', 'file:' + image_1_filename),
+            BackupJob('data-backup-2', 'snapshot-name', 'file:' + os.path.join(self.testpath.path, 'missing')),
+            BackupJob('data-backup-3', 'snapshot-name', 'file:' + image_2_filename),
+        ]
+        results = list(benji_obj.batch_backup(jobs))
+
+        self.assertEqual(jobs, [job for job, _ in results])
+        self.assertIsInstance(results[0][1], Version)
+        self.assertIsInstance(results[1][1], FileNotFoundError)
+        self.assertIsInstance(results[2][1], Version)
+
+        # The second image is identical to the first one, so all its blocks must have been deduplicated
+        version_3 = results[2][1]
+        self.assertEqual(0, version_3.bytes_written)
+        self.assertEqual(len(image), version_3.bytes_dedup)
+
+        for _, version in (results[0], results[2]):
+            benji_obj.deep_scrub(version.uid)
+        benji_obj.close()
+
+    def test_batch_backup_shares_setup(self):
+        jobs = [
+            BackupJob('data-backup-{}'.format(i), 'snapshot-name',
+                      'file:' + self._create_image('image-{}'.format(i), self.random_bytes(128 * kB)))
+            for i in range(4)
+        ]
+        self.benjiOpen(init_database=True).close()
+
+        with patch.object(FileStorage, '__init__', autospec=True, side_effect=FileStorage.__init__) as storage_init, \
+                patch.object(DatabaseBackend, 'open', autospec=True, side_effect=DatabaseBackend.open) as database_open:
+            # Separate invocations of benji backup open the database and set up the storage for each backup
+            for job in jobs:
+                benji_obj = self.benjiOpen()
+                benji_obj.backup(job.version_name, job.version_snapshot_name, job.source)
+                benji_obj.close()
+            self.assertEqual(len(jobs), database_open.call_count)
+            self.assertEqual(len(jobs), storage_init.call_count)
+
+            # A batch does this only once
+            database_open.reset_mock()
+            storage_init.reset_mock()
+            benji_obj = self.benjiOpen()
+            results = list(benji_obj.batch_backup(jobs))
+            self.assertEqual(1, database_open.call_count)
+            self.assertEqual(1, storage_init.call_count)
+            self.assertEqual(1, len(benji_obj._dedup_indexes))
+            benji_obj.close()
+
+        for _, result in results:
+            self.assertIsInstance(result, Version)
+
+
+class BatchBackupTestCaseSQLLite(BatchBackupTestCase, TestCase):
+
+    CONFIG = """
+            configurationVersion: '1'
+            processName: benji
+            logFile: /dev/stderr
+            blockSize: 65536
+            ios:
+            - name: file
+              module: file
+            defaultStorage: s1
+            storages:
+            - name: s1
+              storageId: 1
+              module: file
+              configuration:
+                path: {testpath}/data
+            databaseEngine: sqlite:///{testpath}/benji.sqlite
+            """
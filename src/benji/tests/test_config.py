@@ -145,6 +145,8 @@ class ConfigTestCase(TestCaseBase, TestCase):
             'bandwidthRead': 0,
             'bandwidthWrite': 0,
             'consistencyCheckWrites': False,
+            'packCompactionThreshold': 50,
+            'packSize': 0,
             'path': '/var/tmp',
             'simultaneousReads': 3,
             'simultaneousWrites': 3,
@@ -168,8 +170,13 @@ class ConfigTestCase(TestCaseBase, TestCase):
         config = Config(ad_hoc_config=self.CONFIG)
         module_configuration = config.get('ios')[0]['configuration']
         self.assertEqual({
+            'bandwidthRead': 0,
+            'bandwidthWrite': 0,
             'cephConfigFile': '/etc/ceph/ceph.conf',
             'clientIdentifier': 'admin',
+            'generateHints': False,
+            'iopsRead': 0,
+            'iopsWrite': 0,
             'newImageFeatures': ['RBD_FEATURE_LAYERING', 'RBD_FEATURE_EXCLUSIVE_LOCK'],
             'simultaneousReads': 10,
             'simultaneousWrites': 10,
@@ -185,6 +185,163 @@ class DatabaseBackendTestCase(DatabaseBackendTestCaseBase):
                     deleted_count += 1
         self.assertEqual(num_blocks, deleted_count)
 
+    def test_set_block(self):
+        version = self.database_backend.create_version(version_name='name-' + self.random_string(12),
+                                                       snapshot_name='snapshot-name-' + self.random_string(12),
+                                                       size=256 * 4096,
+                                                       block_size=4096,
+                                                       storage_id=1)
+
+        num_blocks = 256
+        blocks: List[Dict[str, Any]] = []
+        for id in range(num_blocks):
+            blocks.append({
+                'id': id,
+                'version_uid': version.uid,
+                'uid_left': None,
+                'uid_right': None,
+                'checksum': None,
+                'size': 4096,
+                'valid': True
+            })
+        self.database_backend.create_blocks(blocks=blocks)
+        self.database_backend.commit()
+
+        checksums = []
+        for id in range(num_blocks):
+            checksums.append(self.random_hex(32))
+            self.database_backend.set_block(id=id,
+                                            version_uid=version.uid,
+                                            block_uid=BlockUid(version.uid.integer, id + 1),
+                                            checksum=checksums[id],
+                                            size=4096,
+                                            valid=id % 2 == 0)
+
+        # Buffered updates must be visible to queries before they are committed
+        block = self.database_backend.get_block_by_checksum(checksums[0], 1)
+        self.assertEqual(0, block.id)
+        for id, block in enumerate(self.database_backend.get_blocks_by_version(version.uid)):
+            self.assertEqual(BlockUid(version.uid.integer, id + 1), block.uid)
+            self.assertEqual(checksums[id], block.checksum)
+            self.assertEqual(id % 2 == 0, block.valid)
+        self.database_backend.commit()
+
+        # Updates are discarded on rollback
+        self.database_backend.set_block(id=0,
+                                        version_uid=version.uid,
+                                        block_uid=None,
+                                        checksum=None,
+                                        size=4096,
+                                        valid=True)
+        self.database_backend._session.rollback()
+        block = self.database_backend.get_block_by_id(version.uid, 0)
+        self.assertEqual(BlockUid(version.uid.integer, 1), block.uid)
+        self.assertEqual(checksums[0], block.checksum)
+
+        # Updates of loaded blocks are reflected in the session
+        self.database_backend.set_block(id=1,
+                                        version_uid=version.uid,
+                                        block_uid=None,
+                                        checksum=None,
+                                        size=4096,
+                                        valid=True)
+        block = self.database_backend.get_block_by_id(version.uid, 1)
+        self.assertFalse(block.uid)
+        self.assertIsNone(block.checksum)
+        self.assertTrue(block.valid)
+        self.database_backend.commit()
+
+    def test_get_blocks_by_ids(self):
+        version = self.database_backend.create_version(version_name='name-' + self.random_string(12),
+                                                       snapshot_name='snapshot-name-' + self.random_string(12),
+                                                       size=1024 * 4096,
+                                                       block_size=4096,
+                                                       storage_id=1)
+
+        num_blocks = 1024
+        blocks: List[Dict[str, Any]] = []
+        for id in range(num_blocks):
+            blocks.append({
+                'id': id,
+                'version_uid': version.uid,
+                'uid_left': None,
+                'uid_right': None,
+                'checksum': None,
+                'size': 4096,
+                'valid': id % 100 != 0
+            })
+        self.database_backend.create_blocks(blocks=blocks)
+        self.database_backend.commit()
+
+        block_ids = set(range(10, 300)) | set(range(0, num_blocks, 3)) | {1023, 500, 501}
+        for yield_per in (1, 7, 100, 10000):
+            result_ids = [
+                block.id
+                for block in self.database_backend.get_blocks_by_ids(version.uid, sorted(block_ids), yield_per=yield_per)
+            ]
+            self.assertEqual(sorted(block_ids), result_ids)
+
+        self.assertEqual([], list(self.database_backend.get_blocks_by_ids(version.uid, [])))
+
+        id_runs = [(0, 1), (5, 300), (400, 1), (402, 2), (1000, 24)]
+        expected_ids = [block_id for start, length in id_runs for block_id in range(start, start + length)]
+        for yield_per in (1, 7, 100, 10000):
+            result_ids = [
+                block.id for block in self.database_backend.get_blocks_by_id_runs(version.uid, id_runs, yield_per=yield_per)
+            ]
+            self.assertEqual(expected_ids, result_ids)
+        self.assertEqual(list(range(0, num_blocks, 100)),
+                         self.database_backend.get_invalid_block_ids_by_version(version.uid))
+
+    def test_clone_blocks(self):
+        base_version = self.database_backend.create_version(version_name='name-' + self.random_string(12),
+                                                            snapshot_name='snapshot-name-' + self.random_string(12),
+                                                            size=9 * 4096 + 123,
+                                                            block_size=4096,
+                                                            storage_id=1)
+        blocks: List[Dict[str, Any]] = []
+        for id in range(10):
+            blocks.append({
+                'id': id,
+                'version_uid': base_version.uid,
+                'uid_left': base_version.uid.integer,
+                'uid_right': id + 1,
+                'checksum': self.random_hex(32),
+                'size': 4096 if id < 9 else 123,
+                'valid': id != 3
+            })
+        self.database_backend.create_blocks(blocks=blocks)
+        self.database_backend.commit()
+
+        for size, expected_count in ((9 * 4096 + 123, 10), (12 * 4096, 10), (5 * 4096 + 1, 6), (9 * 4096, 9)):
+            version = self.database_backend.create_version(version_name='name-' + self.random_string(12),
+                                                           snapshot_name='snapshot-name-' + self.random_string(12),
+                                                           size=size,
+                                                           block_size=4096,
+                                                           storage_id=1)
+            count = self.database_backend.clone_blocks(base_version_uid=base_version.uid,
+                                                       version_uid=version.uid,
+                                                       size=size,
+                                                       block_size=4096)
+            self.database_backend.commit()
+            self.assertEqual(expected_count, count)
+
+            cloned_blocks = list(self.database_backend.get_blocks_by_version(version.uid))
+            self.assertEqual(expected_count, len(cloned_blocks))
+            for block in cloned_blocks:
+                base_block = blocks[block.id]
+                expected_size = min(4096, size - block.id * 4096)
+                self.assertEqual(version.uid, block.version_uid)
+                self.assertEqual(expected_size, block.size)
+                if expected_size == base_block['size']:
+                    self.assertEqual(BlockUid(base_block['uid_left'], base_block['uid_right']), block.uid)
+                    self.assertEqual(base_block['checksum'], block.checksum)
+                    self.assertEqual(base_block['valid'], block.valid)
+                else:
+                    self.assertFalse(block.uid)
+                    self.assertIsNone(block.checksum)
+                    self.assertFalse(block.valid)
+
     def test_lock_version(self):
         locking = self.database_backend.locking()
         locking.lock_version(VersionUid(1), reason='locking test')
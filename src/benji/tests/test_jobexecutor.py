@@ -0,0 +1,60 @@
+import threading
+import time
+from concurrent.futures import TimeoutError
+from unittest import TestCase
+
+from benji.jobexecutor import JobExecutor
+
+
+class JobExecutorTestCase(TestCase):
+
+    def _test_results(self, blocking_submit: bool) -> None:
+        executor = JobExecutor(name='Test', workers=4, blocking_submit=blocking_submit)
+        for i in range(100):
+            executor.submit(lambda i=i: i)
+        executor.submit(lambda: 1 / 0)
+
+        results = list(executor.get_completed())
+        self.assertEqual(list(range(100)), sorted([result for result in results if isinstance(result, int)]))
+        self.assertEqual(1, len([result for result in results if isinstance(result, ZeroDivisionError)]))
+        self.assertEqual(0, executor.outstanding_jobs)
+        self.assertEqual(101, executor.stats()['jobs_completed'])
+        executor.shutdown()
+
+    def test_results_blocking_submit(self):
+        self._test_results(blocking_submit=True)
+
+    def test_results_non_blocking_submit(self):
+        self._test_results(blocking_submit=False)
+
+    def test_timeout(self):
+        executor = JobExecutor(name='Test', workers=1, blocking_submit=False)
+        event = threading.Event()
+        executor.submit(lambda: 'first')
+        executor.submit(lambda: event.wait())
+        time.sleep(0.1)
+
+        results = []
+        with self.assertRaises(TimeoutError):
+            for result in executor.get_completed(timeout=0):
+                results.append(result)
+        self.assertEqual(['first'], results)
+        self.assertEqual(1, executor.outstanding_jobs)
+
+        event.set()
+        self.assertEqual([True], list(executor.get_completed(timeout=10)))
+        executor.shutdown()
+
+    def test_shutdown_cancels_jobs(self):
+        executor = JobExecutor(name='Test', workers=1, blocking_submit=False)
+        event = threading.Event()
+        executor.submit(lambda: event.wait())
+        for i in range(10):
+            executor.submit(lambda i=i: i)
+        time.sleep(0.1)
+
+        threading.Timer(0.1, event.set).start()
+        executor.shutdown()
+        self.assertEqual(0, executor.outstanding_jobs)
+        self.assertEqual(10, executor.stats()['jobs_cancelled'])
+        self.assertEqual(1, executor.stats()['jobs_completed'])
@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+from benji.exception import InternalError
+from benji.storage.metadatacodec import MetadataCodec
+
+
+class MetadataCodecTestCase(TestCase):
+
+    def setUp(self):
+        self.data = {
+            'a': 10,
+            'b': 'test',
+            'c': True,
+            'd': None,
+            'e': {
+                'a': -1,
+                'b': 'test' * 100
+            },
+            'f': [0, 127, 128, 2**32, 2**63, -33, -2**63, 1.5, b'\x00\x01'],
+            'g': [[1, 2, 3, 4]] * 20,
+        }
+        self.codec = MetadataCodec(secret_key=b'sadasdadsadasdadadadad')
+
+    def test_roundtrip(self):
+        data = self.codec.encode(self.data)
+        self.assertTrue(MetadataCodec.is_encoded(data))
+        self.assertDictEqual(self.data, self.codec.decode(data))
+
+    def test_roundtrip_without_hmac(self):
+        codec = MetadataCodec(secret_key=None)
+        self.assertDictEqual(self.data, codec.decode(codec.encode(self.data)))
+
+    def test_canonical(self):
+        data_reversed = {key: self.data[key] for key in reversed(list(self.data.keys()))}
+        self.assertEqual(self.codec.encode(self.data), self.codec.encode(data_reversed))
+
+    def test_invalid_digest(self):
+        data = bytearray(self.codec.encode(self.data))
+        data[-1] ^= 0xff
+        self.assertRaises(ValueError, lambda: self.codec.decode(bytes(data)))
+
+    def test_modified_payload(self):
+        data = self.codec.encode(self.data)
+        data_modified = data.replace(b'test', b'tost', 1)
+        self.assertNotEqual(data, data_modified)
+        self.assertRaises(ValueError, lambda: self.codec.decode(data_modified))
+
+    def test_missing_digest(self):
+        data = MetadataCodec(secret_key=None).encode(self.data)
+        self.assertRaises(ValueError, lambda: self.codec.decode(data))
+
+    def test_different_key(self):
+        data = MetadataCodec(secret_key=b'different').encode(self.data)
+        self.assertRaises(ValueError, lambda: self.codec.decode(data))
+
+    def test_truncated(self):
+        codec = MetadataCodec(secret_key=None)
+        data = codec.encode(self.data)
+        self.assertRaises(ValueError, lambda: codec.decode(data[:-1]))
+        self.assertRaises(ValueError, lambda: codec.decode(data + b'\x00'))
+        self.assertRaises(ValueError, lambda: codec.decode(b'{"a": 1}'))
+
+    def test_unsupported_type(self):
+        self.assertRaises(InternalError, lambda: self.codec.encode({'a': object()}))
+        self.assertRaises(InternalError, lambda: self.codec.encode({1: 'a'}))
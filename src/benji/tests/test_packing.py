@@ -0,0 +1,171 @@
+import os
+from unittest import TestCase
+
+from benji.database import BlockUid, PackUid, PackedBlock, Block, DatabaseBackend
+from benji.factory import StorageFactory
+from benji.packindex import PackIndex
+from benji.tests.testcase import BenjiTestCaseBase
+from benji.utils import memory_budget
+
+kB = 1024
+
+
+class PackingTestCase(BenjiTestCaseBase):
+
+    def _create_image(self, name: str, data: bytes) -> str:
+        image_filename = os.path.join(self.testpath.path, name)
+        with open(image_filename, 'wb') as f:
+            f.write(data)
+        return image_filename
+
+    def _restore_and_compare(self, benji_obj, version_uid, image: bytes) -> None:
+        restore_filename = os.path.join(self.testpath.path, 'restore-' + version_uid.v_string)
+        benji_obj.restore(version_uid, 'file:' + restore_filename, sparse=False, force=True)
+        with open(restore_filename, 'rb') as f:
+            self.assertEqual(image, f.read())
+
+    @staticmethod
+    def _list_keys(storage, prefix: str):
+        return [key for key in storage._list_objects(prefix) if not key.endswith('.meta')]
+
+    def test_backup_restore(self):
+        block_size = 64 * kB
+        image = self.random_bytes(40 * block_size + 123)
+        image_filename = self._create_image('image', image)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        version = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + image_filename)
+        self.assertEqual(len(image), version.bytes_written)
+        # The memory held by the packs has been released after they were written
+        self.assertEqual(0, memory_budget.used)
+
+        storage = StorageFactory.get_by_name('s1')
+        self.assertEqual([], self._list_keys(storage, BlockUid.storage_prefix()))
+        pack_keys = self._list_keys(storage, PackUid.storage_prefix())
+        self.assertGreater(len(pack_keys), 1)
+        self.assertLess(len(pack_keys), 40)
+        self.assertEqual(41, len(list(storage.list_blocks())))
+
+        self._restore_and_compare(benji_obj, version.uid, image)
+        benji_obj.deep_scrub(version.uid)
+        benji_obj.close()
+
+    def test_cleanup_compaction(self):
+        block_size = 64 * kB
+        image_1 = self.random_bytes(40 * block_size)
+        # The second image shares every second block with the first one
+        image_2 = b''.join([
+            image_1[i * block_size:(i + 1) * block_size] if i % 2 == 0 else self.random_bytes(block_size)
+            for i in range(40)
+        ])
+
+        benji_obj = self.benjiOpen(init_database=True)
+        version_1 = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + self._create_image('image-1', image_1))
+        version_2 = benji_obj.backup('data-backup', 'snapshot-name', 'file:' + self._create_image('image-2', image_2))
+
+        storage = StorageFactory.get_by_name('s1')
+        packs_before = set(self._list_keys(storage, PackUid.storage_prefix()))
+
+        benji_obj.rm(version_1.uid)
+        benji_obj.cleanup(dt=0)
+
+        # Half of the blocks of the first version are gone, so at least some of its packs have been compacted
+        packs_after = set(self._list_keys(storage, PackUid.storage_prefix()))
+        self.assertNotEqual(packs_before, packs_after)
+        self.assertEqual(40, benji_obj._database_backend._session.query(PackedBlock).count())
+
+        self._restore_and_compare(benji_obj, version_2.uid, image_2)
+        benji_obj.deep_scrub(version_2.uid)
+
+        benji_obj.rm(version_2.uid)
+        benji_obj.cleanup(dt=0)
+        self.assertEqual([], self._list_keys(storage, PackUid.storage_prefix()))
+        self.assertEqual(0, benji_obj._database_backend._session.query(PackedBlock).count())
+        benji_obj.close()
+
+    def test_metadata_restore(self):
+        block_size = 64 * kB
+        image = self.random_bytes(20 * block_size + 4567)
+
+        benji_obj = self.benjiOpen(init_database=True)
+        version_uid = benji_obj.backup('data-backup', 'snapshot-name',
+                                       'file:' + self._create_image('image', image)).uid
+        benji_obj.close()
+
+        # The pack index is rebuilt from the packs in the storage
+        benji_obj = self.benjiOpen(in_memory_database=True)
+        benji_obj.metadata_restore([version_uid])
+        self._restore_and_compare(benji_obj, version_uid, image)
+        benji_obj.deep_scrub(version_uid)
+        benji_obj.close()
+
+    def test_packs_written_by_other_process(self):
+        benji_obj = self.benjiOpen(init_database=True)
+        storage = StorageFactory.get_by_name('s1')
+        # There are no packs yet and the pack index remembers this
+        self.assertIsNone(storage._locate(BlockUid(1, 1)))
+
+        # Another process with its own database session and storage instance writes the first packs
+        database_backend = DatabaseBackend(self.config).open()
+        storage_module = StorageFactory._modules[storage.storage_id]
+        other_storage = storage_module.module.Storage(**storage_module.arguments)
+        other_storage.set_pack_index(PackIndex(database_backend=database_backend, storage_id=storage.storage_id))
+        blocks = [Block(uid=BlockUid(1, i + 1), size=4 * kB, checksum='0000000000000000') for i in range(8)]
+        data = {block.uid: self.random_bytes(4 * kB) for block in blocks}
+        for block in blocks:
+            other_storage.write_block_async(block, data[block.uid])
+        for result in other_storage.write_get_completed():
+            self.assertNotIsInstance(result, Exception)
+        database_backend.commit()
+        self.assertEqual([], self._list_keys(storage, BlockUid.storage_prefix()))
+
+        for block in blocks:
+            storage.read_block_async(block)
+        results = list(storage.read_get_completed())
+        self.assertEqual(len(blocks), len(results))
+        for result in results:
+            self.assertNotIsInstance(result, Exception)
+            self.assertEqual(data[result[0].uid], result[1])
+
+        storage._pack_index._has_packs = False
+        for block in blocks:
+            self.assertEqual(data[block.uid], storage.read_block(block))
+
+        other_storage.close()
+        database_backend.close()
+        benji_obj.close()
+
+
+class PackingTestCaseSQLLite(PackingTestCase, TestCase):
+
+    CONFIG = """
+            configurationVersion: '1'
+            processName: benji
+            logFile: /dev/stderr
+            blockSize: 65536
+            ios:
+            - name: file
+              module: file
+            defaultStorage: s1
+            storages:
+            - name: s1
+              storageId: 1
+              module: file
+              configuration:
+                path: {testpath}/data
+                packSize: 262144
+                packCompactionThreshold: 75
+                consistencyCheckWrites: True
+                activeTransforms:
+                  - zstd
+                hmac:
+                  kdfSalt: BBiZ+lIVSefMCdE4eOPX211n/04KY1M4c2SM/9XHUcA=
+                  kdfIterations: 1000
+                  password: Hallo123
+            transforms:
+            - name: zstd
+              module: zstd
+              configuration:
+                level: 1
+            databaseEngine: sqlite:///{testpath}/benji.sqlite
+            """
@@ -0,0 +1,98 @@
+import random
+from unittest import TestCase
+
+from benji.exception import InternalError
+from benji.pipeline import Pipeline
+from benji.utils import MemoryBudget
+
+
+class FakeAsyncIO:
+
+    def __init__(self) -> None:
+        self.in_flight = []
+        self.max_in_flight = 0
+
+    def submit(self, *args) -> None:
+        self.in_flight.append(args[0] if len(args) == 1 else args)
+        self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+
+    def get_completed(self, timeout: int = None):
+        while self.in_flight:
+            # Complete the jobs out of order
+            yield self.in_flight.pop(random.randrange(len(self.in_flight)))
+
+
+class PipelineTestCase(TestCase):
+
+    def test_window(self):
+        for items_count, window in ((0, 4), (3, 4), (100, 1), (100, 4), (1000, 32)):
+            reader = FakeAsyncIO()
+            pipeline = Pipeline('test', window=window)
+            pipeline.read_stage('read', submit=reader.submit, get_completed=reader.get_completed)
+
+            results = list(pipeline.run(range(items_count)))
+            self.assertEqual(list(range(items_count)), sorted(results))
+            self.assertLessEqual(reader.max_in_flight, window)
+            self.assertEqual(items_count, pipeline.stats()['read']['completed'])
+
+    def test_map_and_write(self):
+        reader, writer = FakeAsyncIO(), FakeAsyncIO()
+        written = []
+        pipeline = Pipeline('test', window=8)
+        pipeline.read_stage('read', submit=reader.submit, get_completed=reader.get_completed)
+        pipeline.map_stage('square', function=lambda item: 1 / 0 if item == 13 else item * item, workers=4)
+        pipeline.write_stage('write',
+                             submit=writer.submit,
+                             get_completed=writer.get_completed,
+                             completed=written.append)
+
+        results = []
+        for result in pipeline.run(range(100)):
+            if isinstance(result, ZeroDivisionError):
+                continue
+            results.append(result)
+            pipeline.write(result)
+
+        expected = sorted([item * item for item in range(100) if item != 13])
+        self.assertEqual(expected, sorted(results))
+        self.assertEqual(expected, sorted(written))
+        stats = pipeline.stats()
+        self.assertEqual(100, stats['square']['completed'])
+        self.assertEqual(99, stats['write']['completed'])
+
+    def test_memory_budget(self):
+        budget = MemoryBudget()
+        budget.set_limit(3)
+        lease = budget.lease()
+        reader, writer = FakeAsyncIO(), FakeAsyncIO()
+        used = []
+
+        def written(item):
+            lease.release(1)
+
+        pipeline = Pipeline('test', window=32, lease=lease)
+        pipeline.read_stage('read', submit=reader.submit, get_completed=reader.get_completed, item_size=lambda item: 1)
+        pipeline.map_stage('identity', function=lambda item: item, workers=2)
+        pipeline.write_stage('write', submit=writer.submit, get_completed=writer.get_completed, completed=written)
+
+        for result in pipeline.run(range(100)):
+            used.append(budget.used)
+            if result % 2 == 0:
+                pipeline.write(result)
+            else:
+                lease.release(1)
+
+        self.assertEqual(100, len(used))
+        self.assertLessEqual(max(used), 4)
+        self.assertEqual(0, budget.used)
+        lease.close()
+
+    def test_inconsistent_counts(self):
+
+        def get_completed(timeout: int = None):
+            return iter(())
+
+        pipeline = Pipeline('test', window=8)
+        pipeline.read_stage('read', submit=lambda item: None, get_completed=get_completed)
+        with self.assertRaises(InternalError):
+            list(pipeline.run(range(10)))
@@ -10,7 +10,7 @@ from datetime import datetime
 from importlib import import_module
 from threading import Lock
 from time import time
-from typing import List, Tuple, Union, Any, Optional, Dict, Iterator
+from typing import List, Tuple, Union, Any, Optional, Dict, Iterator, TextIO
 
 import setproctitle
 from Crypto.Hash import SHA512
@@ -22,11 +22,69 @@ from benji.exception import ConfigurationError, UsageError
 from benji.logging import logger
 
 
+def _hint_from_rbd_diff_extent(extent: Dict[str, Any]) -> Tuple[int, int, bool]:
+    return extent['offset'], extent['length'], False if extent['exists'] == 'false' or not extent['exists'] else True
+
+
 def hints_from_rbd_diff(rbd_diff: str) -> List[Tuple[int, int, bool]]:
     """ Return the required offset:length tuples from a rbd json diff
     """
     data = json.loads(rbd_diff)
-    return [(l['offset'], l['length'], False if l['exists'] == 'false' or not l['exists'] else True) for l in data]
+    return [_hint_from_rbd_diff_extent(l) for l in data]
+
+
+def hints_from_rbd_diff_file(f: TextIO, read_size: int = 1024 * 1024) -> Iterator[Tuple[int, int, bool]]:
+    """ Like hints_from_rbd_diff but reads the rbd json diff incrementally from a file and yields the hints one by one.
+    The JSON document is never completely loaded into memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    # One of: start, first_element, element, separator
+    state = 'start'
+    while True:
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+
+        if position == len(buffer) and not eof:
+            chunk = f.read(read_size)
+            eof = chunk == ''
+            buffer = chunk
+            position = 0
+            continue
+        elif position == len(buffer):
+            raise ValueError('Unexpected end of rbd diff.')
+
+        char = buffer[position]
+        if state == 'start':
+            if char != '[':
+                raise ValueError('Expected a list at the start of the rbd diff.')
+            position += 1
+            state = 'first_element'
+        elif state in ('first_element', 'separator') and char == ']':
+            return
+        elif state == 'separator':
+            if char != ',':
+                raise ValueError('Expected , or ] in rbd diff, got {}.'.format(char))
+            position += 1
+            state = 'element'
+        else:
+            try:
+                extent, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The extent might be incomplete, so read some more data
+                if eof:
+                    raise
+                chunk = f.read(read_size)
+                eof = chunk == ''
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            if not isinstance(extent, dict):
+                raise ValueError('Expected an extent in rbd diff, got {}.'.format(extent))
+            yield _hint_from_rbd_diff_extent(extent)
+            state = 'separator'
 
 
 # old_msg is used as a stateful storage between calls
@@ -175,6 +233,110 @@ class TokenBucket:
                 return -self.tokens / self.rate
 
 
+class MemoryBudget:
+    """
+    A process wide limit on the number of bytes of block data which are in flight at the same time. Each stage
+    acquires the size of the data it is about to hold and releases it when it is done with it. A limit of zero
+    disables the limit. A single request is always granted when nothing else is acquired, so requests larger
+    than the limit can still be served.
+    """
+
+    def __init__(self) -> None:
+        self.limit = 0
+        self.used = 0
+        self.lock = Lock()
+
+    def set_limit(self, limit: int) -> None:
+        with self.lock:
+            self.limit = limit
+
+    def _admissible(self, size: int) -> bool:
+        return not self.limit or self.used == 0 or self.used + size <= self.limit
+
+    @property
+    def exhausted(self) -> bool:
+        return bool(self.limit) and self.used >= self.limit
+
+    def try_acquire(self, size: int) -> bool:
+        with self.lock:
+            if not self._admissible(size):
+                return False
+            self.used += size
+            return True
+
+    def charge(self, size: int) -> None:
+        """ Accounts for size bytes without waiting even if this exceeds the limit. This is meant for cases where
+        waiting could deadlock because the memory is held by the caller itself.
+        """
+        with self.lock:
+            self.used += size
+
+    def release(self, size: int) -> None:
+        with self.lock:
+            assert self.used >= size
+            self.used -= size
+
+    def lease(self) -> 'MemoryBudgetLease':
+        return MemoryBudgetLease(self)
+
+
+class MemoryBudgetLease:
+    """
+    Keeps track of the bytes acquired from a MemoryBudget by one operation so that everything still held can be
+    released at once when the operation ends, for example because of an error. The lease also records how long the
+    operation had to wait for the budget, so the statistics only cover this operation.
+    """
+
+    def __init__(self, budget: MemoryBudget) -> None:
+        self._budget = budget
+        self.used = 0
+        # Number of times each stage had to wait and the total time spent waiting
+        self._waits: Dict[str, Tuple[int, float]] = {}
+
+    def try_acquire(self, size: int) -> bool:
+        if self._budget.try_acquire(size):
+            self.used += size
+            return True
+        return False
+
+    def charge(self, size: int) -> None:
+        self._budget.charge(size)
+        self.used += size
+
+    @property
+    def exhausted(self) -> bool:
+        return self._budget.exhausted
+
+    def record_wait(self, stage: str, duration: float) -> None:
+        count, total = self._waits.get(stage, (0, 0.0))
+        self._waits[stage] = (count + 1, total + duration)
+
+    def log_stats(self) -> None:
+        for stage, (count, total) in sorted(self._waits.items()):
+            logger.debug('Memory budget: Stage {} had to wait {} times for a total of {:.1f}s.'.format(
+                stage, count, total))
+
+    def release(self, size: int) -> None:
+        assert self.used >= size
+        self.used -= size
+        self._budget.release(size)
+
+    def close(self) -> None:
+        if self.used > 0:
+            self._budget.release(self.used)
+            self.used = 0
+
+    def __enter__(self) -> 'MemoryBudgetLease':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+# Shared by all I/O and storage modules of this process
+memory_budget = MemoryBudget()
+
+
 class InputValidation:
 
     QUALIFIED_NAME_REGEXP = '(?!-)[-a-zA-Z0-9_.]{1,63}(?<!-)'